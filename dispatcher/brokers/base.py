@@ -1,4 +1,4 @@
-from typing import Any, AsyncGenerator, Callable, Coroutine, Iterator, Optional, Protocol
+from typing import Any, AsyncGenerator, Callable, Coroutine, Iterable, Iterator, Optional, Protocol
 
 
 class BaseBroker(Protocol):
@@ -9,10 +9,16 @@ class BaseBroker(Protocol):
 
     async def apublish_message(self, channel: Optional[str] = None, message: str = '') -> None: ...
 
+    async def apublish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None: ...
+
     async def aclose(self) -> None: ...
 
+    def abandon_async_connections(self) -> bool: ...
+
     def process_notify(self, connected_callback: Optional[Callable] = None, timeout: float = 5.0, max_messages: int = 1) -> Iterator[tuple[str, str]]: ...
 
     def publish_message(self, channel=None, message=None): ...
 
+    def publish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None: ...
+
     def close(self): ...
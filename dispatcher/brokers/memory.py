@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from typing import Any, AsyncGenerator, Callable, Coroutine, Iterable, Iterator, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+"""In-memory broker, for running the service and publishers without postgres
+
+Messages go through a hub shared by everything in the current process, and are delivered
+to asyncio queues for async listeners or to thread-safe queues for blocking listeners.
+This is intended for tests and benchmarks, nothing is persisted and nothing leaves the host.
+
+By default, messages can only be delivered within the process that created the hub.
+With cross_process, the hub opens a datagram socket pair, and processes forked after that
+can publish back to listeners in the original process. This requires forking after the
+broker is created, so it works with the fork process manager, but not forkserver.
+"""
+
+
+class AsyncSubscriber:
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.queue: asyncio.Queue[tuple[str, str]] = asyncio.Queue()
+
+    def deliver(self, channel: str, message: str) -> None:
+        if threading.get_ident() == self.thread_id:
+            self.queue.put_nowait((channel, message))
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (channel, message))
+
+
+class SyncSubscriber:
+    def __init__(self) -> None:
+        self.queue: queue.Queue[tuple[str, str]] = queue.Queue()
+
+    def deliver(self, channel: str, message: str) -> None:
+        self.queue.put((channel, message))
+
+
+Subscriber = Union[AsyncSubscriber, SyncSubscriber]
+
+
+class MemoryHub:
+    "Routes messages to subscribers by channel, shared by all memory brokers in this process"
+
+    def __init__(self) -> None:
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.subscribers: dict[str, list[Subscriber]] = {}
+        # For cross_process, children send on child_sock and the hub process reads from parent_sock
+        self.parent_sock: Optional[socket.socket] = None
+        self.child_sock: Optional[socket.socket] = None
+        self.reader_loops: dict[asyncio.AbstractEventLoop, int] = {}  # loop to count of listeners using it
+
+    def enable_cross_process(self) -> None:
+        with self.lock:
+            if self.parent_sock is None and os.getpid() == self.pid:
+                self.parent_sock, self.child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self.parent_sock.setblocking(False)
+
+    def subscribe(self, channels: Union[tuple, list], subscriber: Subscriber) -> None:
+        with self.lock:
+            for channel in channels:
+                self.subscribers.setdefault(channel, []).append(subscriber)
+
+    def unsubscribe(self, channels: Union[tuple, list], subscriber: Subscriber) -> None:
+        with self.lock:
+            for channel in channels:
+                channel_subscribers = self.subscribers.get(channel, [])
+                if subscriber in channel_subscribers:
+                    channel_subscribers.remove(subscriber)
+                if not channel_subscribers:
+                    self.subscribers.pop(channel, None)
+
+    def publish(self, channel: str, message: str) -> None:
+        if os.getpid() != self.pid:
+            if self.child_sock is None:
+                raise RuntimeError('Memory broker can not publish from a child process unless cross_process is enabled before forking')
+            self.child_sock.send(json.dumps([channel, message]).encode('utf-8'))
+            return
+        self.deliver(channel, message)
+
+    def deliver(self, channel: str, message: str) -> None:
+        with self.lock:
+            channel_subscribers = list(self.subscribers.get(channel, []))
+        if not channel_subscribers:
+            logger.debug(f'No listeners for memory broker message to {channel}, dropping it')
+        for subscriber in channel_subscribers:
+            subscriber.deliver(channel, message)
+
+    def read_from_children(self) -> None:
+        "Reader callback for the event loop, delivers all datagrams from child processes that are ready"
+        assert self.parent_sock is not None
+        while True:
+            try:
+                data = self.parent_sock.recv(1 << 20)  # larger than any datagram the socket will send
+            except BlockingIOError:
+                return
+            channel, message = json.loads(data)
+            self.deliver(channel, message)
+
+    def add_loop_reader(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self.parent_sock is None:
+            return
+        if not self.reader_loops:
+            loop.add_reader(self.parent_sock.fileno(), self.read_from_children)  # only one loop reads at a time
+        self.reader_loops[loop] = self.reader_loops.get(loop, 0) + 1
+
+    def remove_loop_reader(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self.parent_sock is None or loop not in self.reader_loops:
+            return
+        self.reader_loops[loop] -= 1
+        if self.reader_loops[loop] <= 0:
+            del self.reader_loops[loop]
+            if not loop.is_closed():
+                loop.remove_reader(self.parent_sock.fileno())
+            # another loop may still be listening, let it read from now on
+            for other_loop in self.reader_loops:
+                other_loop.call_soon_threadsafe(other_loop.add_reader, self.parent_sock.fileno(), self.read_from_children)
+                break
+
+    def after_fork_in_child(self) -> None:
+        "Children only publish back to the parent, they do not get messages meant for listeners in the parent"
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.reader_loops = {}
+        if self.parent_sock is not None:
+            self.parent_sock.close()
+            self.parent_sock = None
+
+
+hub = MemoryHub()
+os.register_at_fork(after_in_child=hub.after_fork_in_child)
+
+
+class Broker:
+    def __init__(
+        self,
+        channels: Union[tuple, list] = (),
+        default_publish_channel: Optional[str] = None,
+        cross_process: bool = False,
+    ) -> None:
+        """
+        channels - listening channels for the service and used for control-and-reply
+        default_publish_channel - if not specified on task level or in the submission
+          by default messages will be sent to this channel.
+        cross_process - allow processes forked after this to publish to listeners in this process
+        """
+        self.channels = channels
+        self.default_publish_channel = default_publish_channel
+        self.cross_process = cross_process
+        if cross_process:
+            hub.enable_cross_process()
+
+    def get_publish_channel(self, channel: Optional[str] = None) -> str:
+        "Handle default for the publishing channel for calls to publish_message, shared sync and async"
+        if channel is not None:
+            return channel
+        elif self.default_publish_channel is not None:
+            return self.default_publish_channel
+        elif len(self.channels) == 1:
+            return self.channels[0]
+
+        raise ValueError('Could not determine a channel to use publish to from settings or memory broker config')
+
+    # --- asyncio methods ---
+
+    async def aprocess_notify(
+        self, connected_callback: Optional[Callable[[], Coroutine[Any, Any, None]]] = None
+    ) -> AsyncGenerator[tuple[str, str], None]:  # public
+        loop = asyncio.get_running_loop()
+        subscriber = AsyncSubscriber(loop)
+        hub.subscribe(self.channels, subscriber)
+        hub.add_loop_reader(loop)
+        try:
+            logger.info(f'Set up memory broker listening on channels {list(self.channels)}')
+            if connected_callback:
+                await connected_callback()
+            while True:
+                yield await subscriber.queue.get()
+        finally:
+            hub.remove_loop_reader(loop)
+            hub.unsubscribe(self.channels, subscriber)
+
+    async def apublish_message(self, channel: Optional[str] = None, message: str = '') -> None:  # public
+        hub.publish(self.get_publish_channel(channel), message)
+
+    async def apublish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None:  # public
+        self.publish_many(messages)
+
+    async def aclose(self) -> None:
+        pass  # listeners unsubscribe when their generator exits
+
+    def abandon_async_connections(self) -> bool:
+        return True  # no connections
+
+    # --- synchronous methods ---
+
+    def process_notify(self, connected_callback: Optional[Callable] = None, timeout: float = 5.0, max_messages: int = 1) -> Iterator[tuple[str, str]]:
+        """Blocking method that listens for messages on the channels until timeout or max_messages are received"""
+        subscriber = SyncSubscriber()
+        hub.subscribe(self.channels, subscriber)
+        try:
+            if connected_callback:
+                connected_callback()
+            deadline = time.monotonic() + timeout
+            received = 0
+            while received < max_messages:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    item = subscriber.queue.get(timeout=remaining)
+                except queue.Empty:
+                    return
+                received += 1
+                yield item
+        finally:
+            hub.unsubscribe(self.channels, subscriber)
+
+    def publish_message(self, channel: Optional[str] = None, message: str = '') -> None:
+        hub.publish(self.get_publish_channel(channel), message)
+
+    def publish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None:
+        for channel, message in messages:
+            hub.publish(self.get_publish_channel(channel), message)
+
+    def close(self) -> None:
+        pass
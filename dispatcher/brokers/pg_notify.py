@@ -1,5 +1,11 @@
+import asyncio
+import json
 import logging
-from typing import Any, AsyncGenerator, Callable, Coroutine, Iterator, Optional, Union
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, AsyncGenerator, Callable, Coroutine, Iterable, Iterator, Optional, Union
 
 import psycopg
 
@@ -31,8 +37,75 @@ def create_connection(**config) -> psycopg.Connection:
     return connection
 
 
+class SyncConnectionPool:
+    """Thread-safe pool of synchronous connections, so threads of a web server can publish at the same time
+
+    Connections are created on demand, up to max_size, and a thread waits for one to be returned after that.
+    Connections inherited over fork are left open and never used, because the parent process still owns them.
+    """
+
+    def __init__(self, connect: Callable[[], psycopg.Connection], max_size: int, timeout: float = 30.0) -> None:
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self._inherited: list[psycopg.Connection] = []  # references kept so they are not finalized in the child
+        self.reset()
+
+    def reset(self) -> None:
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.max_size)
+        self.idle: list[psycopg.Connection] = []
+        self.all_connections: list[psycopg.Connection] = []
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg.Connection]:
+        if self.pid != os.getpid():
+            self._inherited.extend(self.all_connections)
+            self.reset()
+
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f'No pg_notify publishing connection was free within {self.timeout} seconds')
+        try:
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+                if connection is not None and connection.closed:
+                    self.all_connections.remove(connection)  # lost while idle, replace it
+                    connection = None
+            if connection is None:
+                connection = self.connect()
+                with self.lock:
+                    self.all_connections.append(connection)
+            try:
+                yield connection
+            finally:
+                with self.lock:
+                    if connection.closed:
+                        self.all_connections.remove(connection)
+                    else:
+                        self.idle.append(connection)
+        finally:
+            self.slots.release()
+
+    def close(self) -> None:
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+                self.all_connections.remove(connection)
+            self.idle = []
+
+
 class Broker:
-    NOTIFY_QUERY_TEMPLATE = 'SELECT pg_notify(%s, %s);'
+    # Subclasses may replace these with composed SQL taking the same parameters
+    NOTIFY_QUERY_TEMPLATE: Union[str, psycopg.sql.Composed] = 'SELECT pg_notify(%s, %s);'
+    # Sends every pair from the two arrays, in one statement and so one transaction
+    NOTIFY_MANY_QUERY_TEMPLATE: Union[str, psycopg.sql.Composed] = (
+        'SELECT pg_notify(c, m) FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS t(c, m, n) ORDER BY n;'
+    )
+    PUBLISH_MANY_BATCH_SIZE = 1000
+    CLAIM_CLEANUP_INTERVAL = 60.0  # seconds between deleting expired rows from the claim_table
 
     def __init__(
         self,
@@ -43,6 +116,11 @@ class Broker:
         async_connection: Optional[psycopg.AsyncConnection] = None,
         channels: Union[tuple, list] = (),
         default_publish_channel: Optional[str] = None,
+        publish_pool_size: int = 0,
+        separate_publish_connection: bool = False,
+        claim_table: Optional[str] = None,
+        claim_batch_size: int = 100,
+        claim_retention: float = 86400.0,
     ) -> None:
         """
         config - kwargs to psycopg connect classes, if creating connection this way
@@ -55,6 +133,14 @@ class Broker:
         default_publish_channel - if not specified on task level or in the submission
           by default messages will be sent to this channel.
           this should be one of the listening channels for messages to be received.
+        publish_pool_size - if above 0, synchronous publishing uses a pool of up to this many connections
+          made from config, instead of sharing one connection between threads
+        separate_publish_connection - use a second async connection, made from config, for publishing
+          so that replies go out right away and listening never has to stop to send them
+        claim_table - if given, nodes listening on the same channel claim each task by its uuid in this table
+          before it is given to the service, so only one node runs it, created if it does not exist
+        claim_batch_size - most notifications claimed with one query
+        claim_retention - seconds to keep claims, must be longer than any publisher could send the same message again
         """
         if not (config or async_connection_factory or async_connection):
             raise RuntimeError('Must specify either config or async_connection_factory')
@@ -64,6 +150,7 @@ class Broker:
 
         self._async_connection_factory = async_connection_factory
         self._async_connection = async_connection
+        self._async_connection_owned = False  # made from config, not given or from the factory
 
         self._sync_connection_factory = sync_connection_factory
         self._sync_connection = sync_connection
@@ -76,6 +163,24 @@ class Broker:
         self.channels = channels
         self.default_publish_channel = default_publish_channel
 
+        self._publish_pool: Optional[SyncConnectionPool] = None
+        if publish_pool_size > 0:
+            if not self._config:
+                raise RuntimeError('A publish_pool_size requires config to create connections with')
+            self._publish_pool = SyncConnectionPool(lambda: create_connection(**self._config), max_size=publish_pool_size)
+
+        self.separate_publish_connection = separate_publish_connection
+        if separate_publish_connection and not self._config:
+            raise RuntimeError('A separate_publish_connection requires config to create the connection with')
+        self._async_publish_connection: Optional[psycopg.AsyncConnection] = None
+        self._publish_pending: list[tuple[str, str, asyncio.Future]] = []
+        self._publish_task: Optional[asyncio.Task] = None
+
+        self.claim_table = claim_table
+        self.claim_batch_size = claim_batch_size
+        self.claim_retention = claim_retention
+        self._next_claim_cleanup = 0.0
+
         # If we are in the notification loop (receiving messages),
         # then we have to break out before sending messages
         # These variables track things so that we can exit, send, and re-enter
@@ -94,6 +199,23 @@ class Broker:
 
         raise ValueError('Could not determine a channel to use publish to from settings or PGNotify config')
 
+    def get_publish_batches(self, messages: Iterable[tuple[Optional[str], str]]) -> Iterator[tuple[list[str], list[str]]]:
+        """Split messages into parameters for NOTIFY_MANY_QUERY_TEMPLATE, with channel defaults applied
+
+        Postgres drops notifications with the same channel and payload as another in the same transaction,
+        messages from tasks are always unique because of their uuid.
+        """
+        channels: list[str] = []
+        payloads: list[str] = []
+        for channel, message in messages:
+            channels.append(self.get_publish_channel(channel))
+            payloads.append(message)
+            if len(channels) >= self.PUBLISH_MANY_BATCH_SIZE:
+                yield channels, payloads
+                channels, payloads = [], []
+        if channels:
+            yield channels, payloads
+
     # --- asyncio connection methods ---
 
     async def aget_connection(self) -> psycopg.AsyncConnection:
@@ -106,12 +228,57 @@ class Broker:
                 connection = await factory(**self._config)
             elif self._config:
                 connection = await acreate_connection(**self._config)
+                self._async_connection_owned = True
             else:
                 raise RuntimeError('Could not construct async connection for lack of config or factory')
             self._async_connection = connection
             return connection  # slightly weird due to MyPY
         return self._async_connection
 
+    async def aget_publish_connection(self) -> psycopg.AsyncConnection:
+        "Connection used only for publishing, if separate_publish_connection is set"
+        if not self._async_publish_connection:
+            self._async_publish_connection = await acreate_connection(**self._config)
+        return self._async_publish_connection
+
+    async def asend_publish_pending(self) -> None:
+        """Sends everything queued for the publish connection, pipelined so messages do not wait on each other's results
+
+        Each message is still its own statement, so Postgres will not drop duplicates like it would in one transaction.
+        """
+        try:
+            while self._publish_pending:
+                batch, self._publish_pending = self._publish_pending, []
+                try:
+                    connection = await self.aget_publish_connection()
+                    async with connection.pipeline() if psycopg.Pipeline.is_supported() else nullcontext():
+                        async with connection.cursor() as cur:
+                            for channel, message, _ in batch:
+                                await cur.execute(self.get_notify_query(channel, message), (channel, message))
+                except Exception as exc:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(exc)
+                else:
+                    logger.debug(f'Sent {len(batch)} pg_notify messages on the publish connection')
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self._publish_task = None
+
+    def get_notify_query(self, channel: str, message: str) -> Union[str, psycopg.sql.Composed]:
+        "Query to publish one message with, taking the channel and message as parameters"
+        return self.NOTIFY_QUERY_TEMPLATE
+
+    async def apublish_on_publish_connection(self, channel: str, message: str) -> None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._publish_pending.append((channel, message, future))
+        if self._publish_task is None:
+            self._publish_task = loop.create_task(self.asend_publish_pending(), name='pg_notify_publish')
+        await future
+
     def get_listen_query(self, channel: str) -> psycopg.sql.Composed:
         """Returns SQL command for listening on pg_notify channel
 
@@ -132,21 +299,94 @@ class Broker:
             if connected_callback:
                 await connected_callback()
 
+            if self.claim_table:
+                try:
+                    await cur.execute(self.get_claim_table_query())
+                except (psycopg.errors.UniqueViolation, psycopg.errors.DuplicateTable):
+                    pass  # another node created it at the same time
+
             while True:
                 logger.debug('Starting listening for pg_notify notifications')
-                self.notify_loop_active = True
-                async for notify in connection.notifies():
-                    yield notify.channel, notify.payload
-                    if self.notify_queue:
-                        break
-                self.notify_loop_active = False
+                if self.claim_table:
+                    for channel, payload in await self.aclaim_next_batch(connection, cur):
+                        yield channel, payload
+                else:
+                    self.notify_loop_active = True
+                    async for notify in connection.notifies():
+                        yield notify.channel, notify.payload
+                        if self.notify_queue:
+                            break
+                    self.notify_loop_active = False
                 for reply_to, reply_message in self.notify_queue:
                     await self.apublish_message_from_cursor(cur, channel=reply_to, message=reply_message)
                 self.notify_queue = []
 
+    # --- claiming, for several nodes sharing a channel ---
+
+    def get_claim_table_id(self) -> psycopg.sql.Identifier:
+        assert self.claim_table, 'Only used in claim mode'
+        return psycopg.sql.Identifier(self.claim_table)
+
+    def get_claim_table_query(self) -> psycopg.sql.Composed:
+        return psycopg.sql.SQL('CREATE TABLE IF NOT EXISTS {} (uuid text PRIMARY KEY, claimed timestamptz NOT NULL DEFAULT now());').format(
+            self.get_claim_table_id()
+        )
+
+    def get_claim_query(self) -> psycopg.sql.Composed:
+        "Inserts the given uuids, returning only those no other node inserted first"
+        return psycopg.sql.SQL('INSERT INTO {} (uuid) SELECT unnest(%s::text[]) ON CONFLICT DO NOTHING RETURNING uuid;').format(self.get_claim_table_id())
+
+    def get_claim_cleanup_query(self) -> psycopg.sql.Composed:
+        return psycopg.sql.SQL('DELETE FROM {} WHERE claimed < now() - make_interval(secs => %s);').format(self.get_claim_table_id())
+
+    @staticmethod
+    def get_claim_uuid(payload: str) -> Optional[str]:
+        "Tasks are claimed by uuid, anything else, like control messages, goes to every node"
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return None
+        if isinstance(message, dict) and 'task' in message and 'uuid' in message:
+            # a task moved on from the node that claimed it is claimed again, under the number of times it moved
+            moves = len(message.get('rebalanced', ())) + message.get('handoffs', 0)
+            return f'{message["uuid"]}:{moves}' if moves else str(message['uuid'])
+        return None
+
+    async def aclaim_next_batch(self, connection: psycopg.AsyncConnection, cur: psycopg.AsyncCursor) -> list[tuple[str, str]]:
+        """Wait for notifications, and return those this node should process, with one claim query for the whole batch
+
+        The batch is the first notification plus anything else that already arrived, so claiming does not add a wait.
+        """
+        self.notify_loop_active = True
+        notifications = [notify async for notify in connection.notifies(stop_after=1)]
+        notifications.extend([notify async for notify in connection.notifies(timeout=0, stop_after=self.claim_batch_size - 1)])
+        self.notify_loop_active = False
+
+        uuids = [self.get_claim_uuid(notify.payload) for notify in notifications]
+        to_claim = list({uuid for uuid in uuids if uuid is not None})
+        won: set[str] = set()
+        if to_claim:
+            await cur.execute(self.get_claim_query(), (to_claim,))
+            won = {uuid.decode() if isinstance(uuid, bytes) else uuid for uuid, in await cur.fetchall()}
+            logger.debug(f'Claimed {len(won)} of {len(to_claim)} tasks received on pg_notify')
+
+        if time.monotonic() > self._next_claim_cleanup:
+            await cur.execute(self.get_claim_cleanup_query(), (self.claim_retention,))
+            self._next_claim_cleanup = time.monotonic() + self.CLAIM_CLEANUP_INTERVAL
+
+        ret = []
+        for notify, uuid in zip(notifications, uuids):
+            if uuid is None:
+                ret.append((notify.channel, notify.payload))
+            elif uuid in won:
+                won.remove(uuid)  # the same message twice in one batch still runs once
+                ret.append((notify.channel, notify.payload))
+        return ret
+
     async def apublish_message_from_cursor(self, cursor: psycopg.AsyncCursor, channel: Optional[str] = None, message: str = '') -> None:
         """The inner logic of async message publishing where we already have a cursor"""
-        await cursor.execute(self.NOTIFY_QUERY_TEMPLATE, (channel, message))
+        channel = self.get_publish_channel(channel)
+        await cursor.execute(self.get_notify_query(channel, message), (channel, message))
 
     async def apublish_message(self, channel: Optional[str] = None, message: str = '') -> None:  # public
         """asyncio way to publish a message, used to send control in control-and-reply
@@ -154,6 +394,10 @@ class Broker:
         Not strictly necessary for the service itself if it sends replies in the workers,
         but this may change in the future.
         """
+        if self.separate_publish_connection:
+            await self.apublish_on_publish_connection(self.get_publish_channel(channel), message)
+            return
+
         if self.notify_loop_active:
             self.notify_queue.append((channel, message))
             return
@@ -166,20 +410,58 @@ class Broker:
 
         logger.debug(f'Sent pg_notify message of {len(message)} chars to {channel}')
 
+    async def apublish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None:  # public
+        """Publish many (channel, message) pairs, with one round trip for every PUBLISH_MANY_BATCH_SIZE messages"""
+        if self.separate_publish_connection:
+            connection = await self.aget_publish_connection()
+        elif self.notify_loop_active:
+            self.notify_queue.extend((self.get_publish_channel(channel), message) for channel, message in messages)
+            return
+        else:
+            connection = await self.aget_connection()
+
+        async with connection.cursor() as cur:
+            for channels, payloads in self.get_publish_batches(messages):
+                await cur.execute(self.NOTIFY_MANY_QUERY_TEMPLATE, (channels, payloads))
+                logger.debug(f'Sent {len(payloads)} pg_notify messages in one statement')
+
     async def aclose(self) -> None:
         if self._async_connection:
             await self._async_connection.close()
             self._async_connection = None
+        if self._publish_task:
+            await self._publish_task  # messages already queued are still sent
+        if self._async_publish_connection:
+            await self._async_publish_connection.close()
+            self._async_publish_connection = None
+
+    def abandon_async_connections(self) -> bool:
+        """Close the connections of the async methods without awaiting, once the event loop they were used in has closed
+
+        Closing a postgres connection needs no event loop, so this never leaves one open.
+        A connection given to the broker, or from async_connection_factory, belongs to the caller, so it is only dropped.
+        """
+        if self._async_connection is not None:
+            if self._async_connection_owned:
+                self._async_connection.pgconn.finish()
+            self._async_connection = None
+            self._async_connection_owned = False
+        if self._async_publish_connection is not None:
+            self._async_publish_connection.pgconn.finish()
+            self._async_publish_connection = None
+        self._publish_pending = []
+        self._publish_task = None
+        return True
 
     # --- synchronous connection methods ---
 
     def get_connection(self) -> psycopg.Connection:
+        if self._sync_connection and self._sync_connection.closed and (self._sync_connection_factory or self._config):
+            # this broker may be cached and outlive the connection, as when an application closes its connections
+            self._sync_connection = None
         if not self._sync_connection:
             if self._sync_connection_factory:
-                factory = resolve_callable(self._sync_connection_factory)
-                if not factory:
-                    raise RuntimeError(f'Could not import connection factory {self._sync_connection_factory}')
-                connection = factory(**self._config)
+                connection = self.get_factory_connection()
             elif self._config:
                 connection = create_connection(**self._config)
             else:
@@ -188,6 +470,13 @@ class Broker:
             return connection
         return self._sync_connection
 
+    def get_factory_connection(self) -> psycopg.Connection:
+        "Connection from the application, which decides if it is reused, as with a connection for every thread"
+        factory = resolve_callable(self._sync_connection_factory) if self._sync_connection_factory else None
+        if not factory:
+            raise RuntimeError(f'Could not import connection factory {self._sync_connection_factory}')
+        return factory(**self._config)
+
     def process_notify(self, connected_callback: Optional[Callable] = None, timeout: float = 5.0, max_messages: int = 1) -> Iterator[tuple[str, str]]:
         """Blocking method that listens for messages on subscribed pg_notify channels until timeout
 
@@ -209,19 +498,104 @@ class Broker:
             for notify in connection.notifies(timeout=timeout, stop_after=max_messages):
                 yield (notify.channel, notify.payload)
 
+    @contextmanager
+    def publish_connection(self) -> Iterator[psycopg.Connection]:
+        """Connection for synchronous publishing, from the pool if there is one
+
+        A connection factory is called for every publish and its connection is not kept,
+        because this broker may be shared by threads, and the factory may give each thread its own connection.
+        Only a connection made from config is kept and shared.
+        """
+        if self._publish_pool:
+            with self._publish_pool.connection() as connection:
+                yield connection
+        elif self._sync_connection_factory:
+            yield self.get_factory_connection()
+        else:
+            yield self.get_connection()
+
     def publish_message(self, channel: Optional[str] = None, message: str = '') -> None:
-        connection = self.get_connection()
         channel = self.get_publish_channel(channel)
 
-        with connection.cursor() as cur:
-            cur.execute(self.NOTIFY_QUERY_TEMPLATE, (channel, message))
+        with self.publish_connection() as connection, connection.cursor() as cur:
+            cur.execute(self.get_notify_query(channel, message), (channel, message))
 
         logger.debug(f'Sent pg_notify message of {len(message)} chars to {channel}')
 
+    def publish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None:
+        """Publish many (channel, message) pairs, with one round trip for every PUBLISH_MANY_BATCH_SIZE messages"""
+        with self.publish_connection() as connection, connection.cursor() as cur:
+            for channels, payloads in self.get_publish_batches(messages):
+                cur.execute(self.NOTIFY_MANY_QUERY_TEMPLATE, (channels, payloads))
+                logger.debug(f'Sent {len(payloads)} pg_notify messages in one statement')
+
     def close(self) -> None:
         if self._sync_connection:
             self._sync_connection.close()
             self._sync_connection = None
+        if self._publish_pool:
+            self._publish_pool.close()
+
+
+class LeaseTable:
+    """Leases on task fingerprints in a table, used to apply on_duplicate rules across nodes
+
+    A lease is taken if nobody has it, if it expired, or if the same node has it already.
+    """
+
+    def __init__(self, config: dict, table: str = 'dispatcher_leases') -> None:
+        if not config:
+            raise RuntimeError('Cluster leases need config to connect to postgres with')
+        self._config = config.copy()
+        self.table = table
+        self._connection: Optional[psycopg.AsyncConnection] = None
+
+        table_id = psycopg.sql.Identifier(table)
+        self.CREATE_TABLE_QUERY = psycopg.sql.SQL(
+            'CREATE TABLE IF NOT EXISTS {} (fingerprint text PRIMARY KEY, node_id text NOT NULL, uuid text, expires timestamptz NOT NULL);'
+        ).format(table_id)
+        self.ACQUIRE_QUERY = psycopg.sql.SQL(
+            'INSERT INTO {table} AS l (fingerprint, node_id, uuid, expires) VALUES (%s, %s, %s, now() + make_interval(secs => %s)) '
+            'ON CONFLICT (fingerprint) DO UPDATE SET node_id = EXCLUDED.node_id, uuid = EXCLUDED.uuid, expires = EXCLUDED.expires '
+            'WHERE l.expires < now() OR l.node_id = EXCLUDED.node_id RETURNING fingerprint;'
+        ).format(table=table_id)
+        self.RENEW_QUERY = psycopg.sql.SQL('UPDATE {} SET expires = now() + make_interval(secs => %s) WHERE node_id = %s AND fingerprint = ANY(%s);').format(
+            table_id
+        )
+        self.RELEASE_QUERY = psycopg.sql.SQL('DELETE FROM {} WHERE node_id = %s AND fingerprint = ANY(%s);').format(table_id)
+
+    async def aget_connection(self) -> psycopg.AsyncConnection:
+        if self._connection and self._connection.closed:
+            self._connection = None  # lost, as when postgres restarted, connect again
+        if not self._connection:
+            connection = await acreate_connection(**self._config)
+            try:
+                await connection.execute(self.CREATE_TABLE_QUERY)
+            except (psycopg.errors.UniqueViolation, psycopg.errors.DuplicateTable):
+                pass  # another node created it at the same time
+            self._connection = connection
+            return connection
+        return self._connection
+
+    async def acquire(self, fingerprint: str, node_id: str, uuid: str, ttl: float) -> bool:
+        connection = await self.aget_connection()
+        async with connection.cursor() as cur:
+            await cur.execute(self.ACQUIRE_QUERY, (fingerprint, node_id, uuid, ttl))
+            return bool(await cur.fetchone())
+
+    async def renew(self, fingerprints: list[str], node_id: str, ttl: float) -> None:
+        connection = await self.aget_connection()
+        await connection.execute(self.RENEW_QUERY, (ttl, node_id, fingerprints))
+
+    async def release(self, fingerprints: list[str], node_id: str) -> None:
+        connection = await self.aget_connection()
+        await connection.execute(self.RELEASE_QUERY, (node_id, fingerprints))
+        logger.debug(f'Released {len(fingerprints)} task leases from {self.table}')
+
+    async def aclose(self) -> None:
+        if self._connection:
+            await self._connection.close()
+            self._connection = None
 
 
 class ConnectionSaver:
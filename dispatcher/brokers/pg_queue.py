@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import socket
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncGenerator, Callable, Coroutine, Iterable, Iterator, Optional, Union
+
+import psycopg
+from psycopg import sql
+
+from dispatcher.brokers import pg_notify
+
+logger = logging.getLogger(__name__)
+
+
+"""Postgres table queue broker, messages are rows in a table and NOTIFY is only a hint to check it
+
+Unlike pg_notify, messages published while no service is listening wait in the table,
+and each message goes to only one listener, so several nodes can share a channel.
+Listeners claim batches of rows with SELECT ... FOR UPDATE SKIP LOCKED, so they never wait on each other.
+A claim lasts visibility_timeout seconds, if the node dies before it has taken the whole batch
+the rows can be claimed again by another node after that, so a message may be taken twice.
+Rows are deleted in bulk once the service has taken every message of the batch, not once the tasks ran,
+so tasks the service has taken but not finished are lost if it crashes or is killed.
+
+Control commands and heartbeats are meant for every node, and replies for a client that only listens
+while it waits, so these are not put in the table. They are sent with NOTIFY, with the message as payload
+like pg_notify does, and listeners take a NOTIFY with a payload as the message itself.
+The connection options are the same as pg_notify.
+Channels with nothing consuming them keep their rows until cleared out.
+"""
+
+REPLY_CHANNEL_PREFIX = 'reply_to_'  # of the channels made by Control.generate_reply_queue_name
+BROADCAST_KEYS = ('control', 'heartbeat')
+
+
+def is_broadcast(channel: str, message: str) -> bool:
+    "True for control commands, their replies, and heartbeats, which are sent with NOTIFY instead of the table"
+    if channel.startswith(REPLY_CHANNEL_PREFIX):
+        return True
+    if not any(f'"{key}"' in message for key in BROADCAST_KEYS):
+        return False  # so task messages are not parsed
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return False
+    return isinstance(data, dict) and any(key in data for key in BROADCAST_KEYS)
+
+
+class Broker(pg_notify.Broker):
+    def __init__(
+        self,
+        table: str = 'dispatcher_queue',
+        batch_size: int = 100,
+        visibility_timeout: float = 300.0,
+        poll_interval: float = 5.0,
+        **kwargs,
+    ) -> None:
+        """
+        table - name of the table holding messages, created if it does not exist
+        batch_size - most messages claimed with one query
+        visibility_timeout - seconds before claimed messages not yet done can be claimed by another listener
+        poll_interval - seconds between checks of the table without a NOTIFY, which picks up expired claims
+        other options are the same as the pg_notify broker
+        """
+        super().__init__(**kwargs)
+        self.table = table
+        self.batch_size = batch_size
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.claimed_by = f'{socket.gethostname()}-{os.getpid()}'
+        self._table_ready = False
+
+        table_id = sql.Identifier(table)
+        self.CREATE_TABLE_QUERY = sql.SQL(
+            'CREATE TABLE IF NOT EXISTS {} ('
+            'id bigserial PRIMARY KEY, channel text NOT NULL, message text NOT NULL, '
+            'created timestamptz NOT NULL DEFAULT now(), claimed_until timestamptz, claimed_by text);'
+        ).format(table_id)
+        self.CREATE_INDEX_QUERY = sql.SQL('CREATE INDEX IF NOT EXISTS {} ON {} (channel, id);').format(sql.Identifier(f'{table}_channel_id'), table_id)
+        # The publishing templates of pg_notify take the same parameters, so all the publish methods are inherited
+        self.NOTIFY_QUERY_TEMPLATE = sql.SQL(
+            'WITH ins AS (INSERT INTO {} (channel, message) VALUES (%s, %s) RETURNING channel) SELECT pg_notify(channel, {}) FROM ins;'
+        ).format(table_id, sql.Literal(''))
+        self.NOTIFY_MANY_QUERY_TEMPLATE = sql.SQL(
+            'WITH ins AS (INSERT INTO {} (channel, message) SELECT c, m FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS t(c, m, n) ORDER BY n '
+            'RETURNING channel) SELECT pg_notify(channel, {}) FROM (SELECT DISTINCT channel FROM ins) AS d;'
+        ).format(table_id, sql.Literal(''))
+        self.CLAIM_QUERY = sql.SQL(
+            'WITH claimable AS ('
+            'SELECT id FROM {table} WHERE channel = ANY(%s) AND (claimed_until IS NULL OR claimed_until < now()) '
+            'ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) '
+            'UPDATE {table} AS q SET claimed_until = now() + make_interval(secs => %s), claimed_by = %s '
+            'FROM claimable WHERE q.id = claimable.id RETURNING q.id, q.channel, q.message;'
+        ).format(table=table_id)
+        self.DELETE_QUERY = sql.SQL('DELETE FROM {} WHERE id = ANY(%s);').format(table_id)
+
+    def __str__(self) -> str:
+        return f'pg_queue:{self.table}'
+
+    def get_notify_query(self, channel: str, message: str) -> Union[str, sql.Composed]:
+        if is_broadcast(channel, message):
+            return pg_notify.Broker.NOTIFY_QUERY_TEMPLATE
+        return self.NOTIFY_QUERY_TEMPLATE
+
+    def split_broadcast(self, messages: Iterable[tuple[Optional[str], str]]) -> tuple[list[tuple[str, str]], list[tuple[Optional[str], str]]]:
+        broadcast: list[tuple[str, str]] = []
+        queued: list[tuple[Optional[str], str]] = []
+        for channel, message in messages:
+            resolved = self.get_publish_channel(channel)
+            if is_broadcast(resolved, message):
+                broadcast.append((resolved, message))
+            else:
+                queued.append((resolved, message))
+        return broadcast, queued
+
+    async def apublish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None:  # public
+        broadcast, queued = self.split_broadcast(messages)
+        for channel, message in broadcast:
+            await self.apublish_message(channel=channel, message=message)
+        if queued:
+            await super().apublish_many(queued)
+
+    def publish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None:
+        broadcast, queued = self.split_broadcast(messages)
+        for channel, message in broadcast:
+            self.publish_message(channel=channel, message=message)
+        if queued:
+            super().publish_many(queued)
+
+    def get_claim_params(self, limit: int) -> tuple:
+        return (list(self.channels), limit, self.visibility_timeout, self.claimed_by)
+
+    @staticmethod
+    def sort_claimed(rows: list) -> list[tuple[int, str, str]]:
+        "Put claimed rows in the order they were published, text comes back as bytes from a SQL_ASCII database"
+        return [
+            (row_id, channel.decode() if isinstance(channel, bytes) else channel, message.decode() if isinstance(message, bytes) else message)
+            for row_id, channel, message in sorted(rows)
+        ]
+
+    # --- table setup, done once by the first connection this broker uses ---
+
+    async def aensure_table(self, connection: psycopg.AsyncConnection) -> None:
+        if self._table_ready:
+            return
+        try:
+            async with connection.cursor() as cur:
+                await cur.execute(self.CREATE_TABLE_QUERY)
+                await cur.execute(self.CREATE_INDEX_QUERY)
+        except (psycopg.errors.UniqueViolation, psycopg.errors.DuplicateTable):
+            pass  # another process created it at the same time
+        self._table_ready = True
+
+    def ensure_table(self, connection: psycopg.Connection) -> None:
+        if self._table_ready:
+            return
+        try:
+            with connection.cursor() as cur:
+                cur.execute(self.CREATE_TABLE_QUERY)
+                cur.execute(self.CREATE_INDEX_QUERY)
+        except (psycopg.errors.UniqueViolation, psycopg.errors.DuplicateTable):
+            pass
+        self._table_ready = True
+
+    async def aget_connection(self) -> psycopg.AsyncConnection:
+        connection = await super().aget_connection()
+        await self.aensure_table(connection)
+        return connection
+
+    async def aget_publish_connection(self) -> psycopg.AsyncConnection:
+        connection = await super().aget_publish_connection()
+        await self.aensure_table(connection)
+        return connection
+
+    def get_connection(self) -> psycopg.Connection:
+        connection = super().get_connection()
+        self.ensure_table(connection)
+        return connection
+
+    @contextmanager
+    def publish_connection(self) -> Iterator[psycopg.Connection]:
+        with super().publish_connection() as connection:
+            self.ensure_table(connection)
+            yield connection
+
+    # --- consuming messages ---
+
+    async def aprocess_notify(
+        self, connected_callback: Optional[Callable[[], Coroutine[Any, Any, None]]] = None
+    ) -> AsyncGenerator[tuple[str, str], None]:  # public
+        connection = await self.aget_connection()
+        async with connection.cursor() as cur:
+            for channel in self.channels:
+                await cur.execute(self.get_listen_query(channel))
+                logger.info(f"Set up pg_queue listening on channel '{channel}' of table {self.table}")
+
+            if connected_callback:
+                await connected_callback()
+
+            while True:
+                await cur.execute(self.CLAIM_QUERY, self.get_claim_params(self.batch_size))
+                rows = self.sort_claimed(await cur.fetchall())
+                done_ids = []
+                for row_id, channel, message in rows:
+                    yield channel, message
+                    done_ids.append(row_id)
+                if done_ids:
+                    await cur.execute(self.DELETE_QUERY, (done_ids,))
+                    logger.debug(f'Deleted {len(done_ids)} finished messages from {self.table}')
+
+                if len(rows) >= self.batch_size:
+                    continue  # there may be more waiting already
+
+                self.notify_loop_active = True
+                broadcast = []
+                async for notify in connection.notifies(timeout=self.poll_interval, stop_after=1):
+                    if notify.payload:
+                        broadcast.append((notify.channel, notify.payload))
+                self.notify_loop_active = False
+                for item in broadcast:
+                    yield item
+                for reply_to, reply_message in self.notify_queue:
+                    await self.apublish_message_from_cursor(cur, channel=self.get_publish_channel(reply_to), message=reply_message)
+                self.notify_queue = []
+
+    def process_notify(self, connected_callback: Optional[Callable] = None, timeout: float = 5.0, max_messages: int = 1) -> Iterator[tuple[str, str]]:
+        """Blocking method that claims messages from the table until timeout or max_messages are received
+
+        Rows are deleted as soon as they are claimed. Messages sent with NOTIFY, like replies in control-and-reply,
+        are yielded as they come.
+        """
+        connection = self.get_connection()
+        deadline = time.monotonic() + timeout
+        received = 0
+
+        with connection.cursor() as cur:
+            for channel in self.channels:
+                cur.execute(self.get_listen_query(channel))
+
+            if connected_callback:
+                connected_callback()
+
+            while True:
+                cur.execute(self.CLAIM_QUERY, self.get_claim_params(max_messages - received))
+                rows = self.sort_claimed(cur.fetchall())
+                if rows:
+                    cur.execute(self.DELETE_QUERY, ([row_id for row_id, _, _ in rows],))
+                for _, channel, message in rows:
+                    received += 1
+                    yield (channel, message)
+                if received >= max_messages:
+                    return
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                for notify in connection.notifies(timeout=min(remaining, self.poll_interval), stop_after=1):
+                    if notify.payload and received < max_messages:
+                        received += 1
+                        yield (notify.channel, notify.payload)
+                if received >= max_messages:
+                    return
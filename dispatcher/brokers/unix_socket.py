@@ -0,0 +1,530 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Any, AsyncGenerator, Callable, Coroutine, Iterable, Iterator, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+"""Unix domain socket broker, for publishers on the same host as the service
+
+The service listens on a socket path, and everything else connects to it.
+Only a broker made with server=True, which the service does, binds the path.
+Other listeners, like the reply channel for control-and-reply, connect and subscribe to their channels,
+and their own messages and the replies go over that same connection.
+
+Messages are JSON frames with a 4 byte length prefix.
+Every frame from a client gets an ack frame with the same id, so clients can pipeline
+many frames without waiting for each ack in turn.
+"""
+
+FRAME_HEADER = struct.Struct('!I')
+
+
+class UnsentFrameError(ConnectionError):
+    "The connection was found broken when writing the frame, so the service did not get it and it can be sent again"
+
+
+def encode_frame(data: dict) -> bytes:
+    body = json.dumps(data).encode('utf-8')
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+async def aread_frame(reader: asyncio.StreamReader, max_frame_size: int) -> Optional[dict]:
+    "Returns the next frame, or None if the other side closed the connection"
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        (size,) = FRAME_HEADER.unpack(header)
+        if size > max_frame_size:
+            raise ValueError(f'Frame of {size} bytes exceeds max_frame_size={max_frame_size}')
+        return json.loads(await reader.readexactly(size))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks: list[bytes] = []
+    while size:
+        try:
+            chunk = sock.recv(size)
+        except socket.timeout:
+            if chunks:
+                raise ConnectionError('Timed out in the middle of a unix socket frame')  # the rest of the stream is out of step
+            raise
+        if not chunk:
+            raise ConnectionError('Dispatcher service closed the unix socket connection')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_frame(sock: socket.socket) -> dict:
+    (size,) = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+    try:
+        return json.loads(recv_exact(sock, size))
+    except socket.timeout:
+        raise ConnectionError('Timed out in the middle of a unix socket frame')
+
+
+class ClientConnection:
+    "Async connection to the listening service, acks resolve pending requests and other frames are queued as messages"
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_frame_size: int) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.max_frame_size = max_frame_size
+        self.next_id = 0
+        self.pending: dict[int, asyncio.Future] = {}
+        self.messages: asyncio.Queue[Optional[tuple[str, str]]] = asyncio.Queue()  # None means connection closed
+        self.read_task = asyncio.create_task(self.read_forever(), name='unix_socket_client_read')
+
+    async def read_forever(self) -> None:
+        try:
+            while (frame := await aread_frame(self.reader, self.max_frame_size)) is not None:
+                if frame['op'] == 'ack':
+                    future = self.pending.pop(frame['id'], None)
+                    if future and not future.done():
+                        future.set_result(None)
+                elif frame['op'] == 'msg':
+                    self.messages.put_nowait((frame['channel'], frame['message']))
+        except ConnectionError:
+            pass  # same as the service closing the connection
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Dispatcher service closed the unix socket connection'))
+            self.pending = {}
+            self.messages.put_nowait(None)
+
+    async def request(self, op: str, **data) -> None:
+        "Send a frame and wait for its ack, concurrent requests share the connection and are written together"
+        if self.read_task.done():
+            raise ConnectionError('Dispatcher service closed the unix socket connection')
+        frame_id = self.next_id
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[frame_id] = future
+        self.writer.write(encode_frame(dict(op=op, id=frame_id, **data)))
+        try:
+            if self.writer.is_closing():
+                raise UnsentFrameError('Dispatcher service closed the unix socket connection')  # the write failed right away
+            await self.writer.drain()
+        except ConnectionError:
+            self.discard(frame_id)
+            raise
+        await future
+
+    def discard(self, frame_id: int) -> None:
+        future = self.pending.pop(frame_id, None)
+        if future is None:
+            return
+        if future.done():
+            future.exception()  # set when the connection closed, the caller gets the error raised instead
+        else:
+            future.cancel()
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        self.read_task.cancel()
+        try:
+            await self.read_task
+        except asyncio.CancelledError:
+            pass
+
+
+class Broker:
+    def __init__(
+        self,
+        path: str = 'dispatcher.sock',
+        channels: Union[tuple, list] = (),
+        default_publish_channel: Optional[str] = None,
+        socket_mode: int = 0o600,
+        max_frame_size: int = 16 * 1024 * 1024,
+        max_unacked: int = 256,
+        max_write_buffer: int = 16 * 1024 * 1024,
+        server: bool = False,
+    ) -> None:
+        """
+        path - file path of the unix socket the service listens on
+        channels - listening channels for the service and used for control-and-reply
+        default_publish_channel - if not specified on task level or in the submission
+          by default messages will be sent to this channel.
+        socket_mode - file permissions of the socket, which decide who can submit tasks
+        max_frame_size - largest message frame accepted, in bytes
+        max_unacked - synchronous publishers wait for acks once this many frames are unacknowledged
+        max_write_buffer - bytes the service keeps for a subscribed connection that is not reading them,
+          beyond which that connection is dropped
+        server - listen by binding the socket path, set by the service, other listeners connect to it
+        """
+        self.path = path
+        self.channels = channels
+        self.default_publish_channel = default_publish_channel
+        self.socket_mode = socket_mode
+        self.max_frame_size = max_frame_size
+        self.max_unacked = max_unacked
+        self.max_write_buffer = max_write_buffer
+        self.server = server
+
+        # Listening side, if this broker bound the socket path
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._incoming: Optional[asyncio.Queue[tuple[str, str]]] = None
+        self._subscriptions: dict[str, set[asyncio.StreamWriter]] = {}
+        self._connections: set[asyncio.StreamWriter] = set()
+
+        # Connecting side
+        self._client: Optional[ClientConnection] = None
+        self._sock: Optional[socket.socket] = None
+        self._sock_pid: Optional[int] = None
+        self._next_id = 0
+        self._unacked = 0
+        self._held_messages: list[tuple[str, str]] = []  # read while waiting for acks, to give to process_notify
+        self._publish_lock = threading.Lock()  # frames and ack counts from threads sharing this broker must not interleave
+
+    def __str__(self) -> str:
+        return f'unix_socket:{self.path}'
+
+    def get_publish_channel(self, channel: Optional[str] = None) -> str:
+        "Handle default for the publishing channel for calls to publish_message, shared sync and async"
+        if channel is not None:
+            return channel
+        elif self.default_publish_channel is not None:
+            return self.default_publish_channel
+        elif len(self.channels) == 1:
+            return self.channels[0]
+
+        raise ValueError('Could not determine a channel to use publish to from settings or unix_socket config')
+
+    # --- listening side ---
+
+    def route(self, channel: str, message: str) -> None:
+        "Deliver a message to this listener, if it is for one of our channels, and to any connections subscribed to the channel"
+        delivered = False
+        if channel in self.channels and self._incoming is not None:
+            self._incoming.put_nowait((channel, message))
+            delivered = True
+        for writer in list(self._subscriptions.get(channel, ())):
+            buffered = writer.transport.get_write_buffer_size()
+            if buffered > self.max_write_buffer:
+                logger.error(f'Unix socket subscriber to {channel} is not reading its messages, {buffered} bytes are waiting, disconnecting it')
+                self.drop_subscriber(writer)
+                continue
+            writer.write(encode_frame({'op': 'msg', 'channel': channel, 'message': message}))
+            delivered = True
+        if not delivered:
+            logger.debug(f'No listeners for unix socket message to {channel}, dropping it')
+
+    def drop_subscriber(self, writer: asyncio.StreamWriter) -> None:
+        for channel, channel_writers in list(self._subscriptions.items()):
+            channel_writers.discard(writer)
+            if not channel_writers:
+                del self._subscriptions[channel]
+        writer.transport.abort()  # close would wait to send the buffer first, which this connection is not reading
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        subscribed: list[str] = []
+        self._connections.add(writer)
+        try:
+            while (frame := await aread_frame(reader, self.max_frame_size)) is not None:
+                if frame['op'] == 'pub':
+                    self.route(frame['channel'], frame['message'])
+                elif frame['op'] == 'sub':
+                    for channel in frame['channels']:
+                        self._subscriptions.setdefault(channel, set()).add(writer)
+                        subscribed.append(channel)
+                else:
+                    logger.warning(f'Unix socket client sent unknown frame op {frame["op"]}, ignoring')
+                writer.write(encode_frame({'op': 'ack', 'id': frame['id']}))
+                await writer.drain()  # only waits if the client is not reading its acks
+        except (ValueError, KeyError, ConnectionError) as exc:
+            logger.error(f'Closing unix socket client connection due to error: {exc}')
+        finally:
+            for channel in subscribed:
+                channel_writers = self._subscriptions.get(channel, set())
+                channel_writers.discard(writer)
+                if not channel_writers:
+                    self._subscriptions.pop(channel, None)
+            self._connections.discard(writer)
+            writer.close()
+
+    def bind_socket(self) -> socket.socket:
+        "Bind the path with socket_mode already applied, so no one else can connect in between"
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.path)  # nothing accepted a connection on it, so it is left over
+            else:
+                raise RuntimeError(f'Another service is already listening on unix socket {self.path}')
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o777 & ~self.socket_mode)
+        try:
+            sock.bind(self.path)
+        except OSError:
+            sock.close()
+            raise
+        finally:
+            os.umask(old_umask)
+        return sock
+
+    async def start_server(self) -> None:
+        sock = self.bind_socket()
+        self._incoming = asyncio.Queue()
+        self._server = await asyncio.start_unix_server(self.handle_connection, sock=sock)
+        logger.info(f'Listening on unix socket {self.path} for channels {list(self.channels)}')
+
+    async def stop_server(self) -> None:
+        if self._server:
+            self._server.close()
+            for writer in self._connections:
+                writer.close()
+            self._connections = set()
+            self._subscriptions = {}
+            await self._server.wait_closed()
+            self._server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    # --- asyncio methods ---
+
+    async def aget_client(self) -> ClientConnection:
+        "Connection to the service, a connection the service closed, as when it restarted, is replaced"
+        if self._client is not None and self._client.read_task.done():
+            await self.areset_client()
+        if self._client is None:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            self._client = ClientConnection(reader, writer, self.max_frame_size)
+        return self._client
+
+    async def areset_client(self) -> None:
+        if self._client:
+            client, self._client = self._client, None
+            await client.close()
+
+    async def arequest(self, op: str, **data) -> None:
+        """Request over the connection to the service, which is dropped if this fails
+
+        The request is sent again over a new connection only if it was never written, as when the service restarted.
+        Otherwise the service may or may not have gotten a frame that was never acknowledged, so this raises.
+        """
+        for attempt in range(2):
+            client = await self.aget_client()
+            try:
+                await client.request(op, **data)
+                return
+            except UnsentFrameError:
+                await self.areset_client()
+                if attempt:
+                    raise
+                logger.info(f'Unix socket connection to {self.path} was broken, reconnecting')
+            except (ConnectionError, OSError):
+                await self.areset_client()
+                raise
+
+    async def aprocess_notify(
+        self, connected_callback: Optional[Callable[[], Coroutine[Any, Any, None]]] = None
+    ) -> AsyncGenerator[tuple[str, str], None]:  # public
+        if self.server:
+            await self.start_server()
+            try:
+                if connected_callback:
+                    await connected_callback()
+                assert self._incoming is not None
+                while True:
+                    yield await self._incoming.get()
+            finally:
+                await self.stop_server()
+        else:
+            await self.arequest('sub', channels=list(self.channels))
+            client = await self.aget_client()
+            logger.info(f'Subscribed to channels {list(self.channels)} over unix socket {self.path}')
+            if connected_callback:
+                await connected_callback()
+            while (item := await client.messages.get()) is not None:
+                yield item
+            await self.areset_client()
+            raise ConnectionError(f'Dispatcher service closed unix socket {self.path}')
+
+    async def apublish_message(self, channel: Optional[str] = None, message: str = '') -> None:  # public
+        channel = self.get_publish_channel(channel)
+        if self._server:
+            self.route(channel, message)  # we are the listening service, probably sending a reply
+            return
+        await self.arequest('pub', channel=channel, message=message)
+        logger.debug(f'Sent unix socket message of {len(message)} chars to {channel}')
+
+    async def apublish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None:  # public
+        """All frames are written before waiting on any ack"""
+        resolved = [(self.get_publish_channel(channel), message) for channel, message in messages]
+        if self._server:
+            for channel, message in resolved:
+                self.route(channel, message)
+            return
+        await asyncio.gather(*[self.arequest('pub', channel=channel, message=message) for channel, message in resolved])
+        logger.debug(f'Sent {len(resolved)} unix socket messages')
+
+    async def aclose(self) -> None:
+        await self.areset_client()
+        await self.stop_server()
+
+    def abandon_async_connections(self) -> bool:
+        "Drop the client connection once its event loop has closed, returns False if it was open, since closing it needs the loop"
+        client, self._client = self._client, None
+        return client is None
+
+    # --- synchronous methods ---
+
+    def get_socket(self) -> socket.socket:
+        if self._sock is not None and self._sock_pid != os.getpid():
+            self._sock = None  # inherited over fork, the parent process still owns that connection
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self._sock = sock
+            self._sock_pid = os.getpid()
+            self._unacked = 0
+            self._held_messages = []
+        return self._sock
+
+    def reset_socket(self) -> int:
+        "Close the connection after an error, returns how many frames sent on it were never acknowledged"
+        lost = self._unacked
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._unacked = 0
+        self._held_messages = []
+        return lost
+
+    def send_frames(self, data: bytes, ct: int) -> None:
+        """Write ct frames, reconnecting once if the connection is broken, as when the service restarted
+
+        If frames sent earlier on the broken connection were never acknowledged, the service may not have gotten them,
+        so this raises instead of reconnecting, and the next publish connects again.
+        """
+        for attempt in range(2):
+            sock = self.get_socket()
+            try:
+                sock.sendall(data)
+                break
+            except OSError as exc:
+                lost = self.reset_socket()
+                if lost:
+                    raise ConnectionError(f'Lost unix socket connection to {self.path} with {lost} messages not acknowledged') from exc
+                if attempt:
+                    raise
+                logger.info(f'Unix socket connection to {self.path} was broken, reconnecting')
+        self._unacked += ct
+
+    def send_frame(self, op: str, **data) -> None:
+        self.send_frames(encode_frame(dict(op=op, id=self._next_id, **data)), 1)
+        self._next_id += 1
+
+    def read_sync_frame(self, sock: socket.socket) -> Optional[tuple[str, str]]:
+        "Read one frame, keeping count of acks, returns the message if it was one"
+        try:
+            frame = read_frame(sock)
+        except socket.timeout:
+            raise
+        except (OSError, ValueError) as exc:
+            lost = self.reset_socket()
+            raise ConnectionError(f'Lost unix socket connection to {self.path} with {lost} messages not acknowledged') from exc
+        if frame['op'] == 'ack':
+            self._unacked -= 1
+            return None
+        return (frame['channel'], frame['message'])
+
+    def wait_for_acks(self, max_unacked: int = 0, timeout: float = 5.0) -> None:
+        sock = self.get_socket()
+        deadline = time.monotonic() + timeout
+        while self._unacked > max_unacked:
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            try:
+                if message := self.read_sync_frame(sock):
+                    self._held_messages.append(message)
+            except socket.timeout:
+                lost = self.reset_socket()  # a late ack would be counted against the next frames
+                raise TimeoutError(f'Dispatcher service did not acknowledge {lost} messages in {timeout} seconds')
+            finally:
+                if self._sock is sock:  # not closed after an error
+                    sock.settimeout(None)
+
+    def process_notify(self, connected_callback: Optional[Callable] = None, timeout: float = 5.0, max_messages: int = 1) -> Iterator[tuple[str, str]]:
+        """Blocking method that subscribes to the channels with the service, and yields messages until timeout or max_messages"""
+        sock = self.get_socket()
+        self.send_frame('sub', channels=list(self.channels))
+        if connected_callback:
+            connected_callback()
+
+        deadline = time.monotonic() + timeout
+        received = 0
+        try:
+            while received < max_messages:
+                if self._held_messages:
+                    message: Optional[tuple[str, str]] = self._held_messages.pop(0)
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    sock.settimeout(remaining)
+                    try:
+                        message = self.read_sync_frame(sock)
+                    except socket.timeout:
+                        return
+                if message:
+                    received += 1
+                    yield message
+        finally:
+            if self._sock is sock:
+                sock.settimeout(None)
+
+    def publish_message(self, channel: Optional[str] = None, message: str = '') -> None:
+        """Send the message without waiting for its ack, acks are read in batches once max_unacked is reached, or on close"""
+        channel = self.get_publish_channel(channel)
+        with self._publish_lock:
+            self.send_frame('pub', channel=channel, message=message)
+            if self._unacked >= self.max_unacked:
+                self.wait_for_acks(max_unacked=self.max_unacked // 2)
+        logger.debug(f'Sent unix socket message of {len(message)} chars to {channel}')
+
+    def publish_many(self, messages: Iterable[tuple[Optional[str], str]]) -> None:
+        """Send frames in writes of max_unacked frames, reading acks in between so neither side fills its buffers"""
+        with self._publish_lock:
+            frames: list[bytes] = []
+            sent_ct = 0
+            for channel, message in messages:
+                frames.append(encode_frame(dict(op='pub', id=self._next_id, channel=self.get_publish_channel(channel), message=message)))
+                self._next_id += 1
+                if len(frames) >= self.max_unacked:
+                    self.send_frames(b''.join(frames), len(frames))
+                    sent_ct += len(frames)
+                    frames = []
+                    self.wait_for_acks(max_unacked=self.max_unacked)
+            if frames:
+                self.send_frames(b''.join(frames), len(frames))
+                sent_ct += len(frames)
+            self.wait_for_acks()
+        logger.debug(f'Sent {sent_ct} unix socket messages')
+
+    def close(self) -> None:
+        with self._publish_lock:
+            if self._sock:
+                try:
+                    self.wait_for_acks()
+                except (TimeoutError, ConnectionError, OSError):
+                    logger.warning(f'Closing unix socket {self.path} with {self._unacked} messages not acknowledged')
+                self.reset_socket()
@@ -3,9 +3,10 @@ import json
 import logging
 import time
 import uuid
-from typing import Optional
+from typing import Any, Optional
 
 from .factories import get_broker
+from .nodes import NodeDirectory
 from .producers import BrokeredProducer
 
 logger = logging.getLogger('awx.main.dispatch.control')
@@ -61,10 +62,11 @@ class ControlCallbacks:
 
 
 class Control(object):
-    def __init__(self, broker_name: str, broker_config: dict, queue: Optional[str] = None) -> None:
+    def __init__(self, broker_name: str, broker_config: dict, queue: Optional[str] = None, heartbeat_channel: Optional[str] = None) -> None:
         self.queuename = queue
         self.broker_name = broker_name
         self.broker_config = broker_config
+        self.heartbeat_channel = heartbeat_channel
 
     def running(self, *args, **kwargs):
         return self.control_with_reply('running', *args, **kwargs)
@@ -99,6 +101,10 @@ class Control(object):
         broker = get_broker(self.broker_name, self.broker_config, channels=[reply_queue])
         return BrokeredProducer(broker, close_on_exit=True)
 
+    def client(self) -> 'ControlClient':
+        "Long-lived client for sending many control-and-reply requests over the same connection"
+        return ControlClient(self.broker_name, self.broker_config, queue=self.queuename, heartbeat_channel=self.heartbeat_channel)
+
     async def acontrol_with_reply(self, command, expected_replies=1, timeout=1, data=None):
         reply_queue = Control.generate_reply_queue_name()
         send_data = {'control': command, 'reply_to': reply_queue}
@@ -150,3 +156,167 @@ class Control(object):
         payload = json.dumps(send_data)
         broker = get_broker(self.broker_name, self.broker_config)
         broker.publish_message(channel=self.queuename, message=payload)
+
+
+class PendingReplies:
+    "Replies to one request, done after expected_replies of them, or after every node in expected_nodes answered"
+
+    def __init__(self, expected_replies: int, expected_nodes: Optional[set[str]] = None) -> None:
+        self.expected_replies = expected_replies
+        self.expected_nodes = expected_nodes
+        self.replies: list[dict] = []
+        self.done = asyncio.Event()
+        if expected_nodes is not None and not expected_nodes:
+            self.done.set()  # no live nodes to wait for
+
+    def add(self, reply: dict) -> None:
+        self.replies.append(reply)
+        if self.expected_nodes is not None:
+            if self.expected_nodes.issubset(reply.get('node_id') for reply in self.replies):
+                self.done.set()
+        elif self.expected_replies and len(self.replies) >= self.expected_replies:
+            self.done.set()
+
+
+class ControlClient:
+    """Control-and-reply client that keeps its connections and reply channel between requests
+
+    Compared to Control.acontrol_with_reply, which sets up a new connection and reply channel for every call,
+    this listens on one reply channel for as long as it is open, so each request only costs sending one message.
+    Every request carries a correlation_id, which the service puts in its replies, so replies are matched
+    to their request and many requests can be waiting for replies at the same time.
+
+    With heartbeat_channel, this also listens to the heartbeats of the services and keeps track
+    of the live nodes, so giving expected_replies=None waits for a reply from every live node listening on the queue.
+    That returns as soon as they all answered, instead of waiting for the timeout, once the client
+    has listened for one heartbeat interval. Before then, or if some node does not announce its channels
+    because it has no route_channel, it waits for the timeout like expected_replies=0.
+
+    Listening and publishing use separate broker instances, because a pg_notify connection
+    can not send while it waits on notifications.
+    Use as an async context manager, or call aclose when done.
+    """
+
+    def __init__(self, broker_name: str, broker_config: dict, queue: Optional[str] = None, heartbeat_channel: Optional[str] = None) -> None:
+        self.queuename = queue
+        self.reply_queue = Control.generate_reply_queue_name()
+        self.heartbeat_channel = heartbeat_channel
+        self.nodes = NodeDirectory()
+        channels = [self.reply_queue]
+        if heartbeat_channel:
+            channels.append(heartbeat_channel)
+        self.listener = get_broker(broker_name, broker_config, channels=channels)
+        self.publisher = get_broker(broker_name, broker_config)
+        self.pending: dict[str, PendingReplies] = {}
+        self.listen_task: Optional[asyncio.Task] = None
+        self.ready_event = asyncio.Event()
+        self.start_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> 'ControlClient':
+        await self.astart()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
+
+    async def connected_callback(self) -> None:
+        self.nodes.mark_listening()
+        self.ready_event.set()
+
+    async def listen_forever(self) -> None:
+        async for channel, payload in self.listener.aprocess_notify(connected_callback=self.connected_callback):
+            try:
+                data = json.loads(payload)
+            except json.JSONDecodeError:
+                logger.error(f'Ignoring message on {channel} that is not valid JSON: {payload!r}')
+                continue
+            if self.heartbeat_channel and channel == self.heartbeat_channel:
+                if isinstance(data, dict):
+                    self.nodes.update(data)
+                else:
+                    logger.error(f'Ignoring heartbeat on {channel} that is not a JSON object: {payload!r}')
+            else:
+                self.process_reply(data)
+
+    def process_reply(self, reply: Any) -> None:
+        correlation_id = reply.pop('correlation_id', None) if isinstance(reply, dict) else None
+        pending = self.pending.get(correlation_id) if correlation_id else None
+        if pending is None:
+            logger.debug(f'Ignoring reply on {self.reply_queue} for no waiting request, correlation_id={correlation_id}')
+            return
+        pending.add(reply)
+
+    def listen_done_callback(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            logger.error(f'Control client stopped listening on {self.reply_queue}', exc_info=task.exception())
+        self.ready_event.clear()
+        for pending in self.pending.values():
+            pending.done.set()  # give back what arrived so far, instead of waiting out the timeout
+
+    async def astart(self) -> None:
+        "Start listening on the reply channel, this happens on the first request if not called"
+        async with self.start_lock:
+            if self.listen_task is None or self.listen_task.done():
+                self.listen_task = asyncio.create_task(self.listen_forever(), name=f'control_client_{self.reply_queue}')
+                self.listen_task.add_done_callback(self.listen_done_callback)
+            ready_task = asyncio.create_task(self.ready_event.wait())
+            await asyncio.wait([ready_task, self.listen_task], return_when=asyncio.FIRST_COMPLETED)
+            ready_task.cancel()
+        if self.listen_task.done():
+            self.listen_task.result()  # raise the error from connecting
+
+    def get_expected_nodes(self) -> Optional[set[str]]:
+        "Live nodes that get commands sent to this queue, None if that is not known"
+        if not (self.heartbeat_channel and self.nodes.is_complete()):
+            return None
+        channel = self.queuename or getattr(self.publisher, 'default_publish_channel', None)
+        if channel is None:
+            return None
+        return self.nodes.listening_on(channel)
+
+    async def acontrol_with_reply(self, command: str, expected_replies: Optional[int] = 1, timeout: float = 1.0, data: Optional[dict] = None) -> list[dict]:
+        """Send a control command and return the replies
+
+        expected_replies=None waits for every live node known from heartbeats, otherwise
+        this returns after that many replies, with 0 meaning wait for the timeout.
+        """
+        if not self.ready_event.is_set():
+            await self.astart()
+        correlation_id = str(uuid.uuid4())
+        send_data = {'control': command, 'reply_to': self.reply_queue, 'correlation_id': correlation_id}
+        if data:
+            send_data['control_data'] = data
+
+        if expected_replies is None:
+            pending = PendingReplies(0, expected_nodes=self.get_expected_nodes())
+        else:
+            pending = PendingReplies(expected_replies)
+        self.pending[correlation_id] = pending
+        try:
+            await self.publisher.apublish_message(channel=self.queuename, message=json.dumps(send_data))
+            try:
+                await asyncio.wait_for(pending.done.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f'Did not receive {expected_replies} reply in {timeout} seconds, only {len(pending.replies)}')
+        finally:
+            del self.pending[correlation_id]
+        return pending.replies
+
+    async def acontrol(self, command: str, data: Optional[dict] = None) -> None:
+        send_data: dict = {'control': command}
+        if data:
+            send_data['control_data'] = data
+        await self.publisher.apublish_message(channel=self.queuename, message=json.dumps(send_data))
+
+    async def aclose(self) -> None:
+        if self.listen_task:
+            self.listen_task.cancel()
+            try:
+                await self.listen_task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                pass  # logged by the done callback
+            self.listen_task = None
+        await self.listener.aclose()
+        await self.publisher.aclose()
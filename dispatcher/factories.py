@@ -1,6 +1,12 @@
+import asyncio
 import inspect
+import json
+import logging
+import os
+import threading
 from copy import deepcopy
 from typing import Iterable, Literal, Optional, Type, get_args, get_origin
+from uuid import uuid4
 
 from . import producers
 from .brokers import get_broker
@@ -8,9 +14,19 @@ from .brokers.base import BaseBroker
 from .config import LazySettings
 from .config import settings as global_settings
 from .control import Control
+from .nodes import HEARTBEAT_CHANNEL, ROUTE_LEAST_LOADED, NodeDirectory, NodeWatcher, node_channel
 from .service import process
+from .service.cluster import ClusterDuplicates
+from .service.drain import Drainer
+from .service.heartbeat import Heartbeat
+from .service.loop_monitor import LoopMonitor
 from .service.main import DispatcherMain
+from .service.metrics import MetricsServer
 from .service.pool import WorkerPool
+from .service.rebalancer import Rebalancer
+from .service.store import LocalStore
+
+logger = logging.getLogger(__name__)
 
 """
 Creates objects from settings,
@@ -29,19 +45,105 @@ def process_manager_from_settings(settings: LazySettings = global_settings):
     return process_manager_cls(**kwargs)
 
 
+def cluster_duplicates_from_settings(settings: LazySettings = global_settings) -> Optional[ClusterDuplicates]:
+    "Cluster-wide on_duplicate rules are optional, only used if the cluster_kwargs section is given"
+    if 'cluster_kwargs' not in settings.service:
+        return None
+    kwargs = settings.service['cluster_kwargs'].copy()
+    if 'config' not in kwargs:
+        # connect the same way as a postgres broker does
+        for broker_kwargs in settings.brokers.values():
+            if 'config' in broker_kwargs:
+                kwargs['config'] = broker_kwargs['config']
+                break
+    return ClusterDuplicates(**kwargs)
+
+
 def pool_from_settings(settings: LazySettings = global_settings):
     kwargs = settings.service.get('pool_kwargs', {}).copy()
     kwargs['process_manager'] = process_manager_from_settings(settings=settings)
+    kwargs['cluster_duplicates'] = cluster_duplicates_from_settings(settings=settings)
     return WorkerPool(**kwargs)
 
 
-def brokers_from_settings(settings: LazySettings = global_settings) -> Iterable[BaseBroker]:
-    return [get_broker(broker_name, broker_kwargs) for broker_name, broker_kwargs in settings.brokers.items()]
+def store_from_settings(settings: LazySettings = global_settings) -> Optional[LocalStore]:
+    "The local store is optional, only created if the store_kwargs section is given"
+    if 'store_kwargs' not in settings.service:
+        return None
+    return LocalStore(**settings.service['store_kwargs'])
+
+
+def metrics_server_from_settings(settings: LazySettings = global_settings) -> Optional[MetricsServer]:
+    "The metrics endpoint is optional, only created if the metrics_kwargs section is given"
+    if 'metrics_kwargs' not in settings.service:
+        return None
+    return MetricsServer(**settings.service['metrics_kwargs'])
+
+
+def loop_monitor_from_settings(settings: LazySettings = global_settings) -> Optional[LoopMonitor]:
+    "The loop monitor is optional, only created if the loop_monitor_kwargs section is given"
+    if 'loop_monitor_kwargs' not in settings.service:
+        return None
+    return LoopMonitor(**settings.service['loop_monitor_kwargs'])
+
+
+def _get_heartbeat_broker_name(settings: LazySettings = global_settings) -> str:
+    "Heartbeats, and tasks routed to a node by load, go through this broker"
+    return _get_publisher_broker_name(publish_broker=settings.service['heartbeat_kwargs'].get('broker'), settings=settings)
+
+
+def heartbeat_from_settings(settings: LazySettings = global_settings, node_id: Optional[str] = None) -> Optional[Heartbeat]:
+    "Heartbeats are optional, only sent if the heartbeat_kwargs section is given"
+    if 'heartbeat_kwargs' not in settings.service:
+        return None
+    kwargs = settings.service['heartbeat_kwargs'].copy()
+    kwargs.pop('broker', None)
+    broker_name = _get_heartbeat_broker_name(settings=settings)
+    broker = get_broker(broker_name, settings.brokers[broker_name])
+    if node_id:
+        kwargs['route_channel'] = node_channel(node_id)
+    return Heartbeat(broker, **kwargs)
 
 
-def producers_from_settings(settings: LazySettings = global_settings) -> Iterable[producers.BaseProducer]:
+def rebalancer_from_settings(settings: LazySettings = global_settings) -> Optional[Rebalancer]:
+    "Rebalancing is optional, only done if the rebalance_kwargs section is given, and heartbeats are needed for it"
+    if 'rebalance_kwargs' not in settings.service:
+        return None
+    if 'heartbeat_kwargs' not in settings.service:
+        raise RuntimeError('The rebalance_kwargs service option requires heartbeat_kwargs')
+    broker_name = _get_heartbeat_broker_name(settings=settings)
+    channel = settings.service['heartbeat_kwargs'].get('channel', HEARTBEAT_CHANNEL)
+    broker = get_broker(broker_name, settings.brokers[broker_name], channels=[channel])
+    return Rebalancer(broker, **settings.service['rebalance_kwargs'])
+
+
+def drainer_from_settings(settings: LazySettings = global_settings) -> Optional[Drainer]:
+    "Draining on shutdown is optional, only done if the drain_kwargs section is given"
+    if 'drain_kwargs' not in settings.service:
+        return None
+    kwargs = settings.service['drain_kwargs'].copy()
+    broker_name = _get_publisher_broker_name(publish_broker=kwargs.pop('broker', None), settings=settings)
+    broker = get_broker(broker_name, settings.brokers[broker_name])
+    return Drainer(broker, **kwargs)
+
+
+def brokers_from_settings(settings: LazySettings = global_settings, node_id: Optional[str] = None) -> Iterable[BaseBroker]:
+    "With a node_id and heartbeats, the heartbeat broker also listens on the channel for tasks routed to this node"
+    route_broker_name = _get_heartbeat_broker_name(settings=settings) if (node_id and 'heartbeat_kwargs' in settings.service) else None
+    brokers = []
+    for broker_name, broker_kwargs in settings.brokers.items():
+        overrides: dict = {}
+        if node_id and broker_name == route_broker_name:
+            overrides['channels'] = list(broker_kwargs.get('channels', ())) + [node_channel(node_id)]
+        if broker_name == 'unix_socket':
+            overrides['server'] = True  # the service binds the socket, everything else connects to it
+        brokers.append(get_broker(broker_name, broker_kwargs, **overrides))
+    return brokers
+
+
+def producers_from_settings(settings: LazySettings = global_settings, node_id: Optional[str] = None) -> Iterable[producers.BaseProducer]:
     producer_objects = []
-    for broker in brokers_from_settings(settings=settings):
+    for broker in brokers_from_settings(settings=settings, node_id=node_id):
         producer = producers.BrokeredProducer(broker=broker)
         producer_objects.append(producer)
 
@@ -57,10 +159,28 @@ def from_settings(settings: LazySettings = global_settings) -> DispatcherMain:
     You could initialize this yourself, but using the shared settings allows for consistency
     between the service, publisher, and any other interacting processes.
     """
-    producers = producers_from_settings(settings=settings)
+    extra_kwargs = settings.service.get('main_kwargs', {}).copy()
+    if 'heartbeat_kwargs' in settings.service:
+        extra_kwargs.setdefault('node_id', str(uuid4()))  # known before the brokers, for the channel routed to this node
+    producers = producers_from_settings(settings=settings, node_id=extra_kwargs.get('node_id'))
     pool = pool_from_settings(settings=settings)
-    extra_kwargs = settings.service.get('main_kwargs', {})
-    return DispatcherMain(producers, pool, **extra_kwargs)
+    store = store_from_settings(settings=settings)
+    metrics_server = metrics_server_from_settings(settings=settings)
+    heartbeat = heartbeat_from_settings(settings=settings, node_id=extra_kwargs.get('node_id'))
+    rebalancer = rebalancer_from_settings(settings=settings)
+    drainer = drainer_from_settings(settings=settings)
+    loop_monitor = loop_monitor_from_settings(settings=settings)
+    return DispatcherMain(
+        producers,
+        pool,
+        store=store,
+        metrics_server=metrics_server,
+        heartbeat=heartbeat,
+        rebalancer=rebalancer,
+        drainer=drainer,
+        loop_monitor=loop_monitor,
+        **extra_kwargs,
+    )
 
 
 # ---- Publisher objects ----
@@ -90,11 +210,163 @@ def get_publisher_from_settings(publish_broker: Optional[str] = None, settings:
     return get_broker(publish_broker, settings.brokers[publish_broker], **overrides)
 
 
+class PublisherCache:
+    """Publishing brokers reused for every submission in this process, keyed by broker name and config
+
+    After a fork, the child starts with no brokers so it makes its own connections.
+    The brokers from the parent are kept referenced, because closing or garbage collecting
+    them in the child could close connections that the parent is still using.
+    A cached pg_notify broker with a sync_connection_factory asks the factory for a connection on every publish,
+    so threads sharing the broker use whatever connection the application gives each of them.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.brokers: dict[tuple[str, str], BaseBroker] = {}
+        # Async connections belong to one event loop, so async publishing has a broker for every loop,
+        # dropped with its connections once that loop closed
+        self.batchers: dict[tuple[int, str, str], AsyncPublishBatcher] = {}
+        self.watchers: dict[tuple[str, str, str], NodeWatcher] = {}
+        self.inherited: list = []
+
+    def get(self, broker_name: str, broker_config: dict) -> BaseBroker:
+        key = (broker_name, json.dumps(broker_config, sort_keys=True, default=str))
+        with self.lock:
+            if key not in self.brokers:
+                self.brokers[key] = get_broker(broker_name, broker_config)
+            return self.brokers[key]
+
+    def get_batcher(self, broker_name: str, broker_config: dict) -> 'AsyncPublishBatcher':
+        loop = asyncio.get_running_loop()
+        key = (id(loop), broker_name, json.dumps(broker_config, sort_keys=True, default=str))
+        with self.lock:
+            batcher = self.batchers.get(key)
+            if batcher is None or batcher.loop is not loop:
+                for old_key, old_batcher in list(self.batchers.items()):
+                    if old_batcher.loop.is_closed():
+                        del self.batchers[old_key]
+                        # aclose needs the loop, so connections are closed without it if they can be
+                        if not old_batcher.broker.abandon_async_connections():
+                            logger.warning(f'Could not close the connection of a {old_key[1]} publisher after its event loop closed, it is leaked')
+                batcher = AsyncPublishBatcher(get_broker(broker_name, broker_config), loop)
+                self.batchers[key] = batcher
+            return batcher
+
+    def get_node_watcher(self, broker_name: str, broker_config: dict, channel: str) -> NodeWatcher:
+        key = (broker_name, json.dumps(broker_config, sort_keys=True, default=str), channel)
+        with self.lock:
+            if key not in self.watchers:
+                if 'config' in broker_config:
+                    # listen on a connection of its own, not one from a factory that may be shared with publishing
+                    broker_config = {k: v for k, v in broker_config.items() if k != 'sync_connection_factory'}
+                watcher = NodeWatcher(broker_name, broker_config, channel=channel)
+                watcher.start()
+                self.watchers[key] = watcher
+            return self.watchers[key]
+
+    def after_fork_in_child(self) -> None:
+        self.lock = threading.Lock()
+        self.inherited.extend(self.brokers.values())
+        self.inherited.extend(self.batchers.values())
+        self.inherited.extend(self.watchers.values())  # the thread did not survive the fork
+        self.brokers = {}
+        self.batchers = {}
+        self.watchers = {}
+
+
+class AsyncPublishBatcher:
+    """Collects messages published from one event loop, and sends those from the same loop iteration with one apublish_many
+
+    Messages that come in while a batch is being sent go out together in the next batch.
+    """
+
+    def __init__(self, broker: BaseBroker, loop: asyncio.AbstractEventLoop) -> None:
+        self.broker = broker
+        self.loop = loop
+        self.pending: list[tuple[Optional[str], str, asyncio.Future]] = []
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def publish(self, channel: Optional[str] = None, message: str = '') -> None:
+        "Returns once the batch with this message was sent, raising the error from the broker if that failed"
+        future = self.loop.create_future()
+        self.pending.append((channel, message, future))
+        if self.flush_task is None:
+            self.flush_task = self.loop.create_task(self.flush(), name='dispatcher_publish_batcher')
+        await future
+
+    async def flush(self) -> None:
+        try:
+            while self.pending:
+                batch, self.pending = self.pending, []
+                try:
+                    await self.broker.apublish_many([(channel, message) for channel, message, _ in batch])
+                except Exception as exc:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(exc)
+                else:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self.flush_task = None
+
+
+publisher_cache = PublisherCache()
+os.register_at_fork(after_in_child=publisher_cache.after_fork_in_child)
+
+
+def get_cached_publisher(publish_broker: Optional[str] = None, settings: LazySettings = global_settings) -> BaseBroker:
+    """
+    Like get_publisher_from_settings, but returns the same broker for the same settings within a process.
+    This is used for task submission, so connections are not set up again for every task.
+    """
+    publish_broker = _get_publisher_broker_name(publish_broker=publish_broker, settings=settings)
+    return publisher_cache.get(publish_broker, settings.brokers[publish_broker])
+
+
+def get_async_publish_batcher(publish_broker: Optional[str] = None, settings: LazySettings = global_settings) -> AsyncPublishBatcher:
+    """
+    Returns the batcher for async task submission for the running event loop,
+    the same one for the same settings, so submissions from different coroutines are sent together.
+    """
+    publish_broker = _get_publisher_broker_name(publish_broker=publish_broker, settings=settings)
+    return publisher_cache.get_batcher(publish_broker, settings.brokers[publish_broker])
+
+
+def get_node_directory(settings: LazySettings = global_settings) -> NodeDirectory:
+    """
+    Returns the live nodes and their load, kept current from their heartbeats by a thread in this process.
+    The first call starts listening, so nothing is known right away.
+    """
+    if 'heartbeat_kwargs' not in settings.service:
+        raise RuntimeError('Knowing the dispatcher nodes requires heartbeat_kwargs in the service settings')
+    broker_name = _get_heartbeat_broker_name(settings=settings)
+    channel = settings.service['heartbeat_kwargs'].get('channel', HEARTBEAT_CHANNEL)
+    return publisher_cache.get_node_watcher(broker_name, settings.brokers[broker_name], channel).directory
+
+
+def get_routed_channel(route: str, queue: Optional[str] = None, settings: LazySettings = global_settings) -> tuple[Optional[str], Optional[str]]:
+    """
+    Returns the broker and channel to publish a task to for the given routing mode.
+    Until a node listening on queue is known, this gives back no broker, meaning the default, and queue.
+    """
+    if route != ROUTE_LEAST_LOADED:
+        raise ValueError(f'Unknown route {route}, options are {ROUTE_LEAST_LOADED}')
+    node = get_node_directory(settings=settings).pick_least_loaded(queue=queue)
+    if node is None:
+        return (None, queue)
+    return (_get_heartbeat_broker_name(settings=settings), node.route_channel)
+
+
 def get_control_from_settings(publish_broker: Optional[str] = None, settings: LazySettings = global_settings, **overrides):
     publish_broker = _get_publisher_broker_name(publish_broker=publish_broker, settings=settings)
     broker_options = settings.brokers[publish_broker].copy()
     broker_options.update(overrides)
-    return Control(publish_broker, broker_options)
+    heartbeat_channel = None
+    if 'heartbeat_kwargs' in settings.service:
+        heartbeat_channel = settings.service['heartbeat_kwargs'].get('channel', HEARTBEAT_CHANNEL)
+    return Control(publish_broker, broker_options, heartbeat_channel=heartbeat_channel)
 
 
 # ---- Schema generation ----
@@ -128,6 +400,16 @@ def generate_settings_schema(settings: LazySettings = global_settings) -> dict:
 
     ret['service']['pool_kwargs'] = schema_for_cls(WorkerPool)
     ret['service']['main_kwargs'] = schema_for_cls(DispatcherMain)
+    ret['service']['store_kwargs'] = schema_for_cls(LocalStore)
+    ret['service']['metrics_kwargs'] = schema_for_cls(MetricsServer)
+    ret['service']['cluster_kwargs'] = schema_for_cls(ClusterDuplicates)
+    ret['service']['heartbeat_kwargs'] = schema_for_cls(Heartbeat)
+    ret['service']['heartbeat_kwargs']['broker'] = 'str'
+    ret['service']['heartbeat_kwargs'].pop('route_channel')  # set from the node_id
+    ret['service']['rebalance_kwargs'] = schema_for_cls(Rebalancer)
+    ret['service']['drain_kwargs'] = schema_for_cls(Drainer)
+    ret['service']['drain_kwargs']['broker'] = 'str'
+    ret['service']['loop_monitor_kwargs'] = schema_for_cls(LoopMonitor)
     ret['service']['process_manager_kwargs'] = {}
     pm_classes = (process.ProcessManager, process.ForkServerManager)
     for pm_cls in pm_classes:
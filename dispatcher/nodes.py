@@ -0,0 +1,155 @@
+import json
+import logging
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+from .brokers import get_broker
+
+logger = logging.getLogger(__name__)
+
+
+"""Tracking of the live dispatcher nodes, from the heartbeats they send
+
+With heartbeat_kwargs in the service settings, each service announces its node_id and load
+on the heartbeat channel every interval seconds, and once more when it stops.
+Clients listening on that channel keep a NodeDirectory, so they know which nodes are alive
+without asking, for instance how many replies to expect for a control command.
+
+Each node also listens on a channel of its own, given in its heartbeats, so publishers
+can route tasks to the least loaded node with apply_async(route='least_loaded').
+"""
+
+HEARTBEAT_CHANNEL = 'dispatcher_heartbeat'
+ROUTE_LEAST_LOADED = 'least_loaded'
+
+
+def node_channel(node_id: str) -> str:
+    "Channel only this node listens on, for tasks routed to it"
+    return f'dispatcher_node_{node_id}'.replace('-', '_')
+
+
+class NodeInfo:
+    def __init__(self, node_id: str, interval: float, load: dict, route_channel: Optional[str] = None, channels: Optional[list[str]] = None) -> None:
+        self.node_id = node_id
+        self.interval = interval
+        self.load = load
+        self.route_channel = route_channel
+        self.channels = channels  # None if the node did not announce the channels it listens on
+        self.last_seen = time.monotonic()
+
+    def load_key(self) -> tuple[float, float]:
+        "Lower is less loaded, tasks waiting beyond the free workers first, then the recent wait to dispatch"
+        return (self.load.get('queued', 0) - self.load.get('free', 0), self.load.get('p95_wait', 0.0))
+
+    def record_routed(self) -> None:
+        "Count a task routed here until the next heartbeat, so a burst is not all sent to the same node"
+        if self.load.get('free', 0) > 0:
+            self.load['free'] -= 1
+        else:
+            self.load['queued'] = self.load.get('queued', 0) + 1
+
+
+class NodeDirectory:
+    """Nodes seen in heartbeats, a node is considered dead after missing missed_heartbeats of them in a row"""
+
+    def __init__(self, missed_heartbeats: int = 3) -> None:
+        self.missed_heartbeats = missed_heartbeats
+        self.nodes: dict[str, NodeInfo] = {}
+        self.listening_since: Optional[float] = None
+
+    def mark_listening(self) -> None:
+        "Called once listening on the heartbeat channel, heartbeats sent before this were missed"
+        self.listening_since = time.monotonic()
+
+    def update(self, data: dict) -> None:
+        "Record a heartbeat message"
+        node_id = data.get('heartbeat')
+        if not node_id:
+            logger.warning(f'Heartbeat message without a node_id: {data}')
+            return
+        if data.get('stopping'):
+            self.nodes.pop(node_id, None)
+            logger.debug(f'Node {node_id} announced it is stopping')
+            return
+        if node_id not in self.nodes:
+            logger.info(f'Discovered dispatcher node {node_id}')
+        self.nodes[node_id] = NodeInfo(
+            node_id, float(data.get('interval', 0.0)), data.get('load', {}), route_channel=data.get('route_channel'), channels=data.get('channels')
+        )
+
+    def live_nodes(self) -> dict[str, NodeInfo]:
+        "Nodes heard from recently, forgetting any that missed too many heartbeats"
+        now = time.monotonic()
+        for node_id, info in list(self.nodes.items()):
+            if now - info.last_seen > info.interval * self.missed_heartbeats:
+                logger.info(f'Node {node_id} missed {self.missed_heartbeats} heartbeats, considered gone')
+                del self.nodes[node_id]
+        return self.nodes
+
+    def is_complete(self) -> bool:
+        """True if we have listened long enough that every live node has sent a heartbeat
+
+        Before that, a node that is running may not be known yet.
+        """
+        if self.listening_since is None:
+            return False
+        live = self.live_nodes()
+        if not live:
+            return False
+        return time.monotonic() - self.listening_since >= max(info.interval for info in live.values())
+
+    def listening_on(self, channel: str) -> Optional[set[str]]:
+        """The live nodes listening on channel, from the channels they announce in heartbeats
+
+        Returns None if any live node does not announce its channels, because then it is not known.
+        """
+        live = self.live_nodes()
+        if any(info.channels is None for info in live.values()):
+            return None
+        return {node_id for node_id, info in live.items() if channel in (info.channels or ())}
+
+    def pick_least_loaded(self, queue: Optional[str] = None) -> Optional[NodeInfo]:
+        """Power of two choices, the less loaded of two random nodes that can take the task
+
+        This avoids sending everything to the one node that looked least loaded at the last heartbeat.
+        Only nodes listening on queue are considered, if given. Returns None if no node is known.
+        """
+        candidates = [info for info in list(self.live_nodes().values()) if info.route_channel and (queue is None or queue in (info.channels or ()))]
+        if not candidates:
+            return None
+        if len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        chosen = min(candidates, key=lambda info: info.load_key())
+        chosen.record_routed()
+        return chosen
+
+
+class NodeWatcher:
+    """Keeps a NodeDirectory current from a thread listening to heartbeats, for publishers in synchronous code
+
+    The thread runs as long as the process, and a forked child has to start its own.
+    """
+
+    def __init__(self, broker_name: str, broker_config: dict, channel: str = HEARTBEAT_CHANNEL, poll_timeout: float = 5.0) -> None:
+        self.broker = get_broker(broker_name, broker_config, channels=[channel])
+        self.channel = channel
+        self.poll_timeout = poll_timeout
+        self.directory = NodeDirectory()
+        self.thread = threading.Thread(target=self.watch_forever, name='dispatcher_node_watcher', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def watch_forever(self) -> None:
+        connected_callback: Optional[Callable[[], None]] = self.directory.mark_listening
+        while True:
+            try:
+                for channel, payload in self.broker.process_notify(connected_callback=connected_callback, timeout=self.poll_timeout, max_messages=100):
+                    self.directory.update(json.loads(payload))
+                connected_callback = None
+            except Exception:
+                logger.exception(f'Error listening for heartbeats on {self.channel}, retrying')
+                connected_callback = self.directory.mark_listening
+                time.sleep(self.poll_timeout)
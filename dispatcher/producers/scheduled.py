@@ -1,9 +1,13 @@
 import asyncio
 import logging
-from typing import Union
+import time
+from typing import TYPE_CHECKING, Optional, Union
 
 from .base import BaseProducer
 
+if TYPE_CHECKING:
+    from ..service.store import LocalStore
+
 logger = logging.getLogger(__name__)
 
 
@@ -11,9 +15,12 @@ class ScheduledProducer(BaseProducer):
     def __init__(self, task_schedule: dict[str, dict[str, Union[int, str]]]):
         self.task_schedule = task_schedule
         self.scheduled_tasks: list[asyncio.Task] = []
+        self.store: Optional['LocalStore'] = None
         super().__init__()
 
     async def start_producing(self, dispatcher) -> None:
+        # If the service keeps a local store, schedules pick up where the last run left off
+        self.store = getattr(dispatcher, 'store', None)
         for task_name, options in self.task_schedule.items():
             submission_options = options.copy()
             per_seconds = submission_options.pop('schedule')
@@ -26,12 +33,22 @@ class ScheduledProducer(BaseProducer):
     def all_tasks(self) -> list[asyncio.Task]:
         return self.scheduled_tasks
 
+    def first_wait(self, task_name: str, per_seconds) -> float:
+        "Seconds until the first run, accounting for the last run saved in the local store if there is one"
+        if self.store and (last_run := self.store.schedule_runs.get(task_name)):
+            return min(max(last_run + per_seconds - time.time(), 0.0), per_seconds)
+        return per_seconds
+
     async def run_schedule_forever(self, task_name: str, per_seconds, dispatcher, submission_options) -> None:
         logger.info(f"Starting task runner for {task_name} with interval {per_seconds} seconds")
+        wait = self.first_wait(task_name, per_seconds)
         while True:
-            await asyncio.sleep(per_seconds)
+            await asyncio.sleep(wait)
+            wait = per_seconds
             logger.debug(f"Produced scheduled task: {task_name}")
             self.produced_count += 1
+            if self.store:
+                self.store.record_schedule_run(task_name, time.time())
             message = submission_options.copy()
             message['task'] = task_name
             message['uuid'] = f'sch-{self.produced_count}'
@@ -31,6 +31,9 @@ class DispatcherDecorator:
 
         setattr(fn, 'apply_async', dmethod.apply_async)
         setattr(fn, 'delay', dmethod.delay)
+        setattr(fn, 'apply_many', dmethod.apply_many)
+        setattr(fn, 'aapply_async', dmethod.aapply_async)
+        setattr(fn, 'adelay', dmethod.adelay)
 
         return fn
 
@@ -66,6 +69,12 @@ def task(
     add.apply_async([1, 1])
     Adder.apply_async([1, 1])
 
+    # ...or published many times over, in batches:
+    add.apply_many([{'args': [1, 1]}, {'args': [2, 2]}])
+
+    # ...or from asyncio code, without blocking the event loop:
+    await add.aapply_async([1, 1])
+
     # Tasks can also define a specific target queue or use the special fan-out queue tower_broadcast:
 
     @task(queue='slow-tasks')
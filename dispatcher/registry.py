@@ -3,7 +3,7 @@ import json
 import logging
 import threading
 import time
-from typing import Callable, Optional, Set, Tuple, Union
+from typing import Callable, Iterable, Optional, Set, Tuple, Union
 from uuid import uuid4
 
 from .config import LazySettings
@@ -84,7 +84,13 @@ class DispatcherMethod:
 
         return body
 
-    def apply_async(self, args=None, kwargs=None, queue=None, uuid=None, settings: LazySettings = global_settings, **kw) -> Tuple[dict, str]:
+    def apply_async(
+        self, args=None, kwargs=None, queue=None, uuid=None, settings: LazySettings = global_settings, route: Optional[str] = None, **kw
+    ) -> Tuple[dict, str]:
+        """Submit the task, with route='least_loaded' it goes to the channel of the least loaded node listening on queue
+
+        Routing needs heartbeats from the services, and until some are received the task is published as usual.
+        """
         queue = queue or self.queue
 
         if callable(queue):
@@ -92,15 +98,64 @@ class DispatcherMethod:
 
         obj = self.get_async_body(args=args, kwargs=kwargs, uuid=uuid, **kw)
 
-        from dispatcher.factories import get_publisher_from_settings
+        from dispatcher.factories import get_cached_publisher, get_routed_channel
 
-        broker = get_publisher_from_settings(settings=settings)
+        publish_broker = None
+        if route:
+            publish_broker, queue = get_routed_channel(route, queue=queue, settings=settings)
+
+        broker = get_cached_publisher(publish_broker=publish_broker, settings=settings)
 
         # TODO: exit if a setting is applied to disable publishing
 
         broker.publish_message(channel=queue, message=json.dumps(obj))
         return (obj, queue)
 
+    async def aapply_async(
+        self, args=None, kwargs=None, queue=None, uuid=None, settings: LazySettings = global_settings, route: Optional[str] = None, **kw
+    ) -> Tuple[dict, str]:
+        """Submit the task from asyncio code, submissions made in the same event loop iteration go out in one round trip"""
+        queue = queue or self.queue
+
+        if callable(queue):
+            queue = queue()
+
+        obj = self.get_async_body(args=args, kwargs=kwargs, uuid=uuid, **kw)
+
+        from dispatcher.factories import get_async_publish_batcher, get_routed_channel
+
+        publish_broker = None
+        if route:
+            publish_broker, queue = get_routed_channel(route, queue=queue, settings=settings)
+
+        batcher = get_async_publish_batcher(publish_broker=publish_broker, settings=settings)
+
+        await batcher.publish(channel=queue, message=json.dumps(obj))
+        return (obj, queue)
+
+    async def adelay(self, *args, **kwargs) -> Tuple[dict, str]:
+        return await self.aapply_async(args, kwargs)
+
+    def apply_many(self, calls: Iterable[dict], queue=None, settings: LazySettings = global_settings, **kw) -> Tuple[list[dict], str]:
+        """Submit this task once for each entry in calls, with the broker sending them in batches
+
+        Each entry is a dict of the options apply_async takes, like {'args': [1], 'kwargs': {}},
+        and any other keyword arguments given here apply to every entry.
+        """
+        queue = queue or self.queue
+
+        if callable(queue):
+            queue = queue()
+
+        objs = [self.get_async_body(**dict(kw, **call)) for call in calls]
+
+        from dispatcher.factories import get_cached_publisher
+
+        broker = get_cached_publisher(settings=settings)
+
+        broker.publish_many([(queue, json.dumps(obj)) for obj in objs])
+        return (objs, queue)
+
 
 class UnregisteredMethod(DispatcherMethod):
     def __init__(self, task: str) -> None:
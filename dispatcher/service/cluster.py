@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from typing import TYPE_CHECKING, Optional, Protocol
+
+from ..utils import DuplicateBehavior, MessageAction
+
+if TYPE_CHECKING:
+    from .pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseBackend(Protocol):
+    async def acquire(self, fingerprint: str, node_id: str, uuid: str, ttl: float) -> bool: ...
+
+    async def renew(self, fingerprints: list[str], node_id: str, ttl: float) -> None: ...
+
+    async def release(self, fingerprints: list[str], node_id: str) -> None: ...
+
+    async def aclose(self) -> None: ...
+
+
+def task_fingerprint(message: dict) -> str:
+    "Duplicates are the same task with the same args and kwargs, like the checks in the pool"
+    data = json.dumps([message.get('task'), message.get('args'), message.get('kwargs')], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ClusterDuplicates:
+    """Applies on_duplicate rules to tasks running on any node, not just in the local pool
+
+    Before running a task with serial, discard or queue_one, the node takes a lease on the task fingerprint
+    in a table shared by all nodes, and gives it back once no local copy of the task is running.
+    Leases are renewed while held, so the lease of a node that died expires after lease_ttl.
+
+    The local pool is checked first, and if a copy of the task is already running here the lease is
+    already held, so that needs no round trip. A lease found held by another node is remembered
+    for cache_ttl seconds, which is also how often tasks queued behind another node are retried.
+    Only running tasks are coordinated, queued tasks are still only checked within this node.
+
+    If the lease table can not be reached, tasks are started under the local rules only, and the
+    table is tried again after a backoff that doubles with each error, up to a third of lease_ttl.
+    """
+
+    CLUSTER_BEHAVIORS = (DuplicateBehavior.serial.value, DuplicateBehavior.discard.value, DuplicateBehavior.queue_one.value)
+
+    def __init__(self, config: Optional[dict] = None, table: str = 'dispatcher_leases', lease_ttl: float = 60.0, cache_ttl: float = 1.0) -> None:
+        if cache_ttl <= 0:
+            raise ValueError('cache_ttl must be positive, it is how long a task blocked by another node waits before checking again')
+        self.config = config or {}
+        self.table = table
+        self.lease_ttl = lease_ttl
+        self.cache_ttl = cache_ttl
+        self.backend: Optional[LeaseBackend] = None  # created on start, unless given already
+        self.node_id = ''
+
+        self.held: dict[str, int] = {}  # fingerprint to the number of local tasks running under its lease
+        self.releasing: set[str] = set()  # no longer held, to be given back by the maintenance task
+        self.held_elsewhere: dict[str, float] = {}  # fingerprint to the monotonic time this answer expires
+        self.blocked_count = 0
+        self.error_count = 0
+        self.consecutive_errors = 0
+        self.retry_at = 0.0  # monotonic time before which the lease table is not used, after an error
+        self.lock = asyncio.Lock()  # keeps release queries from racing with taking the same lease again
+        self.wakeup = asyncio.Event()
+        self.maintain_task: Optional[asyncio.Task] = None
+
+    def applies_to(self, message: dict) -> bool:
+        return message.get('on_duplicate') in self.CLUSTER_BEHAVIORS
+
+    def is_held_elsewhere(self, message: dict) -> bool:
+        "Cached answer, without a round trip, used by the pool in its checks of queued messages"
+        if not self.held_elsewhere or not self.applies_to(message):
+            return False
+        fingerprint = task_fingerprint(message)
+        expires = self.held_elsewhere.get(fingerprint)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self.held_elsewhere[fingerprint]
+            return False
+        return True
+
+    def backend_available(self) -> bool:
+        return self.consecutive_errors == 0 or time.monotonic() >= self.retry_at
+
+    def backend_error(self, action: str) -> None:
+        "Log the error being handled, and back off from the lease table"
+        self.error_count += 1
+        self.consecutive_errors += 1
+        backoff = min(self.cache_ttl * 2 ** (self.consecutive_errors - 1), self.lease_ttl / 3)
+        self.retry_at = time.monotonic() + backoff
+        logger.exception(f'Cluster lease table error to {action}, applying on_duplicate rules on this node only, retrying in {backoff:.1f} seconds')
+
+    def blocked_action(self, message: dict) -> str:
+        "What the pool does with a task that is running on another node"
+        if message.get('on_duplicate') == DuplicateBehavior.discard.value:
+            return MessageAction.discard.value
+        return MessageAction.queue.value
+
+    async def acquire(self, message: dict) -> bool:
+        "Take the lease for the task before it starts, returns False if another node holds it"
+        if not self.applies_to(message):
+            return True
+        fingerprint = task_fingerprint(message)
+        async with self.lock:
+            if fingerprint in self.held:
+                self.held[fingerprint] += 1  # local rules already allowed this copy
+                return True
+            if fingerprint in self.releasing:
+                self.releasing.discard(fingerprint)  # never given back, so still ours
+                self.held[fingerprint] = 1
+                return True
+            assert self.backend is not None, 'Cluster leases used before start'
+            if not self.backend_available():
+                return True  # the pool already applied the local rules
+            try:
+                acquired = await self.backend.acquire(fingerprint, self.node_id, str(message.get('uuid', '')), self.lease_ttl)
+            except Exception:
+                self.backend_error(f'acquire lease for task (uuid={message.get("uuid")})')
+                return True
+            self.consecutive_errors = 0
+            if acquired:
+                self.held[fingerprint] = 1
+                self.held_elsewhere.pop(fingerprint, None)
+                return True
+        self.held_elsewhere[fingerprint] = time.monotonic() + self.cache_ttl
+        self.blocked_count += 1
+        logger.info(f'Task (uuid={message.get("uuid")}) is running on another node, on_duplicate={message.get("on_duplicate")}')
+        return False
+
+    def release(self, message: dict) -> None:
+        "Called when a task finishes, the lease is given back in the background once no local copy runs"
+        if not self.applies_to(message):
+            return
+        fingerprint = task_fingerprint(message)
+        if fingerprint not in self.held:
+            return
+        self.held[fingerprint] -= 1
+        if self.held[fingerprint] <= 0:
+            del self.held[fingerprint]
+            self.releasing.add(fingerprint)
+            self.wakeup.set()
+
+    async def release_pending(self) -> None:
+        async with self.lock:
+            if not self.releasing or self.backend is None:
+                return
+            fingerprints = list(self.releasing)
+            self.releasing.clear()
+            try:
+                await self.backend.release(fingerprints, self.node_id)
+            except Exception:
+                self.releasing.update(fingerprints)  # given back on the next try, or they expire
+                raise
+
+    async def maintain_forever(self, pool: 'WorkerPool') -> None:
+        "Gives back released leases, renews held ones, and retries queued tasks once cached answers expire"
+        next_renewal = time.monotonic() + self.lease_ttl / 3
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.cache_ttl)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            if self.backend_available():
+                try:
+                    await self.release_pending()
+                    if time.monotonic() >= next_renewal:
+                        if self.held and self.backend:
+                            await self.backend.renew(list(self.held), self.node_id, self.lease_ttl)
+                        next_renewal = time.monotonic() + self.lease_ttl / 3
+                    self.consecutive_errors = 0
+                except Exception:
+                    self.backend_error('release or renew leases')
+
+            if pool.queued_messages:
+                await pool.drain_queue()
+
+    async def start(self, pool: 'WorkerPool', node_id: str) -> None:
+        self.node_id = node_id
+        if self.backend is None:
+            from ..brokers.pg_notify import LeaseTable  # psycopg is only imported by broker modules
+
+            self.backend = LeaseTable(config=self.config, table=self.table)
+        self.maintain_task = asyncio.create_task(self.maintain_forever(pool), name='cluster_leases_task')
+
+    async def shutdown(self) -> None:
+        if self.maintain_task:
+            self.maintain_task.cancel()
+            try:
+                await self.maintain_task
+            except asyncio.CancelledError:
+                pass
+            self.maintain_task = None
+        if self.backend:
+            self.releasing.update(self.held)
+            self.held = {}
+            try:
+                await self.release_pending()
+            except Exception:
+                logger.exception(f'Could not give back {len(self.releasing)} cluster leases on shutdown, they expire after {self.lease_ttl} seconds')
+            await self.backend.aclose()
@@ -1,7 +1,6 @@
-import asyncio
 import logging
 
-__all__ = ['running', 'cancel', 'alive', 'workers']
+__all__ = ['running', 'cancel', 'alive', 'workers', 'latency', 'resources', 'profile', 'profile_results', 'loop_lag', 'pool_limits', 'pause', 'resume']
 
 
 logger = logging.getLogger(__name__)
@@ -19,34 +18,41 @@ def task_filter_match(pool_task: dict, msg_data: dict) -> bool:
 
 
 async def _find_tasks(dispatcher, cancel: bool = False, **data) -> dict[str, dict]:
-    "Utility method used for both running and cancel control methods"
+    """Utility method used for both running and cancel control methods
+
+    Filtering by uuid or task name uses the indexes kept by the pool and delayer,
+    other filters fall back to checking everything.
+    """
     ret = {}
-    for worker in dispatcher.pool.workers.values():
-        if worker.current_task:
-            if task_filter_match(worker.current_task, data):
-                if cancel:
-                    logger.warning(f'Canceling task in worker {worker.worker_id}, task: {worker.current_task}')
-                    worker.cancel()
-                ret[f'worker-{worker.worker_id}'] = worker.current_task
-    for i, message in enumerate(dispatcher.pool.queued_messages):
-        if task_filter_match(message, data):
-            if cancel:
-                logger.warning(f'Canceling task in pool queue: {message}')
-                dispatcher.pool.queued_messages.remove(message)
-            ret[f'queued-{i}'] = message
-    for i, capsule in enumerate(dispatcher.delayed_messages.copy()):
-        if task_filter_match(capsule.message, data):
+    pool = dispatcher.pool
+
+    workers = pool.running_index.candidates(data)
+    if workers is None:
+        workers = [worker for worker in pool.workers.values() if worker.current_task]
+    for worker in workers:
+        if worker.current_task and task_filter_match(worker.current_task, data):
             if cancel:
-                logger.warning(f'Canceling delayed task (uuid={capsule.uuid})')
-                capsule.task.cancel()
-                try:
-                    await capsule.task
-                except asyncio.CancelledError:
-                    pass
-                except Exception:
-                    logger.error(f'Error canceling delayed task (uuid={capsule.uuid})')
-                dispatcher.delayed_messages.remove(capsule)
-            ret[f'delayed-{i}'] = capsule.message
+                logger.warning(f'Canceling task in worker {worker.worker_id}, task: {worker.current_task}')
+                worker.cancel()
+            ret[f'worker-{worker.worker_id}'] = worker.current_task
+
+    messages = pool.queued_index.candidates(data)
+    if messages is None:
+        messages = list(pool.queued_messages)
+    for i, message in enumerate(message for message in messages if task_filter_match(message, data)):
+        if cancel:
+            logger.warning(f'Canceling task in pool queue: {message}')
+            pool.remove_queued(message)
+        ret[f'queued-{i}'] = message
+
+    capsules = dispatcher.delayer.index.candidates(data)
+    if capsules is None:
+        capsules = dispatcher.delayer.capsules
+    for i, capsule in enumerate(capsule for capsule in capsules if task_filter_match(capsule.message, data)):
+        if cancel:
+            logger.warning(f'Canceling delayed task (uuid={capsule.uuid})')
+            dispatcher.delayer.cancel_capsule(capsule)
+        ret[f'delayed-{i}'] = capsule.message
     return ret
 
 
@@ -69,3 +75,67 @@ async def workers(dispatcher, **data) -> dict:
     for worker in dispatcher.pool.workers.values():
         ret[f'worker-{worker.worker_id}'] = worker.get_data()
     return ret
+
+
+async def latency(dispatcher, **data) -> dict:
+    "Latency percentiles in seconds for each stage of the task lifecycle, by task name, optionally filtered to one task"
+    return dispatcher.pool.task_latency.summary(task=data.get('task'))
+
+
+async def resources(dispatcher, **data) -> dict:
+    "Resources used by each task name, as reported by the workers, most CPU time first, optionally the top N or one task"
+    return dispatcher.pool.task_resources.summary(task=data.get('task'), top=data.get('top'))
+
+
+async def profile(dispatcher, **data) -> dict:
+    "Profile the next count runs of task, with cProfile for the cpu mode or tracemalloc for the memory mode, keeping the top entries"
+    if not data.get('task'):
+        return {'error': 'The profile command needs a task name'}
+    try:
+        armed = dispatcher.pool.profiling.arm(data['task'], count=data.get('count', 1), mode=data.get('mode', 'cpu'), top=data.get('top', 20))
+    except (TypeError, ValueError) as exc:
+        return {'error': str(exc)}
+    return {'task': data['task'], 'remaining': armed['remaining'], **armed['options']}
+
+
+async def profile_results(dispatcher, **data) -> dict:
+    "Summaries of the profiled runs by task name, latest last, optionally for one task"
+    return dispatcher.pool.profiling.summary(task=data.get('task'))
+
+
+async def loop_lag(dispatcher, **data) -> dict:
+    "Lag percentiles of the service event loop in seconds, and the latest slow callbacks with the code that blocked it"
+    if not dispatcher.loop_monitor:
+        return {'error': 'The loop monitor is not on, it is turned on by loop_monitor_kwargs in the service settings'}
+    return dispatcher.loop_monitor.summary()
+
+
+async def pool_limits(dispatcher, **data) -> dict:
+    "Change any of min_workers, max_workers and scaledown_wait given, and return the limits in effect"
+    pool = dispatcher.pool
+    try:
+        pool.set_limits(min_workers=data.get('min_workers'), max_workers=data.get('max_workers'), scaledown_wait=data.get('scaledown_wait'))
+    except (TypeError, ValueError) as exc:
+        return {'error': str(exc)}
+    return {
+        'min_workers': pool.min_workers,
+        'max_workers': pool.max_workers,
+        'scaledown_wait': pool.scaledown_wait,
+        'workers': sum(1 for worker in pool.workers.values() if worker.counts_for_capacity),
+    }
+
+
+def _intake_status(dispatcher) -> dict:
+    return {'paused_all': dispatcher.intake_paused, 'paused_channels': sorted(dispatcher.paused_channels), 'held': len(dispatcher.held_messages)}
+
+
+async def pause(dispatcher, **data) -> dict:
+    "Hold new tasks from the given channel, or from all channels, until resumed"
+    dispatcher.pause_intake(channel=data.get('channel'))
+    return _intake_status(dispatcher)
+
+
+async def resume(dispatcher, **data) -> dict:
+    "Resume intake for the given channel, or for all channels, and process the tasks held meanwhile"
+    released = await dispatcher.resume_intake(channel=data.get('channel'))
+    return dict(_intake_status(dispatcher), released=released)
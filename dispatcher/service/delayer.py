@@ -0,0 +1,180 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Any, Callable, Coroutine, Optional
+
+from .store import LocalStore
+from .task_index import TaskIndex
+
+logger = logging.getLogger(__name__)
+
+
+class DelayCapsule:
+    "Holds a message until its delay has passed, as in, a time capsule"
+
+    __slots__ = ('uuid', 'delay', 'message', 'deadline', 'seq', 'canceled')
+
+    def __init__(self, message: dict, deadline: float, seq: int) -> None:
+        self.uuid: str = message['uuid']
+        self.delay: float = message['delay']
+        self.message = message
+        self.deadline = deadline  # time.monotonic() value when this should run
+        self.seq = seq  # tie breaker, so messages with the same deadline run in order received
+        self.canceled = False
+
+    def __lt__(self, other: 'DelayCapsule') -> bool:
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+
+class Delayer:
+    """Holds delayed messages until they are due, woken up by a single timer task
+
+    Capsules are kept in a min-heap ordered by deadline, and indexed by uuid.
+    Canceling removes the capsule from the index right away, but leaves it in the heap
+    until it expires, or until canceled entries make up most of the heap.
+    If a store is given, waiting messages are saved to it so they survive a restart.
+    The store keeps one message per uuid, so of capsules sharing a uuid only the latest is saved.
+    """
+
+    compact_min_canceled = 64
+
+    def __init__(self, store: Optional[LocalStore] = None) -> None:
+        self.store = store
+        self.index = TaskIndex()  # capsules still waiting, by uuid in order received, and by task
+        self._heap: list[DelayCapsule] = []
+        self._canceled_ct = 0
+        self._seq = 0
+        self.timer_task: Optional[asyncio.Task] = None
+        self.wakeup_event = asyncio.Event()  # earliest deadline may have changed
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def capsules(self) -> list[DelayCapsule]:
+        return self.index.entries()
+
+    def add(self, message: dict) -> DelayCapsule:
+        uuid = message['uuid']
+        if uuid in self.index.by_uuid:
+            logger.warning(f'Delayed task (uuid={uuid}) has the same uuid as another waiting delayed task, keeping both')
+
+        capsule = DelayCapsule(message, time.monotonic() + message['delay'], self._seq)
+        self._seq += 1
+        heapq.heappush(self._heap, capsule)
+        self.index.add(message, capsule)
+        if self.store:
+            self.store.put_delayed(message, time.time() + message['delay'])
+
+        if self._heap[0] is capsule:
+            self.wakeup_event.set()  # new earliest deadline, timer needs to re-arm
+        return capsule
+
+    def cancel(self, uuid: str) -> list[DelayCapsule]:
+        "Cancel every capsule with this uuid, returning them"
+        capsules = self.index.for_uuid(uuid)
+        for capsule in capsules:
+            self.cancel_capsule(capsule)
+        return capsules
+
+    def forget(self, capsule: DelayCapsule) -> None:
+        "Remove the capsule from the index and the store, where another capsule with the same uuid is saved in its place"
+        self.index.remove(capsule.message, capsule)
+        if self.store:
+            if (other := self.index.get(capsule.uuid)) is not None:
+                self.store.put_delayed(other.message, time.time() + max(other.deadline - time.monotonic(), 0.0))
+            else:
+                self.store.remove_delayed(capsule.uuid)
+
+    def cancel_capsule(self, capsule: DelayCapsule) -> None:
+        self.forget(capsule)
+        capsule.canceled = True
+        self._canceled_ct += 1
+        if self._canceled_ct > self.compact_min_canceled and self._canceled_ct > len(self._heap) // 2:
+            self._heap = [other for other in self._heap if not other.canceled]
+            heapq.heapify(self._heap)
+            self._canceled_ct = 0
+
+    def pop_expired(self, current_time: float) -> list[DelayCapsule]:
+        "Remove and return all capsules whose deadline has passed, in deadline order"
+        expired = []
+        while self._heap and self._heap[0].deadline <= current_time:
+            capsule = heapq.heappop(self._heap)
+            if capsule.canceled:
+                self._canceled_ct -= 1
+                continue
+            self.forget(capsule)
+            expired.append(capsule)
+        return expired
+
+    def next_deadline(self) -> Optional[float]:
+        while self._heap and self._heap[0].canceled:
+            heapq.heappop(self._heap)
+            self._canceled_ct -= 1
+        if self._heap:
+            return self._heap[0].deadline
+        return None
+
+    def pop_waiting(self) -> list[DelayCapsule]:
+        "Remove and return all capsules still waiting, in deadline order, to hand them off on shutdown"
+        waiting = sorted(self.capsules)
+        self.index = TaskIndex()
+        self._heap = []
+        self._canceled_ct = 0
+        return waiting
+
+    def restore(self, capsules: list[DelayCapsule]) -> None:
+        "Put back capsules taken by pop_waiting, with their original deadlines"
+        for capsule in capsules:
+            heapq.heappush(self._heap, capsule)
+            self.index.add(capsule.message, capsule)
+        if capsules:
+            self.wakeup_event.set()
+
+    async def run_forever(self, process_message: Callable[[dict], Coroutine[Any, Any, Any]]) -> None:
+        "The single timer task, sleeps until the next deadline or until a new earlier deadline is added"
+        while True:
+            self.wakeup_event.clear()
+            for capsule in self.pop_expired(time.monotonic()):
+                logger.debug(f'Wakeup for delayed task: {capsule.message}')
+                try:
+                    await process_message(capsule.message)
+                except Exception:
+                    logger.exception(f'Error processing delayed task (uuid={capsule.uuid})')
+
+            deadline = self.next_deadline()
+            if deadline is None:
+                await self.wakeup_event.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self.wakeup_event.wait(), timeout=max(deadline - time.monotonic(), 0.0))
+                except asyncio.TimeoutError:
+                    pass  # will handle in next loop run
+
+    def start(self, dispatcher) -> None:
+        self.timer_task = asyncio.create_task(self.run_forever(dispatcher.process_message_internal), name='delayer_task')
+        self.timer_task.add_done_callback(dispatcher.fatal_error_callback)
+
+    async def shutdown(self) -> None:
+        if self.timer_task:
+            self.timer_task.cancel()
+            try:
+                await self.timer_task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # traceback logged in fatal callback
+                if not hasattr(self.timer_task, '_dispatcher_tb_logged'):
+                    logger.exception('Delayer shutdown saw an unexpected exception from timer task')
+            self.timer_task = None
+
+        if self.capsules:
+            uuids = [capsule.uuid for capsule in self.capsules]
+            if self.store:
+                logger.info(f'Delayed tasks left in local store for next start, uuids: {uuids}')
+            else:
+                logger.info(f'Canceled delayed tasks for shutdown, uuids: {uuids}')
+        self.index = TaskIndex()
+        self._heap = []
+        self._canceled_ct = 0
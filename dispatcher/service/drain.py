@@ -0,0 +1,139 @@
+import asyncio
+import json
+import logging
+import time
+from typing import TYPE_CHECKING, Optional
+
+from ..brokers.base import BaseBroker
+
+if TYPE_CHECKING:
+    from .main import DispatcherMain
+
+logger = logging.getLogger(__name__)
+
+
+# Set by the service when a message is received or queued, the node that picks up a handoff sets its own
+SERVICE_FIELDS = ('channel', 'time_received', 'time_queued', 'time_dispatched')
+
+
+def handoff_message(message: dict, delay: Optional[float] = None) -> dict:
+    "Copy of message to publish again, without fields set by this service, counting the handoff"
+    data = {k: v for k, v in message.items() if k not in SERVICE_FIELDS and k != 'delay'}
+    if delay:
+        data['delay'] = delay
+    data['handoffs'] = message.get('handoffs', 0) + 1
+    return data
+
+
+class Drainer:
+    """Stops a node gracefully, handing off the work it will not get to
+
+    On shutdown, after the producers stop, no queued task is started and running tasks get up to
+    timeout seconds to finish. Then queued tasks, tasks held by paused intake, and delayed tasks with the delay remaining,
+    are published again on the channel they came in on, so other nodes, or the next process, run them.
+    Tasks routed to this node go to the default channel of the broker instead.
+
+    With a local store, delayed tasks are already saved for the next start on this host, so they stay there,
+    and queued and held tasks are saved to it too if publishing fails. Without one, they are kept and logged as not handed off.
+    Tasks still running after the timeout are canceled as in any other shutdown, and not handed off.
+
+    The broker is only used for publishing, separate from the producers, like for heartbeats.
+    """
+
+    def __init__(self, broker: BaseBroker, timeout: float = 30.0) -> None:
+        if timeout < 0:
+            raise ValueError('Drain timeout can not be negative')
+        self.broker = broker
+        self.timeout = timeout
+        self.handoff_count = 0
+
+    async def wait_for_running(self, dispatcher: 'DispatcherMain') -> bool:
+        "Wait for tasks running in the pool to finish, returns False if some were still running at the timeout"
+        pool = dispatcher.pool
+        deadline = time.monotonic() + self.timeout
+        while pool.get_running_count():
+            pool.events.workers_idle.clear()
+            if not pool.get_running_count():
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(pool.events.workers_idle.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def get_channel(self, dispatcher: 'DispatcherMain', message: dict) -> Optional[str]:
+        channel = message.get('channel')
+        if dispatcher.heartbeat and channel == dispatcher.heartbeat.route_channel:
+            return None  # no other node listens there
+        return channel
+
+    def take_queued(self, dispatcher: 'DispatcherMain') -> list[dict]:
+        pool = dispatcher.pool
+        queued = list(pool.queued_messages)
+        for message in queued:
+            pool.remove_queued(message)
+        return queued
+
+    def persist(self, dispatcher: 'DispatcherMain', queued: list[dict], held: list[dict]) -> None:
+        "Save queued and held tasks that could not be handed off in the local store, to run at the next start"
+        assert dispatcher.store is not None
+        current_time = time.time()
+        for message in queued:
+            dispatcher.store.put_delayed(handoff_message(message), current_time)
+        for message in held:
+            dispatcher.store.put_delayed(handoff_message(message), current_time + (message.get('delay') or 0.0))
+        uuids = [message.get('uuid') for message in queued + held]
+        logger.warning(f'Saved queued tasks in the local store for the next start, uuids: {uuids}')
+
+    async def handoff(self, dispatcher: 'DispatcherMain') -> int:
+        "Publish queued tasks, and delayed tasks if there is no store, returns the number published"
+        queued = self.take_queued(dispatcher)
+        messages = [(self.get_channel(dispatcher, message), json.dumps(handoff_message(message))) for message in queued]
+        held, dispatcher.held_messages = dispatcher.held_messages, []
+        # held while intake was paused, so any delay has not started yet
+        messages.extend((self.get_channel(dispatcher, message), json.dumps(handoff_message(message, delay=message.get('delay')))) for message in held)
+        delayed = []
+        if not dispatcher.store:
+            current_time = time.monotonic()
+            delayed = dispatcher.delayer.pop_waiting()
+            for capsule in delayed:
+                remaining = max(capsule.deadline - current_time, 0.0)
+                messages.append((self.get_channel(dispatcher, capsule.message), json.dumps(handoff_message(capsule.message, delay=remaining))))
+        if not messages:
+            return 0
+
+        try:
+            await self.broker.apublish_many(messages)
+        except Exception:
+            logger.exception(f'Failed to hand off {len(messages)} tasks')
+            if dispatcher.store:
+                self.persist(dispatcher, queued, held)
+            else:
+                # kept where they were, for the shutdown logs
+                for message in queued:
+                    dispatcher.pool.queue_message(message)
+                dispatcher.held_messages = held
+                dispatcher.delayer.restore(delayed)
+                uuids = [message.get('uuid') for message in queued + held] + [capsule.uuid for capsule in delayed]
+                logger.error(f'Tasks were not handed off, and without a local store they are lost at shutdown, uuids: {uuids}')
+            return 0
+
+        self.handoff_count += len(messages)
+        logger.info(f'Handed off {len(queued) + len(held)} queued and {len(delayed)} delayed tasks to other nodes')
+        return len(messages)
+
+    async def drain(self, dispatcher: 'DispatcherMain') -> None:
+        "Called on shutdown after the producers stopped, before the pool stops"
+        pool = dispatcher.pool
+        pool.draining = True
+        logger.info(f'Draining, waiting up to {self.timeout} seconds for {pool.get_running_count()} running tasks')
+        if not await self.wait_for_running(dispatcher):
+            uuids = [message.get('uuid', '<unknown>') for message in pool.running_tasks()]
+            logger.warning(f'Tasks still running after the drain timeout of {self.timeout} seconds will be canceled, uuids: {uuids}')
+        try:
+            await self.handoff(dispatcher)
+        finally:
+            await self.broker.aclose()
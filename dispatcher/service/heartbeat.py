@@ -0,0 +1,86 @@
+import asyncio
+import json
+import logging
+from typing import TYPE_CHECKING, Optional
+
+from ..brokers.base import BaseBroker
+from ..nodes import HEARTBEAT_CHANNEL
+from .metrics import LatencyHistogram
+
+if TYPE_CHECKING:
+    from .main import DispatcherMain
+
+logger = logging.getLogger(__name__)
+
+
+class Heartbeat:
+    """Announces this node and its load on the heartbeat channel, so clients can discover the live nodes
+
+    The broker is only used for publishing, separate from the producers,
+    because a pg_notify connection that is listening can not send until it gets a message.
+    Heartbeats are best-effort, a failed send is logged and the next one is tried on schedule.
+
+    If route_channel is given, the node also listens on that channel of its own,
+    which publishers use to send tasks to this node when routing by load.
+    """
+
+    def __init__(self, broker: BaseBroker, interval: float = 10.0, channel: str = HEARTBEAT_CHANNEL, route_channel: Optional[str] = None) -> None:
+        if interval <= 0:
+            raise ValueError('Heartbeat interval must be positive')
+        self.broker = broker
+        self.interval = interval
+        self.channel = channel
+        self.route_channel = route_channel
+        self.sent_count = 0
+        self.beat_task: Optional[asyncio.Task] = None
+
+    def get_message(self, dispatcher: 'DispatcherMain', stopping: bool = False) -> str:
+        pool = dispatcher.pool
+        data: dict = {'heartbeat': dispatcher.node_id, 'interval': self.interval}
+        if stopping:
+            data['stopping'] = True
+            return json.dumps(data)
+
+        running = pool.get_running_count()
+        recent_wait, pool.recent_wait = pool.recent_wait, LatencyHistogram()
+        data['load'] = {
+            'free': max(pool.max_workers - running, 0),
+            'running': running,
+            'queued': len(pool.queued_messages),
+            'delayed': len(dispatcher.delayer),
+            'workers': len(pool.workers),
+            'max_workers': pool.max_workers,
+            'p95_wait': round(recent_wait.percentile(95), 6),  # since the last heartbeat
+        }
+        if dispatcher.rebalancer:
+            data['load']['accepting'] = dispatcher.rebalancer.is_accepting(dispatcher)
+        if self.route_channel:
+            data['route_channel'] = self.route_channel
+            data['channels'] = [channel for channel in getattr(self.broker, 'channels', ()) if channel != self.route_channel]
+        return json.dumps(data)
+
+    async def send(self, dispatcher: 'DispatcherMain', stopping: bool = False) -> None:
+        try:
+            await self.broker.apublish_message(channel=self.channel, message=self.get_message(dispatcher, stopping=stopping))
+            self.sent_count += 1
+        except Exception:
+            logger.exception(f'Failed to send heartbeat on {self.channel}')
+
+    async def beat_forever(self, dispatcher: 'DispatcherMain') -> None:
+        while True:
+            await self.send(dispatcher)
+            await asyncio.sleep(self.interval)
+
+    async def start(self, dispatcher: 'DispatcherMain') -> None:
+        self.beat_task = asyncio.create_task(self.beat_forever(dispatcher), name='heartbeat_task')
+
+    async def shutdown(self, dispatcher: 'DispatcherMain') -> None:
+        if self.beat_task:
+            self.beat_task.cancel()
+            try:
+                await self.beat_task
+            except asyncio.CancelledError:
+                pass
+            self.beat_task = None
+            await self.send(dispatcher, stopping=True)  # clients forget this node now, not after missed heartbeats
+        await self.broker.aclose()
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import TYPE_CHECKING, Optional
+
+from .metrics import Counter, Histogram, LatencyHistogram
+
+if TYPE_CHECKING:
+    from .main import DispatcherMain
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """Measures how late the event loop of the service wakes up, and finds what blocked it
+
+    A task sleeps for interval seconds at a time, and records how much later than scheduled it woke up.
+    Everything in the service shares the one loop, so this lag is added to all intake, dispatch and control.
+
+    A watchdog thread checks that the sampler keeps waking up. If it is late by more than slow_threshold,
+    the thread captures the stack of the loop thread, which is the code blocking it at that moment.
+    The latest max_slow slow callbacks are kept with their lag and that stack.
+
+    Forking while another thread runs is unsafe, and a process manager using the fork context forks
+    workers from the service at any time, for scale-up and recycling, not only at start.
+    So by default the watchdog only runs if workers are started some other way, like with ForkServerManager.
+    Without it, slow callbacks are recorded without their stack. use_watchdog=True runs it anyway.
+    """
+
+    def __init__(
+        self, interval: float = 0.1, slow_threshold: float = 0.1, max_slow: int = 50, stack_depth: int = 5, use_watchdog: Optional[bool] = None
+    ) -> None:
+        if interval <= 0 or slow_threshold <= 0:
+            raise ValueError('Loop monitor interval and slow_threshold must be positive')
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.stack_depth = stack_depth
+        self.use_watchdog = use_watchdog  # None decides from the process manager of the pool
+        self.lag = Histogram('dispatcher_loop_lag_seconds', 'How much later than scheduled the service event loop woke up')
+        self.lag_summary = LatencyHistogram()  # for percentiles in the control command
+        self.slow_callbacks: deque[dict] = deque(maxlen=max_slow)
+        self.slow_count = 0
+
+        # Shared with the watchdog thread, each tick is one wakeup of the sampler
+        self.tick = 0
+        self.tick_deadline = 0.0  # time.monotonic() the current tick is due
+        self.stall: Optional[tuple[int, list[str]]] = None  # tick and loop thread stack, captured by the watchdog
+        self.loop_thread_id: Optional[int] = None
+        self.sample_task: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    def metrics(self) -> list:
+        return [
+            self.lag,
+            Counter('dispatcher_loop_slow_callbacks_total', 'Event loop wakeups late by more than the slow threshold', collect=lambda: self.slow_count),
+        ]
+
+    def record(self, tick: int, lag: float) -> None:
+        self.lag.observe(lag)
+        self.lag_summary.record(lag)
+        if lag < self.slow_threshold:
+            return
+        self.slow_count += 1
+        stall = self.stall
+        source = stall[1] if (stall and stall[0] == tick) else []
+        self.slow_callbacks.append({'lag': lag, 'time': time.time(), 'source': source})
+        logger.warning(f'Event loop blocked for {lag:.3f} seconds, in: {source[-1] if source else "<not captured>"}')
+
+    async def sample_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self.tick += 1
+            tick = self.tick
+            expected = loop.time() + self.interval
+            self.tick_deadline = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.record(tick, max(loop.time() - expected, 0.0))
+
+    def capture_stack(self) -> list[str]:
+        frame = sys._current_frames().get(self.loop_thread_id) if self.loop_thread_id else None
+        if frame is None:
+            return []
+        return [f'{entry.filename}:{entry.lineno} in {entry.name}' for entry in traceback.extract_stack(frame, limit=self.stack_depth)]
+
+    def watch_forever(self) -> None:
+        while not self.stop_event.wait(self.slow_threshold / 2):
+            tick = self.tick
+            if tick and time.monotonic() - self.tick_deadline > self.slow_threshold and not (self.stall and self.stall[0] == tick):
+                self.stall = (tick, self.capture_stack())
+
+    def summary(self) -> dict:
+        return {'lag': self.lag_summary.summary(), 'slow_count': self.slow_count, 'slow_callbacks': list(self.slow_callbacks)}
+
+    def start_watchdog(self) -> None:
+        self.stop_event.clear()
+        self.watchdog = threading.Thread(target=self.watch_forever, name='dispatcher_loop_watchdog', daemon=True)
+        self.watchdog.start()
+
+    async def start(self, dispatcher: 'DispatcherMain') -> None:
+        self.loop_thread_id = threading.get_ident()
+        use_watchdog = self.use_watchdog
+        if use_watchdog is None:
+            use_watchdog = dispatcher.pool.process_manager.mp_context != 'fork'
+        if use_watchdog:
+            self.start_watchdog()
+        self.sample_task = asyncio.create_task(self.sample_forever(), name='loop_monitor_task')
+        self.sample_task.add_done_callback(dispatcher.fatal_error_callback)
+
+    async def shutdown(self) -> None:
+        self.stop_event.set()
+        if self.sample_task:
+            self.sample_task.cancel()
+            try:
+                await self.sample_task
+            except asyncio.CancelledError:
+                pass
+            self.sample_task = None
+        self.watchdog = None
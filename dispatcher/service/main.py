@@ -2,13 +2,20 @@ import asyncio
 import json
 import logging
 import signal
-from types import SimpleNamespace
+import time
 from typing import Iterable, Optional
 from uuid import uuid4
 
 from ..producers import BaseProducer
 from . import control_tasks
+from .delayer import Delayer
+from .drain import Drainer
+from .heartbeat import Heartbeat
+from .loop_monitor import LoopMonitor
+from .metrics import Counter, Gauge, Histogram, MetricsRegistry, MetricsServer
 from .pool import WorkerPool
+from .rebalancer import Rebalancer
+from .store import LocalStore
 
 logger = logging.getLogger(__name__)
 
@@ -21,11 +28,27 @@ class DispatcherEvents:
 
 
 class DispatcherMain:
-    def __init__(self, producers: Iterable[BaseProducer], pool: WorkerPool, node_id: Optional[str] = None):
-        self.delayed_messages: list[SimpleNamespace] = []
+    def __init__(
+        self,
+        producers: Iterable[BaseProducer],
+        pool: WorkerPool,
+        node_id: Optional[str] = None,
+        store: Optional[LocalStore] = None,
+        metrics_server: Optional[MetricsServer] = None,
+        heartbeat: Optional[Heartbeat] = None,
+        rebalancer: Optional[Rebalancer] = None,
+        drainer: Optional[Drainer] = None,
+        loop_monitor: Optional[LoopMonitor] = None,
+    ):
+        self.store = store  # optional persistence of delayed messages and schedule state
+        self.delayer = Delayer(store=store)
         self.received_count = 0
         self.control_count = 0
         self.shutting_down = False
+        # Task intake can be paused by control commands, for all channels or some, tasks received meanwhile are held
+        self.intake_paused = False
+        self.paused_channels: set[str] = set()
+        self.held_messages: list[dict] = []
         # Lock for file descriptor mgmnt - hold lock when forking or connecting, to avoid DNS hangs
         # psycopg is well-behaved IFF you do not connect while forking, compare to AWX __clean_on_fork__
         self.fd_lock = asyncio.Lock()
@@ -43,6 +66,85 @@ class DispatcherMain:
 
         self.events: DispatcherEvents = DispatcherEvents()
 
+        # Optional announcements of this node on a shared channel, for discovery by clients
+        self.heartbeat = heartbeat
+        # Optional moving of queued tasks to idle nodes, which needs the heartbeats
+        self.rebalancer = rebalancer
+        # Optional graceful shutdown, letting running tasks finish and handing off queued tasks
+        self.drainer = drainer
+
+        # Optional measuring of the lag of the event loop shared by everything here
+        self.loop_monitor = loop_monitor
+
+        # Metrics are always collected, but only served if a metrics server is given
+        self.metrics_server = metrics_server
+        self.broker_lag = Histogram('dispatcher_broker_lag_seconds', 'Time from a task being published to it being received by the service')
+        self.metrics = MetricsRegistry()
+        self.register_metrics()
+
+    def register_metrics(self) -> None:
+        "Counters and gauges here read existing attributes when rendered, so nothing extra is done in the hot path"
+        pool = self.pool
+        for metric in (
+            Counter('dispatcher_messages_received_total', 'Messages received from all producers', collect=lambda: self.received_count),
+            Counter('dispatcher_control_actions_total', 'Control actions ran by this service', collect=lambda: self.control_count),
+            Counter('dispatcher_tasks_produced_total', 'Tasks submitted by each type of producer', labelnames=('producer',), collect=self.produced_counts),
+            Counter('dispatcher_tasks_finished_total', 'Tasks that finished running in a worker', collect=lambda: pool.finished_count),
+            Counter('dispatcher_tasks_canceled_total', 'Tasks canceled while running in a worker', collect=lambda: pool.canceled_count),
+            Counter('dispatcher_tasks_discarded_total', 'Tasks discarded due to their on_duplicate setting', collect=lambda: pool.discard_count),
+            Gauge('dispatcher_queued_tasks', 'Tasks waiting in the pool queue', collect=lambda: len(pool.queued_messages)),
+            Gauge('dispatcher_running_tasks', 'Tasks currently running in a worker', collect=pool.get_running_count),
+            Gauge('dispatcher_delayed_tasks', 'Tasks waiting for their delay to pass', collect=lambda: len(self.delayer)),
+            Gauge('dispatcher_held_tasks', 'Tasks received while intake is paused', collect=lambda: len(self.held_messages)),
+            Gauge('dispatcher_workers', 'Number of workers by status', labelnames=('status',), collect=self.worker_status_counts),
+            self.broker_lag,
+            pool.dispatch_latency,
+            pool.task_runtime,
+            Counter(
+                'dispatcher_task_cpu_seconds_total',
+                'CPU time used by tasks, by task name',
+                labelnames=('task', 'mode'),
+                collect=pool.task_resources.cpu_seconds,
+            ),
+        ):
+            self.metrics.register(metric)
+        if self.loop_monitor:
+            for metric in self.loop_monitor.metrics():
+                self.metrics.register(metric)
+        if cluster := pool.cluster_duplicates:
+            self.metrics.register(Gauge('dispatcher_cluster_leases', 'Task leases held by this node for on_duplicate rules', collect=lambda: len(cluster.held)))
+            self.metrics.register(
+                Counter('dispatcher_cluster_blocked_total', 'Tasks held back because they were running on another node', collect=lambda: cluster.blocked_count)
+            )
+            self.metrics.register(
+                Counter(
+                    'dispatcher_cluster_errors_total',
+                    'Errors using the lease table, when tasks ran under local rules only',
+                    collect=lambda: cluster.error_count,
+                )
+            )
+        if heartbeat := self.heartbeat:
+            self.metrics.register(Counter('dispatcher_heartbeats_sent_total', 'Heartbeats announcing this node', collect=lambda: heartbeat.sent_count))
+        if rebalancer := self.rebalancer:
+            self.metrics.register(Counter('dispatcher_tasks_rebalanced_total', 'Queued tasks sent to idle nodes', collect=lambda: rebalancer.sent_count))
+        if drainer := self.drainer:
+            self.metrics.register(
+                Counter('dispatcher_tasks_handed_off_total', 'Queued and delayed tasks published again on shutdown', collect=lambda: drainer.handoff_count)
+            )
+
+    def produced_counts(self) -> dict[tuple[str, ...], float]:
+        counts: dict[tuple[str, ...], float] = {}
+        for producer in self.producers:
+            key = (type(producer).__name__,)
+            counts[key] = counts.get(key, 0) + producer.produced_count
+        return counts
+
+    def worker_status_counts(self) -> dict[tuple[str, ...], float]:
+        counts: dict[tuple[str, ...], float] = {}
+        for worker in self.pool.workers.values():
+            counts[(worker.status,)] = counts.get((worker.status,), 0) + 1
+        return counts
+
     def fatal_error_callback(self, *args) -> None:
         """Method to connect to error callbacks of other tasks, will kick out of main loop"""
         if self.shutting_down:
@@ -73,23 +175,34 @@ class DispatcherMain:
 
     async def shutdown(self) -> None:
         self.shutting_down = True
+        if self.rebalancer:
+            try:
+                await self.rebalancer.shutdown()
+            except Exception:
+                logger.exception('Rebalancer had error')
+        if self.heartbeat:
+            try:
+                await self.heartbeat.shutdown(self)
+            except Exception:
+                logger.exception('Heartbeat had error')
         logger.debug("Shutting down, starting with producers.")
         for producer in self.producers:
             try:
                 await producer.shutdown()
             except Exception:
                 logger.exception('Producer task had error')
-        if self.delayed_messages:
-            logger.debug('Shutting down delayed messages')
-            for capsule in self.delayed_messages:
-                capsule.task.cancel()
-                try:
-                    await capsule.task
-                except asyncio.CancelledError:
-                    logger.info(f'Canceled delayed task (uuid={capsule.uuid}) for shutdown')
-                except Exception:
-                    logger.exception(f'Error shutting down delayed task (uuid={capsule.uuid})')
-            self.delayed_messages = []
+        if self.drainer:
+            try:
+                await self.drainer.drain(self)
+            except Exception:
+                logger.exception('Drain had error')
+        if self.metrics_server:
+            try:
+                await self.metrics_server.shutdown()
+            except Exception:
+                logger.exception('Metrics server had error')
+        logger.debug('Shutting down delayed messages')
+        await self.delayer.shutdown()
 
         logger.debug('Gracefully shutting down worker pool')
         try:
@@ -97,28 +210,30 @@ class DispatcherMain:
         except Exception:
             logger.exception('Pool manager encountered error')
 
+        if self.held_messages:
+            uuids = [message['uuid'] for message in self.held_messages]
+            logger.error(f'Dispatcher shut down with tasks held by paused intake, uuids: {uuids}')
+
+        if self.store:
+            logger.debug('Flushing local store')
+            try:
+                await self.store.shutdown()
+            except Exception:
+                logger.exception('Local store encountered error')
+
+        if self.loop_monitor:
+            await self.loop_monitor.shutdown()
+
         logger.debug('Setting event to exit main loop')
         self.events.exit_event.set()
 
     async def connected_callback(self, producer: BaseProducer) -> None:
         return
 
-    async def sleep_then_process(self, capsule: SimpleNamespace) -> None:
-        logger.info(f'Delaying {capsule.delay} s before running task: {capsule.message}')
-        await asyncio.sleep(capsule.delay)
-        logger.debug(f'Wakeup for delayed task: {capsule.message}')
-        await self.process_message_internal(capsule.message)
-        if capsule in self.delayed_messages:
-            self.delayed_messages.remove(capsule)
-            logger.info(f'fully processed delayed task (uuid={capsule.uuid})')
-
     def create_delayed_task(self, message: dict) -> None:
         "Called as alternative to sending to worker now, send to worker later"
-        # capsule, as in, time capsule
-        capsule = SimpleNamespace(uuid=message['uuid'], delay=message['delay'], message=message, task=None)
-        new_task = asyncio.create_task(self.sleep_then_process(capsule))
-        capsule.task = new_task
-        self.delayed_messages.append(capsule)
+        logger.info(f'Delaying {message["delay"]} s before running task: {message}')
+        self.delayer.add(message)
 
     async def process_message(
         self, payload: dict, producer: Optional[BaseProducer] = None, channel: Optional[str] = None
@@ -143,12 +258,24 @@ class DispatcherMain:
             return (None, None)
 
         # A client may provide a task uuid (hope they do it correctly), if not add it
+        # random, because a count restarts with the service and would collide with tasks restored from the store
         if 'uuid' not in message:
-            message['uuid'] = f'internal-{self.received_count}'
+            message['uuid'] = f'internal-{uuid4()}'
         if channel:
             message['channel'] = channel
         self.received_count += 1
+        message['time_received'] = time.time()
+        if 'time_pub' in message:
+            self.broker_lag.observe(max(message['time_received'] - message['time_pub'], 0.0))
 
+        if 'control' not in message and self.is_paused(message):
+            logger.info(f'Holding task (uuid={message["uuid"]}) because intake is paused, held_ct={len(self.held_messages) + 1}')
+            self.held_messages.append(message)
+            return (None, None)
+
+        return await self.accept_message(message, producer=producer)
+
+    async def accept_message(self, message: dict, producer: Optional[BaseProducer] = None) -> tuple[Optional[str], Optional[str]]:
         if 'delay' in message:
             # NOTE: control messages with reply should never be delayed, document this for users
             self.create_delayed_task(message)
@@ -156,7 +283,36 @@ class DispatcherMain:
             return await self.process_message_internal(message, producer=producer)
         return (None, None)
 
-    async def run_control_action(self, action: str, control_data: Optional[dict] = None, reply_to: Optional[str] = None) -> tuple[Optional[str], Optional[str]]:
+    def is_paused(self, message: dict) -> bool:
+        return self.intake_paused or (message.get('channel') in self.paused_channels)
+
+    def pause_intake(self, channel: Optional[str] = None) -> None:
+        "Hold tasks received on channel, or on any channel if not given, control messages still run"
+        if channel is None:
+            self.intake_paused = True
+        else:
+            self.paused_channels.add(channel)
+        logger.warning(f'Paused task intake for {channel or "all channels"}')
+
+    async def resume_intake(self, channel: Optional[str] = None) -> int:
+        "Undo pause_intake, resuming everything if channel is not given, returns the number of held tasks released"
+        if channel is None:
+            self.intake_paused = False
+            self.paused_channels.clear()
+        else:
+            self.paused_channels.discard(channel)
+        logger.warning(f'Resumed task intake for {channel or "all channels"}')
+
+        released = [message for message in self.held_messages if not self.is_paused(message)]
+        if released:
+            self.held_messages = [message for message in self.held_messages if self.is_paused(message)]
+            for message in released:
+                await self.accept_message(message)
+        return len(released)
+
+    async def run_control_action(
+        self, action: str, control_data: Optional[dict] = None, reply_to: Optional[str] = None, correlation_id: Optional[str] = None
+    ) -> tuple[Optional[str], Optional[str]]:
         return_data = {}
 
         # Get the result
@@ -172,6 +328,8 @@ class DispatcherMain:
 
         # Identify the current node in the response
         return_data['node_id'] = self.node_id
+        if correlation_id:
+            return_data['correlation_id'] = correlation_id  # lets a client with one reply channel match the reply to its request
         self.control_count += 1
 
         # Give Nones for no reply, or the reply
@@ -185,12 +343,28 @@ class DispatcherMain:
     async def process_message_internal(self, message: dict, producer=None) -> tuple[Optional[str], Optional[str]]:
         """Route message based on needed action - delay for later, return reply, or dispatch to worker"""
         if 'control' in message:
-            return await self.run_control_action(message['control'], control_data=message.get('control_data'), reply_to=message.get('reply_to'))
+            return await self.run_control_action(
+                message['control'], control_data=message.get('control_data'), reply_to=message.get('reply_to'), correlation_id=message.get('correlation_id')
+            )
         else:
             await self.pool.dispatch_task(message)
         return (None, None)
 
     async def start_working(self) -> None:
+        if self.store:
+            await self.store.start(self)
+            for message in self.store.pending_delayed():
+                message['time_received'] = time.time()  # delay was adjusted to the time remaining from now
+                self.delayer.add(message)
+        self.delayer.start(self)
+
+        if self.metrics_server:
+            try:
+                await self.metrics_server.start(self.metrics)
+            except Exception:
+                logger.exception(f'Metrics server {self.metrics_server} failed to start')
+                self.events.exit_event.set()
+
         logger.debug('Filling the worker pool')
         try:
             await self.pool.start_working(self)
@@ -198,6 +372,9 @@ class DispatcherMain:
             logger.exception(f'Pool {self.pool} failed to start working')
             self.events.exit_event.set()
 
+        if self.loop_monitor:
+            await self.loop_monitor.start(self)
+
         logger.debug('Starting task production')
         async with self.fd_lock:  # lots of connecting going on here
             for producer in self.producers:
@@ -207,6 +384,11 @@ class DispatcherMain:
                     logger.exception(f'Producer {producer} failed to start')
                     self.events.exit_event.set()
 
+        if self.heartbeat:
+            await self.heartbeat.start(self)
+        if self.rebalancer:
+            await self.rebalancer.start(self)
+
     async def cancel_tasks(self):
         for task in asyncio.all_tasks():
             if task == asyncio.current_task():
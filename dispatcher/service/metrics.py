@@ -0,0 +1,371 @@
+import asyncio
+import bisect
+import logging
+import math
+import os
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+"""Minimal metrics primitives and Prometheus text exposition, with no dependencies
+
+Metrics are plain objects owned by whatever measures them, like the pool.
+The MetricsRegistry only collects them for rendering, and the MetricsServer
+serves the rendered text over HTTP from the service event loop.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+LabelKey = tuple[str, ...]
+# Value callbacks return a single value, or a dict of label values to values for labeled metrics
+CollectCallback = Callable[[], Union[float, dict[LabelKey, float]]]
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(labelnames: Iterable[str], labelvalues: Iterable[str], extra: str = '') -> str:
+    parts = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        parts.append(extra)
+    if not parts:
+        return ''
+    return '{' + ','.join(parts) + '}'
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), collect: Optional[CollectCallback] = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect  # if given, values are read from this at render time
+        self.values: dict[LabelKey, float] = {}
+
+    def label_key(self, labels: dict[str, str]) -> LabelKey:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get(self, **labels) -> float:
+        return self.current_values().get(self.label_key(labels), 0.0)
+
+    def current_values(self) -> dict[LabelKey, float]:
+        if self.collect is None:
+            return self.values
+        value = self.collect()
+        if isinstance(value, dict):
+            return value
+        return {(): float(value)}
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.current_values().items():
+            yield f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}'
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self.label_key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self.label_key(labels)] = value
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class HistogramData:
+    __slots__ = ('bucket_counts', 'count', 'sum')
+
+    def __init__(self, bucket_ct: int) -> None:
+        self.bucket_counts = [0] * bucket_ct  # not cumulative, last entry is the +Inf bucket
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames=labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.data: dict[LabelKey, HistogramData] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.label_key(labels)
+        data = self.data.get(key)
+        if data is None:
+            data = self.data[key] = HistogramData(len(self.buckets) + 1)
+        data.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        data.count += 1
+        data.sum += value
+
+    def get_count(self, **labels) -> int:
+        data = self.data.get(self.label_key(labels))
+        return data.count if data else 0
+
+    def samples(self) -> Iterator[str]:
+        for key, data in self.data.items():
+            cumulative = 0
+            for upper, bucket_ct in zip(self.buckets + (math.inf,), data.bucket_counts):
+                cumulative += bucket_ct
+                labels = format_labels(self.labelnames, key, extra=f'le="{format_value(upper)}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {format_value(data.sum)}'
+            yield f'{self.name}_count{labels} {data.count}'
+
+
+class MetricsRegistry:
+    "Collection of metrics to be rendered together"
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        "Prometheus text exposition format, version 0.0.4"
+        blocks = []
+        for metric in self.metrics.values():
+            try:
+                blocks.append(metric.render())
+            except Exception:
+                logger.exception(f'Error collecting metric {metric.name}, skipping it')
+        return '\n'.join(blocks) + '\n'
+
+
+class MetricsServer:
+    """Serves the dispatcher metrics over HTTP, from the service event loop
+
+    If path is given this listens on a Unix domain socket, otherwise on host and port.
+    This only understands GET /metrics, which is what a Prometheus scrape needs.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8070, path: Optional[str] = None, read_timeout: float = 5.0) -> None:
+        self.host = host
+        self.port = port
+        self.path = path
+        self.read_timeout = read_timeout
+        self.registry: Optional[MetricsRegistry] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, registry: MetricsRegistry) -> None:
+        self.registry = registry
+        if self.path:
+            if os.path.exists(self.path):
+                os.unlink(self.path)  # left over from a prior run
+            self.server = await asyncio.start_unix_server(self.handle_request, path=self.path)
+            logger.info(f'Serving metrics on unix socket {self.path}')
+        else:
+            self.server = await asyncio.start_server(self.handle_request, host=self.host, port=self.port)
+            logger.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def read_request_path(self, reader: asyncio.StreamReader) -> Optional[str]:
+        request_line = await reader.readline()
+        parts = request_line.decode('latin-1').split()
+        # Headers are not used, but have to be read so the client is not left mid-send
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if len(parts) < 2 or parts[0] != 'GET':
+            return None
+        return parts[1].split('?', 1)[0]
+
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                request_path = await asyncio.wait_for(self.read_request_path(reader), timeout=self.read_timeout)
+            except (ValueError, asyncio.LimitOverrunError):
+                # readline raises these for a line longer than the stream limit
+                logger.debug('Metrics client sent a request line or header that is too long')
+                status, body = '400 Bad Request', b'Bad Request\n'
+            else:
+                if request_path in ('/metrics', '/') and self.registry:
+                    status, body = '200 OK', self.registry.render().encode('utf-8')
+                else:
+                    status, body = '404 Not Found', b'Not Found\n'
+            headers = f'HTTP/1.1 {status}\r\nContent-Type: {self.CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+            writer.write(headers.encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            logger.debug('Metrics client did not complete request')
+        finally:
+            writer.close()
+
+    async def shutdown(self) -> None:
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class LatencyHistogram:
+    """Log-bucketed histogram for latency percentiles, in the style of HDR histogram
+
+    Bucket bounds grow by a fixed ratio, so any recorded value is known to within that relative error,
+    from microseconds to hours, in a small sparse dict of counts.
+    """
+
+    def __init__(self, min_value: float = 1e-6, ratio: float = 1.02) -> None:
+        self.min_value = min_value
+        self.ratio = ratio
+        self._log_ratio = math.log(ratio)
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def bucket_index(self, value: float) -> int:
+        if value <= self.min_value:
+            return 0
+        return int(math.log(value / self.min_value) / self._log_ratio) + 1
+
+    def bucket_value(self, index: int) -> float:
+        "Representative value for the bucket, the middle of its range"
+        if index == 0:
+            return self.min_value
+        return self.min_value * self.ratio ** (index - 0.5)
+
+    def record(self, value: float) -> None:
+        value = max(value, 0.0)  # clock differences between processes can give tiny negatives
+        index = self.bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, percent: float) -> float:
+        if not self.count:
+            return 0.0
+        target = max(math.ceil(self.count * percent / 100.0), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(max(self.bucket_value(index), self.min), self.max)
+        return self.max
+
+    def summary(self) -> dict[str, float]:
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count,
+            'min': self.min,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class TaskLatency:
+    """Latency histograms for each stage of the task lifecycle, kept per task name
+
+    Task names beyond max_tasks are grouped together, so unbounded dynamic task names can not use unbounded memory.
+    """
+
+    stages = ('publish_to_receive', 'queue_wait', 'dispatch', 'run')
+    other_task = '<other>'
+
+    def __init__(self, max_tasks: int = 1000) -> None:
+        self.max_tasks = max_tasks
+        self.histograms: dict[str, dict[str, LatencyHistogram]] = {}
+
+    def record(self, task: str, stage: str, value: float) -> None:
+        task_histograms = self.histograms.get(task)
+        if task_histograms is None:
+            if len(self.histograms) >= self.max_tasks:
+                task = self.other_task
+            task_histograms = self.histograms.setdefault(task, {})
+        histogram = task_histograms.get(stage)
+        if histogram is None:
+            histogram = task_histograms[stage] = LatencyHistogram()
+        histogram.record(value)
+
+    def summary(self, task: Optional[str] = None) -> dict[str, dict[str, dict[str, float]]]:
+        ret = {}
+        for task_name, task_histograms in self.histograms.items():
+            if task and task_name != task:
+                continue
+            ret[task_name] = {stage: histogram.summary() for stage, histogram in task_histograms.items()}
+        return ret
+
+
+class TaskResources:
+    """Totals of the resources used by tasks as reported by the workers, kept per task name
+
+    Each field is summed, and the largest single task is kept, so expensive tasks stand out
+    both for their total cost and for their worst run.
+    Task names beyond max_tasks are grouped together, as in TaskLatency.
+    """
+
+    other_task = '<other>'
+
+    def __init__(self, max_tasks: int = 1000) -> None:
+        self.max_tasks = max_tasks
+        self.counts: dict[str, int] = {}
+        self.totals: dict[str, dict[str, float]] = {}
+        self.maximums: dict[str, dict[str, float]] = {}
+
+    def record(self, task: str, usage: dict[str, float]) -> None:
+        if task not in self.counts and len(self.counts) >= self.max_tasks:
+            task = self.other_task
+        self.counts[task] = self.counts.get(task, 0) + 1
+        totals = self.totals.setdefault(task, {})
+        maximums = self.maximums.setdefault(task, {})
+        for key, value in usage.items():
+            totals[key] = totals.get(key, 0.0) + value
+            maximums[key] = max(maximums.get(key, value), value)
+
+    def cpu_seconds(self) -> dict[LabelKey, float]:
+        "For a labeled counter of CPU time by task name and mode"
+        ret: dict[LabelKey, float] = {}
+        for task, totals in self.totals.items():
+            for mode in ('user', 'system'):
+                ret[(task, mode)] = totals.get(f'cpu_{mode}', 0.0)
+        return ret
+
+    def summary(self, task: Optional[str] = None, top: Optional[int] = None) -> dict[str, dict]:
+        "Per task usage, most CPU time first, limited to the top tasks if given"
+        names = sorted(self.counts, key=lambda name: -(self.totals[name].get('cpu_user', 0.0) + self.totals[name].get('cpu_system', 0.0)))
+        if task:
+            names = [name for name in names if name == task]
+        if top is not None:
+            names = names[:top]
+        return {
+            name: {
+                'count': self.counts[name],
+                'total': self.totals[name],
+                'mean': {key: value / self.counts[name] for key, value in self.totals[name].items()},
+                'max': self.maximums[name],
+            }
+            for name in names
+        }
@@ -2,18 +2,23 @@ import asyncio
 import logging
 import time
 from asyncio import Task
-from typing import Any, Iterator, Literal, Optional
+from typing import Any, Callable, Iterator, Literal, Optional
 
 from ..utils import DuplicateBehavior, MessageAction
+from .cluster import ClusterDuplicates
+from .metrics import Histogram, LatencyHistogram, TaskLatency, TaskResources
 from .process import ProcessManager, ProcessProxy
+from .profiling import TaskProfiling
+from .task_index import TaskIndex
 
 logger = logging.getLogger(__name__)
 
 
 class PoolWorker:
-    def __init__(self, worker_id: int, process: ProcessProxy) -> None:
+    def __init__(self, worker_id: int, process: ProcessProxy, on_exit: Optional[Callable[['PoolWorker'], None]] = None) -> None:
         self.worker_id = worker_id
         self.process = process
+        self.on_exit = on_exit  # called from the event loop when the process exits, for any reason
         self.current_task: Optional[dict] = None
         self.created_at: float = time.monotonic()
         self.started_at: Optional[float] = None
@@ -25,6 +30,8 @@ class PoolWorker:
         self.finished_count = 0
         self.status: Literal['initialized', 'spawned', 'starting', 'ready', 'stopping', 'exited', 'error', 'retired'] = 'initialized'
         self.exit_msg_event = asyncio.Event()
+        self.process_exited = asyncio.Event()  # set by the event loop when the process sentinel becomes readable
+        self.sentinel_fd: Optional[int] = None
 
     async def start(self) -> None:
         if self.status != 'initialized':
@@ -39,6 +46,24 @@ class PoolWorker:
             return
         logger.debug(f'Worker {self.worker_id} pid={self.process.pid} subprocess has spawned')
         self.status = 'starting'  # Not ready until it sends callback message
+        self.watch_sentinel()
+
+    def watch_sentinel(self) -> None:
+        "Have the event loop tell us when the process exits, so that we never block waiting on it"
+        self.sentinel_fd = self.process.sentinel
+        asyncio.get_running_loop().add_reader(self.sentinel_fd, self.on_process_exit)
+
+    def unwatch_sentinel(self) -> None:
+        if self.sentinel_fd is not None:
+            asyncio.get_running_loop().remove_reader(self.sentinel_fd)
+            self.sentinel_fd = None
+
+    def on_process_exit(self) -> None:
+        "Event loop callback for the process sentinel, the fd stays readable so stop watching it"
+        self.unwatch_sentinel()
+        self.process_exited.set()
+        if self.on_exit:
+            self.on_exit(self)
 
     @property
     def counts_for_capacity(self) -> bool:
@@ -46,12 +71,27 @@ class PoolWorker:
 
     async def start_task(self, message: dict) -> None:
         self.current_task = message  # NOTE: this marks this worker as busy
+        message['time_dispatched'] = time.time()
         self.process.message_queue.put(message)
         self.started_at = time.monotonic()
 
-    async def join(self, timeout=3) -> None:
+    async def join(self, timeout: float = 3) -> None:
+        """Wait for the process to exit, then reap it
+
+        Exit is detected from the process sentinel by the event loop, so this never blocks other work.
+        If the process does not exit within the timeout, this returns without reaping it.
+        """
+        if self.process.pid is None:
+            return  # never started, nothing to join
         logger.debug(f'Joining worker {self.worker_id} pid={self.process.pid} subprocess')
-        self.process.join(timeout)  # argument is timeout
+        if not self.process_exited.is_set():
+            if self.sentinel_fd is None:
+                return  # not watching this process, and can not wait without blocking
+            try:
+                await asyncio.wait_for(self.process_exited.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return
+        self.process.join()  # sentinel fired so the process is exiting, this returns right away
 
     async def signal_stop(self) -> None:
         "Tell the worker to stop and return"
@@ -82,20 +122,19 @@ class PoolWorker:
         await self.join()  # If worker fails to exit, this returns control without raising an exception
 
         for i in range(3):
-            if self.process.is_alive():
-                logger.error(f'Worker {self.worker_id} pid={self.process.pid} is still alive trying SIGKILL, attempt {i}')
-                await asyncio.sleep(1)
-                self.process.kill()
-            else:
-                logger.debug(f'Worker {self.worker_id} pid={self.process.pid} exited code={self.process.exitcode()}')
-                self.status = 'retired'
-                self.retired_at = time.monotonic()
-                return
+            if not self.process.is_alive():
+                break
+            logger.error(f'Worker {self.worker_id} pid={self.process.pid} is still alive trying SIGKILL, attempt {i}')
+            self.process.kill()
+            await self.join(timeout=1)
 
-        logger.critical(f'Worker {self.worker_id} pid={self.process.pid} failed to exit after SIGKILL')
-        self.status = 'error'
         self.retired_at = time.monotonic()
-        return
+        if self.process.is_alive():
+            logger.critical(f'Worker {self.worker_id} pid={self.process.pid} failed to exit after SIGKILL')
+            self.status = 'error'
+        else:
+            logger.debug(f'Worker {self.worker_id} pid={self.process.pid} exited code={self.process.exitcode()}')
+            self.status = 'retired'
 
     def cancel(self) -> None:
         self.is_active_cancel = True  # signal for result callback
@@ -131,11 +170,35 @@ class PoolEvents:
     def __init__(self) -> None:
         self.queue_cleared: asyncio.Event = asyncio.Event()  # queue is now 0 length
         self.work_cleared: asyncio.Event = asyncio.Event()  # Totally quiet, no blocked or queued messages, no busy workers
+        self.workers_idle: asyncio.Event = asyncio.Event()  # No busy workers, there may still be queued messages
         self.management_event: asyncio.Event = asyncio.Event()  # Process spawning is backgrounded, so this is the kicker
         self.timeout_event: asyncio.Event = asyncio.Event()  # Anything that might affect the timeout watcher task
         self.workers_ready: asyncio.Event = asyncio.Event()  # min workers have started and sent ready message
 
 
+class MessageQueue:
+    """Queued messages in the order received, which can be removed from anywhere in constant time
+
+    Messages are keyed by id(), because messages are dicts and two different ones can be equal.
+    """
+
+    def __init__(self) -> None:
+        self.messages: dict[int, dict] = {}
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self.messages.values())
+
+    def append(self, message: dict) -> None:
+        self.messages[id(message)] = message
+
+    def remove(self, message: dict) -> None:
+        if self.messages.pop(id(message), None) is None:
+            raise ValueError(f'Message (uuid={message.get("uuid")}) is not queued')
+
+
 class WorkerPool:
     def __init__(
         self,
@@ -146,16 +209,22 @@ class WorkerPool:
         scaledown_interval: float = 15.0,
         worker_stop_wait: float = 30.0,
         worker_removal_wait: float = 30.0,
+        cluster_duplicates: Optional[ClusterDuplicates] = None,
+        profile_dir: Optional[str] = None,
     ):
         self.min_workers = min_workers
         self.max_workers = max_workers
         self.workers: dict[int, PoolWorker] = {}
         self.next_worker_id = 0
         self.process_manager = process_manager
-        self.queued_messages: list[dict] = []  # TODO: use deque, invent new kinds of logging anxiety
+        self.queued_messages = MessageQueue()
+        # Indexes for control lookups, entries are the worker for running tasks and the message for queued tasks
+        self.running_index = TaskIndex()
+        self.queued_index = TaskIndex()
         self.read_results_task: Optional[Task] = None
         self.start_worker_task: Optional[Task] = None
         self.shutting_down = False
+        self.draining = False  # running tasks may finish, but no queued task starts
         self.finished_count: int = 0
         self.canceled_count: int = 0
         self.discard_count: int = 0
@@ -164,6 +233,14 @@ class WorkerPool:
 
         self.events: PoolEvents = PoolEvents()
 
+        # Timing metrics, owned here and registered with the dispatcher metrics registry
+        self.dispatch_latency = Histogram('dispatcher_dispatch_latency_seconds', 'Time from a task being due to it starting in a worker')
+        self.task_runtime = Histogram('dispatcher_task_runtime_seconds', 'Time a task took to run in the worker')
+        self.task_latency = TaskLatency()  # per task name, for the latency control command
+        self.task_resources = TaskResources()  # per task name, as reported by workers, for the resources control command
+        self.profiling = TaskProfiling(directory=profile_dir)  # armed by the profile control command
+        self.recent_wait = LatencyHistogram()  # dispatch latency since the last heartbeat, for its load summary
+
         # Track the last time we used X number of workers, like
         # {
         #   0: None,
@@ -177,6 +254,7 @@ class WorkerPool:
         self.scaledown_interval = scaledown_interval  # seconds for poll to see if we should retire workers
         self.worker_stop_wait = worker_stop_wait  # seconds to wait for a worker to exit on its own before SIGTERM, SIGKILL
         self.worker_removal_wait = worker_removal_wait  # after worker process exits, seconds to keep its record, for stats
+        self.cluster_duplicates = cluster_duplicates  # optional, applies on_duplicate across all nodes
 
     @property
     def processed_count(self):
@@ -193,6 +271,10 @@ class WorkerPool:
         self.management_task.add_done_callback(dispatcher.fatal_error_callback)
         self.timeout_task = asyncio.create_task(self.manage_timeout(), name='timeout_task')
         self.timeout_task.add_done_callback(dispatcher.fatal_error_callback)
+        if self.cluster_duplicates:
+            await self.cluster_duplicates.start(self, dispatcher.node_id)
+            if self.cluster_duplicates.maintain_task:
+                self.cluster_duplicates.maintain_task.add_done_callback(dispatcher.fatal_error_callback)
 
     def get_running_count(self) -> int:
         ct = 0
@@ -230,12 +312,23 @@ class WorkerPool:
                 worker_ids.append(new_worker_id)
             logger.info(f'Starting subprocess for workers ids={worker_ids} (prior ct={worker_ct}) to satisfy min_workers')
 
+        elif worker_ct > self.max_workers:
+            # Limit was lowered at runtime, idle workers above it stop now, busy ones once their task finishes
+            async with self.management_lock:
+                excess = worker_ct - self.max_workers
+                idle_workers = [worker for worker in available_workers if worker.current_task is None]
+                for worker in idle_workers[:excess]:
+                    logger.info(f'Scaling down worker id={worker.worker_id} (prior ct={worker_ct}) to satisfy max_workers={self.max_workers}')
+                    await worker.signal_stop()
+
         elif self.active_task_ct() > len(available_workers):
             # have more messages to process than what we have workers
             if worker_ct < self.max_workers:
                 # Scale up, below or to MAX
                 new_worker_id = await self.up()
                 logger.info(f'Started worker id={new_worker_id} (prior ct={worker_ct}) to handle queue pressure')
+                if worker_ct + 1 < self.max_workers:
+                    self.events.management_event.set()  # check again right away, one more worker may not be enough
             else:
                 # At MAX, nothing we can do, but let the user know anyway
                 logger.warning(f'System at max_workers={self.max_workers} and queue pressure detected, capacity may be insufficient')
@@ -250,6 +343,20 @@ class WorkerPool:
                             await worker.signal_stop()
                             break
 
+    def set_limits(self, min_workers: Optional[int] = None, max_workers: Optional[int] = None, scaledown_wait: Optional[float] = None) -> None:
+        "Change the scaling limits at runtime, the management task applies them right away"
+        new_min = self.min_workers if min_workers is None else min_workers
+        new_max = self.max_workers if max_workers is None else max_workers
+        if new_min < 0 or new_max < new_min:
+            raise ValueError(f'Invalid worker limits min_workers={new_min} max_workers={new_max}')
+        if scaledown_wait is not None and scaledown_wait < 0:
+            raise ValueError(f'Invalid scaledown_wait={scaledown_wait}')
+        self.min_workers, self.max_workers = new_min, new_max
+        if scaledown_wait is not None:
+            self.scaledown_wait = scaledown_wait
+        logger.info(f'Worker limits set to min_workers={self.min_workers} max_workers={self.max_workers} scaledown_wait={self.scaledown_wait}')
+        self.events.management_event.set()
+
     async def manage_new_workers(self, forking_lock: asyncio.Lock) -> None:
         """This calls the .start() method to actually fork a new process for initialized workers
 
@@ -272,21 +379,31 @@ class WorkerPool:
         This method will see the updated status, join the process, and remove it from self.workers
         """
         remove_ids = []
+        stop_tasks = []
         for worker in self.workers.values():
             if worker.status == 'exited':
-                await worker.stop()  # happy path
+                stop_tasks.append(worker.stop())  # happy path
             elif worker.status == 'stopping' and worker.stopping_at and (time.monotonic() - worker.stopping_at) > self.worker_stop_wait:
                 logger.warning(f'Worker id={worker.worker_id} failed to respond to stop signal')
-                await worker.stop()  # agressively bring down process
+                stop_tasks.append(worker.stop())  # agressively bring down process
 
             elif worker.status in ['retired', 'error'] and worker.retired_at and (time.monotonic() - worker.retired_at) > self.worker_removal_wait:
                 remove_ids.append(worker.worker_id)
 
+        # Workers are reaped concurrently, so one stuck process does not hold up the others
+        await asyncio.gather(*stop_tasks)
+
+        # A worker that is gone but still holds a task never reported it done, so account for it here
+        for worker in list(self.workers.values()):
+            if worker.status in ('retired', 'error') and worker.current_task and not worker.process.is_alive():
+                await self.process_lost(worker)
+
         # Remove workers from memory, done as separate loop due to locking concerns
         for worker_id in remove_ids:
             async with self.management_lock:
                 if worker_id in self.workers:
                     logger.debug(f'Fully removing worker id={worker_id}')
+                    self.workers[worker_id].unwatch_sentinel()
                     del self.workers[worker_id]
 
     async def manage_workers(self, forking_lock: asyncio.Lock) -> None:
@@ -347,7 +464,7 @@ class WorkerPool:
     async def up(self) -> int:
         new_worker_id = self.next_worker_id
         process = self.process_manager.create_process(kwargs={'worker_id': self.next_worker_id})
-        worker = PoolWorker(new_worker_id, process)
+        worker = PoolWorker(new_worker_id, process, on_exit=self.worker_exited)
         self.workers[new_worker_id] = worker
         self.next_worker_id += 1
         return new_worker_id
@@ -403,6 +520,9 @@ class WorkerPool:
             except asyncio.CancelledError:
                 pass  # intended
 
+        if self.cluster_duplicates:
+            await self.cluster_duplicates.shutdown()
+
         if self.queued_messages:
             uuids = [message.get('uuid', '<unknown>') for message in self.queued_messages]
             logger.error(f'Dispatcher shut down with queued work, uuids: {uuids}')
@@ -415,6 +535,15 @@ class WorkerPool:
                 return candidate_worker
         return None
 
+    def queue_message(self, message: dict) -> None:
+        message.setdefault('time_queued', time.time())  # first time queued, if queued again after failing to dispatch
+        self.queued_messages.append(message)
+        self.queued_index.add(message, message)
+
+    def remove_queued(self, message: dict) -> None:
+        self.queued_messages.remove(message)
+        self.queued_index.remove(message, message)
+
     def running_tasks(self) -> Iterator[dict]:
         for worker in self.workers.values():
             if worker.current_task:
@@ -455,6 +584,9 @@ class WorkerPool:
         elif on_duplicate != DuplicateBehavior.parallel.value:
             logger.warning(f'Got unexpected on_duplicate value {on_duplicate}')
 
+        if self.cluster_duplicates and self.cluster_duplicates.is_held_elsewhere(message):
+            return self.cluster_duplicates.blocked_action(message)
+
         return MessageAction.run.value
 
     def message_is_blocked(self, message: dict) -> bool:
@@ -486,44 +618,93 @@ class WorkerPool:
         self.last_used_by_ct[running_ct] = None  # block scale down of this amount
 
     async def dispatch_task(self, message: dict) -> None:
+        uuid = message.get("uuid", "<unknown>")
+
+        # The cluster lease is a database round trip, so it is taken before the management lock, to never hold up the pool
+        lease_taken = False
+        cluster_action: Optional[str] = None
+        if (
+            self.cluster_duplicates
+            and not self.shutting_down
+            and not self.draining
+            and self.get_free_worker()
+            and self.get_blocking_action(message) == MessageAction.run.value
+        ):
+            if await self.cluster_duplicates.acquire(message):
+                lease_taken = True
+            else:
+                cluster_action = self.cluster_duplicates.blocked_action(message)
+
         async with self.management_lock:
-            uuid = message.get("uuid", "<unknown>")
+            # Local state may have changed while taking the lease, so the local rules are checked again
+            blocking_action = cluster_action or self.get_blocking_action(message)
+            worker = self.get_free_worker()
+            if lease_taken and self.cluster_duplicates:
+                if blocking_action != MessageAction.run.value or self.shutting_down or self.draining or worker is None:
+                    self.cluster_duplicates.release(message)  # not starting the task after all
 
-            blocking_action = self.get_blocking_action(message)
             if blocking_action == MessageAction.discard.value:
                 logger.info(f'Discarding task because it is already running: \n{message}')
                 self.discard_count += 1
                 return
-            elif self.shutting_down:
+            elif self.shutting_down or self.draining:
                 logger.info(f'Not starting task (uuid={uuid}) because we are shutting down, queued_ct={len(self.queued_messages)}')
-                self.queued_messages.append(message)
+                self.queue_message(message)
                 return
             elif blocking_action == MessageAction.queue.value:
                 logger.info(f'Queuing task (uuid={uuid}) because it is already running or queued, queued_ct={len(self.queued_messages)}')
-                self.queued_messages.append(message)
+                self.queue_message(message)
                 return
 
-            if worker := self.get_free_worker():
+            if worker:
                 logger.debug(f"Dispatching task (uuid={uuid}) to worker (id={worker.worker_id})")
+                if self.profiling.armed and (profile_options := self.profiling.take(message)):
+                    message['profile'] = profile_options
                 await worker.start_task(message)
+                self.running_index.add(message, worker)
+                if 'time_received' in message:
+                    # for delayed tasks, the task was not due until the delay passed
+                    wait = max(time.time() - message['time_received'] - message.get('delay', 0.0), 0.0)
+                    self.dispatch_latency.observe(wait)
+                    self.recent_wait.record(wait)
                 await self.post_task_start(message)
             else:
                 logger.warning(f'Queueing task (uuid={uuid}), ran out of workers, queued_ct={len(self.queued_messages)}')
-                self.queued_messages.append(message)
+                self.queue_message(message)
                 self.events.management_event.set()  # kick manager task to start auto-scale up
 
     async def drain_queue(self) -> None:
         work_done = False
         while requeue_message := self.get_unblocked_message():
-            if (not self.get_free_worker()) or self.shutting_down:
+            if (not self.get_free_worker()) or self.shutting_down or self.draining:
                 return
-            self.queued_messages.remove(requeue_message)
+            self.remove_queued(requeue_message)
             await self.dispatch_task(requeue_message)
             work_done = True
 
         if work_done:
             self.events.queue_cleared.set()
 
+    def worker_exited(self, worker: PoolWorker) -> None:
+        "Sentinel callback for a worker process, expected exits are handled by the shutdown message instead"
+        if worker.status not in ('starting', 'ready'):
+            return
+        msg = f'Worker {worker.worker_id} pid={worker.process.pid} exited unexpectedly, exitcode={worker.process.exitcode()}'
+        if worker.current_task:
+            msg += f", while running task (uuid={worker.current_task.get('uuid', '<unknown>')})"
+        logger.error(msg)
+        worker.status = 'exited'
+        self.events.management_event.set()  # reap the worker, and replace it if needed
+
+    async def process_lost(self, worker: PoolWorker) -> None:
+        "The worker process is gone without reporting its task done, so finish the task for it"
+        assert worker.current_task is not None
+        uuid = worker.current_task.get('uuid', '<unknown>')
+        logger.error(f'Task (uuid={uuid}) was lost because worker {worker.worker_id} exited while running it')
+        result = '<cancel>' if worker.is_active_cancel else None
+        await self.process_finished(worker, {'uuid': uuid, 'result': result})
+        await self.drain_queue()
+
     async def process_finished(self, worker, message) -> None:
         uuid = message.get('uuid', '<unknown>')
         msg = f"Worker {worker.worker_id} finished task (uuid={uuid}), ct={worker.finished_count}"
@@ -537,6 +718,14 @@ class WorkerPool:
             else:
                 msg += f", result: {result}"
         logger.debug(msg)
+        if 'time_started' in message and 'time_finish' in message:
+            self.task_runtime.observe(message['time_finish'] - message['time_started'])
+            if worker.current_task:
+                self.record_task_latency(worker.current_task, message)
+        if 'resources' in message and worker.current_task:
+            self.task_resources.record(worker.current_task.get('task', '<unknown>'), message['resources'])
+        if 'profile' in message and worker.current_task:
+            self.profiling.record(worker.current_task.get('task', '<unknown>'), message['profile'])
 
         running_ct = self.get_running_count()
         self.last_used_by_ct[running_ct] = time.monotonic()  # scale down may be allowed, clock starting now
@@ -547,14 +736,42 @@ class WorkerPool:
                 self.canceled_count += 1
             else:
                 self.finished_count += 1
+            if worker.current_task:
+                self.running_index.remove(worker.current_task, worker)
+                if self.cluster_duplicates:
+                    self.cluster_duplicates.release(worker.current_task)
             worker.mark_finished_task()
 
-        if not self.queued_messages and all(worker.current_task is None for worker in self.workers.values()):
-            self.events.work_cleared.set()
+        if sum(1 for worker in self.workers.values() if worker.counts_for_capacity) > self.max_workers:
+            self.events.management_event.set()  # max_workers was lowered, this worker can stop now
+
+        if all(worker.current_task is None for worker in self.workers.values()):
+            self.events.workers_idle.set()
+            if not self.queued_messages:
+                self.events.work_cleared.set()
 
         if 'timeout' in message:
             self.events.timeout_event.set()
 
+    def record_task_latency(self, task_message: dict, finished_message: dict) -> None:
+        """Record how long the task spent in each stage, from the timestamps collected along the way
+
+        publish_to_receive - time_pub set by the publisher, to time_received set by the service
+        queue_wait - from when the task was due, after any delay, to time_dispatched to a worker
+        dispatch - from time_dispatched, to time_started reported by the worker
+        run - from time_started to time_finish, both reported by the worker
+        """
+        task = task_message.get('task', '<unknown>')
+        time_received = task_message.get('time_received')
+        time_dispatched = task_message.get('time_dispatched')
+        if time_received is not None and 'time_pub' in task_message:
+            self.task_latency.record(task, 'publish_to_receive', time_received - task_message['time_pub'])
+        if time_received is not None and time_dispatched is not None:
+            self.task_latency.record(task, 'queue_wait', time_dispatched - time_received - task_message.get('delay', 0.0))
+        if time_dispatched is not None:
+            self.task_latency.record(task, 'dispatch', finished_message['time_started'] - time_dispatched)
+        self.task_latency.record(task, 'run', finished_message['time_finish'] - finished_message['time_started'])
+
     async def read_results_forever(self) -> None:
         """Perpetual task that continuously waits for task completions."""
         while True:
@@ -575,6 +792,8 @@ class WorkerPool:
             worker = self.workers[worker_id]
 
             if event == 'ready':
+                if worker.process_exited.is_set():
+                    continue  # died right after starting up, already marked as exited
                 worker.status = 'ready'
                 if all(worker.status == 'ready' for worker in self.workers.values()):
                     self.events.workers_ready.set()
@@ -597,5 +816,8 @@ class WorkerPool:
                     logger.debug(f"Worker {worker_id} sent exit signal.")
 
             elif event == 'done':
+                if worker.current_task is None and worker.status in ('retired', 'error'):
+                    logger.warning(f'Worker {worker_id} reported a task done after its task was counted as lost')
+                    continue
                 await self.process_finished(worker, message)
                 await self.drain_queue()
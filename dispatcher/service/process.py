@@ -39,6 +39,11 @@ class ProcessProxy:
     def pid(self) -> Optional[int]:
         return self._process.pid
 
+    @property
+    def sentinel(self) -> int:
+        "File descriptor that becomes ready when the process exits, only available after start"
+        return self._process.sentinel
+
     def exitcode(self) -> Optional[int]:
         return self._process.exitcode
 
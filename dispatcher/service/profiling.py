@@ -0,0 +1,48 @@
+import logging
+import os
+import tempfile
+from collections import deque
+from typing import Optional
+
+from ..worker.profile import PROFILE_MODES
+
+logger = logging.getLogger(__name__)
+
+
+class TaskProfiling:
+    """Profiling armed by task name, for a number of upcoming runs, and the summaries the workers sent back
+
+    The pool asks take() for the options of each task it starts, which is a dict lookup while anything is armed.
+    Only the latest max_results summaries are kept for each task name.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_results: int = 10) -> None:
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'dispatcher_profiles')
+        self.max_results = max_results
+        self.armed: dict[str, dict] = {}  # task name to the remaining count and options
+        self.results: dict[str, deque[dict]] = {}
+
+    def arm(self, task: str, count: int = 1, mode: str = 'cpu', top: int = 20) -> dict:
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode {mode}, options are {PROFILE_MODES}')
+        if count < 1 or top < 1:
+            raise ValueError('Profile count and top must be at least 1')
+        self.armed[task] = {'remaining': count, 'options': {'mode': mode, 'directory': self.directory, 'top': top}}
+        logger.info(f'Profiling the next {count} runs of task {task} in {mode} mode')
+        return self.armed[task]
+
+    def take(self, message: dict) -> Optional[dict]:
+        "Options to profile this run of the task with, or None, counting it towards the armed runs"
+        entry = self.armed.get(message.get('task', ''))
+        if entry is None:
+            return None
+        entry['remaining'] -= 1
+        if entry['remaining'] <= 0:
+            del self.armed[message['task']]
+        return entry['options']
+
+    def record(self, task: str, summary: dict) -> None:
+        self.results.setdefault(task, deque(maxlen=self.max_results)).append(summary)
+
+    def summary(self, task: Optional[str] = None) -> dict:
+        return {name: list(results) for name, results in self.results.items() if task is None or name == task}
@@ -0,0 +1,161 @@
+import asyncio
+import itertools
+import json
+import logging
+from typing import TYPE_CHECKING, Optional
+
+from ..brokers.base import BaseBroker
+from ..nodes import NodeDirectory, NodeInfo
+from ..utils import DuplicateBehavior
+from .drain import SERVICE_FIELDS
+
+if TYPE_CHECKING:
+    from .main import DispatcherMain
+
+logger = logging.getLogger(__name__)
+
+
+class Rebalancer:
+    """Moves queued tasks from this node to idle nodes, when the queue here backs up
+
+    Nodes with at least idle_threshold free workers and nothing queued announce in their heartbeats
+    that they accept overflow. Every interval, if more than surplus_threshold tasks here are waiting
+    only for a free worker, the surplus is sent to accepting nodes on their own channel,
+    no more to each node than the free workers it announced.
+
+    Guards against moving tasks back and forth:
+    - a task records the nodes it was moved from, and is moved at most max_hops times
+    - a node only sends overflow while it is not accepting any, and never to a node the task was at
+    - only tasks with on_duplicate of parallel move, because duplicate rules are only kept within a node
+    A task only moves to a node listening on the channel it was received on, unless it was routed to this node.
+
+    This listens to heartbeats with its own broker, and sends with the broker of the heartbeat.
+    """
+
+    def __init__(
+        self,
+        broker: BaseBroker,
+        interval: float = 1.0,
+        surplus_threshold: int = 5,
+        idle_threshold: int = 1,
+        max_hops: int = 1,
+    ) -> None:
+        if surplus_threshold < 0 or idle_threshold < 1 or max_hops < 1:
+            raise ValueError('Rebalancer needs surplus_threshold >= 0, and idle_threshold and max_hops of at least 1')
+        self.broker = broker
+        self.interval = interval
+        self.surplus_threshold = surplus_threshold
+        self.idle_threshold = idle_threshold
+        self.max_hops = max_hops
+        self.nodes = NodeDirectory()
+        self.sent_count = 0
+        self.listen_task: Optional[asyncio.Task] = None
+        self.rebalance_task: Optional[asyncio.Task] = None
+
+    def is_accepting(self, dispatcher: 'DispatcherMain') -> bool:
+        "Announced in heartbeats, whether this node takes tasks from overloaded nodes"
+        pool = dispatcher.pool
+        if pool.shutting_down or pool.queued_messages or dispatcher.intake_paused:
+            return False
+        return pool.max_workers - pool.get_running_count() >= self.idle_threshold
+
+    def can_move(self, message: dict) -> bool:
+        if message.get('on_duplicate', DuplicateBehavior.parallel.value) != DuplicateBehavior.parallel.value:
+            return False
+        return len(message.get('rebalanced', ())) < self.max_hops
+
+    def get_surplus(self, dispatcher: 'DispatcherMain') -> list[dict]:
+        "Newest queued tasks beyond surplus_threshold that only wait for a free worker, the oldest stay to run here next"
+        pool = dispatcher.pool
+        waiting = [message for message in pool.queued_messages if not pool.message_is_blocked(message)]
+        if len(waiting) <= self.surplus_threshold:
+            return []
+        return [message for message in itertools.islice(waiting, self.surplus_threshold, None) if self.can_move(message)]
+
+    def get_targets(self, dispatcher: 'DispatcherMain') -> list[NodeInfo]:
+        return [
+            info
+            for node_id, info in list(self.nodes.live_nodes().items())
+            if node_id != dispatcher.node_id and info.route_channel and info.load.get('accepting') and info.load.get('free', 0) > 0
+        ]
+
+    def get_overflow_message(self, dispatcher: 'DispatcherMain', message: dict) -> str:
+        data = {k: v for k, v in message.items() if k not in SERVICE_FIELDS and k != 'delay'}  # any delay already passed here
+        data['rebalanced'] = list(message.get('rebalanced', ())) + [dispatcher.node_id]
+        return json.dumps(data)
+
+    async def rebalance(self, dispatcher: 'DispatcherMain') -> int:
+        "Send surplus queued tasks to accepting nodes, returns the number sent"
+        if self.is_accepting(dispatcher):
+            return 0
+        surplus = self.get_surplus(dispatcher)
+        if not surplus:
+            return 0
+        targets = self.get_targets(dispatcher)
+        if not targets:
+            return 0
+
+        assert dispatcher.heartbeat is not None
+        moved = []
+        messages = []
+        for message in surplus:
+            queue = message.get('channel')
+            if queue == dispatcher.heartbeat.route_channel:
+                queue = None
+            candidates = [
+                info
+                for info in targets
+                if info.load.get('free', 0) > 0 and info.node_id not in message.get('rebalanced', ()) and (queue is None or queue in (info.channels or ()))
+            ]
+            if not candidates:
+                continue
+            target = max(candidates, key=lambda info: info.load.get('free', 0))
+            target.record_routed()
+            dispatcher.pool.remove_queued(message)  # before sending, so the pool can not start it meanwhile
+            moved.append(message)
+            messages.append((target.route_channel, self.get_overflow_message(dispatcher, message)))
+            logger.info(f'Moving queued task (uuid={message.get("uuid")}) to idle node {target.node_id}')
+
+        if messages:
+            try:
+                await dispatcher.heartbeat.broker.apublish_many(messages)
+            except Exception:
+                for message in moved:
+                    dispatcher.pool.queue_message(message)
+                raise
+            self.sent_count += len(messages)
+        return len(messages)
+
+    async def listen_forever(self) -> None:
+        async for channel, payload in self.broker.aprocess_notify(connected_callback=self.connected_callback):
+            self.nodes.update(json.loads(payload))
+
+    async def connected_callback(self) -> None:
+        self.nodes.mark_listening()
+
+    async def rebalance_forever(self, dispatcher: 'DispatcherMain') -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.rebalance(dispatcher)
+            except Exception:
+                logger.exception('Failed to send queued tasks to other nodes')
+
+    async def start(self, dispatcher: 'DispatcherMain') -> None:
+        if dispatcher.heartbeat is None:
+            raise RuntimeError('Rebalancing requires heartbeats, to know which nodes are idle')
+        self.listen_task = asyncio.create_task(self.listen_forever(), name='rebalancer_listen_task')
+        self.listen_task.add_done_callback(dispatcher.fatal_error_callback)
+        self.rebalance_task = asyncio.create_task(self.rebalance_forever(dispatcher), name='rebalancer_task')
+
+    async def shutdown(self) -> None:
+        for task in (self.rebalance_task, self.listen_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.rebalance_task = None
+        self.listen_task = None
+        await self.broker.aclose()
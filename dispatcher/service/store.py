@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LocalStore:
+    """Optional on-disk record of delayed messages and schedule state, so restarts do not lose them
+
+    This uses SQLite in WAL mode. Writes are buffered in memory and flushed in batches
+    by a background task, so recording a change from the hot path is only a dict update.
+    Changes made less than flush_interval before a crash may be lost.
+    """
+
+    def __init__(self, path: str = 'dispatcher_store.sqlite3', flush_interval: float = 1.0) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.connection: Optional[sqlite3.Connection] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
+
+        # Pending changes, newest write wins, a None value means delete the delayed message
+        self._pending_delayed: dict[str, Optional[tuple[float, str]]] = {}
+        self._pending_schedules: dict[str, float] = {}
+
+        # State read from disk at startup
+        self.schedule_runs: dict[str, float] = {}
+        self._loaded_delayed: list[tuple[float, dict]] = []
+
+    # --- hot path methods, these never touch the disk ---
+
+    def put_delayed(self, message: dict, run_at: float) -> None:
+        "Record that message should run at the system clock time run_at"
+        self._pending_delayed[message['uuid']] = (run_at, json.dumps(message))
+
+    def remove_delayed(self, uuid: str) -> None:
+        self._pending_delayed[uuid] = None
+
+    def record_schedule_run(self, name: str, run_at: float) -> None:
+        self.schedule_runs[name] = run_at
+        self._pending_schedules[name] = run_at
+
+    # --- startup and shutdown ---
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            # Flushes run in the default executor, but never more than one at a time
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS delayed (uuid TEXT PRIMARY KEY, run_at REAL NOT NULL, message TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS schedules (name TEXT PRIMARY KEY, last_run REAL NOT NULL)')
+            self.connection.commit()
+        return self.connection
+
+    def load(self) -> None:
+        connection = self.connect()
+        self.schedule_runs = {name: last_run for name, last_run in connection.execute('SELECT name, last_run FROM schedules')}
+        self._loaded_delayed = [(run_at, json.loads(message)) for run_at, message in connection.execute('SELECT run_at, message FROM delayed ORDER BY run_at')]
+        logger.info(f'Loaded {len(self._loaded_delayed)} delayed messages and {len(self.schedule_runs)} schedules from {self.path}')
+
+    def pending_delayed(self) -> list[dict]:
+        "Return the delayed messages saved by a prior run, with delay adjusted to the time remaining"
+        messages = []
+        current_time = time.time()
+        for run_at, message in self._loaded_delayed:
+            message['delay'] = max(run_at - current_time, 0.0)
+            messages.append(message)
+        self._loaded_delayed = []
+        return messages
+
+    async def start(self, dispatcher) -> None:
+        self.load()
+        self.flush_task = asyncio.create_task(self.flush_forever(), name='store_flush_task')
+        self.flush_task.add_done_callback(dispatcher.fatal_error_callback)
+
+    async def shutdown(self) -> None:
+        if self.flush_task:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        await self.flush()
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    # --- writing ---
+
+    def write_batch(self, delayed: dict[str, Optional[tuple[float, str]]], schedules: dict[str, float]) -> None:
+        connection = self.connect()
+        with connection:  # one transaction for the whole batch
+            removals = [(uuid,) for uuid, data in delayed.items() if data is None]
+            if removals:
+                connection.executemany('DELETE FROM delayed WHERE uuid = ?', removals)
+            puts = [(uuid, data[0], data[1]) for uuid, data in delayed.items() if data is not None]
+            if puts:
+                connection.executemany('INSERT OR REPLACE INTO delayed (uuid, run_at, message) VALUES (?, ?, ?)', puts)
+            if schedules:
+                connection.executemany('INSERT OR REPLACE INTO schedules (name, last_run) VALUES (?, ?)', list(schedules.items()))
+
+    async def flush(self) -> None:
+        async with self.flush_lock:
+            if not (self._pending_delayed or self._pending_schedules):
+                return
+            delayed, self._pending_delayed = self._pending_delayed, {}
+            schedules, self._pending_schedules = self._pending_schedules, {}
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.write_batch, delayed, schedules)
+            except Exception:
+                logger.exception(f'Failed to write {len(delayed)} delayed and {len(schedules)} schedule changes to {self.path}, will retry')
+                # Put the batch back, without overwriting anything newer
+                for uuid, data in delayed.items():
+                    self._pending_delayed.setdefault(uuid, data)
+                for name, run_at in schedules.items():
+                    self._pending_schedules.setdefault(name, run_at)
+
+    async def flush_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
@@ -0,0 +1,74 @@
+from typing import Any, Optional
+
+
+class TaskIndex:
+    """Index of work entries by message uuid and by task name
+
+    This lets control lookups find work without scanning every worker and queue.
+    The entry can be anything, like the message itself, or the worker running it.
+    Messages can share a uuid, as when a task is submitted again, so every entry is kept under its uuid.
+    """
+
+    def __init__(self) -> None:
+        # inner dicts keyed by id(entry) for cheap removal, in the order entries were added
+        self.by_uuid: dict[str, dict[int, Any]] = {}
+        self.by_task: dict[str, dict[int, Any]] = {}
+        self.uuid_entry_ct = 0
+
+    def __len__(self) -> int:
+        return self.uuid_entry_ct
+
+    @staticmethod
+    def _add(entries_by_key: dict[str, dict[int, Any]], key: Optional[str], entry: Any) -> bool:
+        if key is None:
+            return False
+        entries = entries_by_key.setdefault(key, {})
+        added = id(entry) not in entries
+        entries[id(entry)] = entry
+        return added
+
+    @staticmethod
+    def _remove(entries_by_key: dict[str, dict[int, Any]], key: Optional[str], entry: Any) -> bool:
+        if key is None or not (entries := entries_by_key.get(key)):
+            return False
+        removed = entries.pop(id(entry), None) is not None
+        if not entries:
+            del entries_by_key[key]
+        return removed
+
+    def add(self, message: dict, entry: Any) -> None:
+        if self._add(self.by_uuid, message.get('uuid'), entry):
+            self.uuid_entry_ct += 1
+        self._add(self.by_task, message.get('task'), entry)
+
+    def remove(self, message: dict, entry: Any) -> None:
+        if self._remove(self.by_uuid, message.get('uuid'), entry):
+            self.uuid_entry_ct -= 1
+        self._remove(self.by_task, message.get('task'), entry)
+
+    def get(self, uuid: str) -> Optional[Any]:
+        "The latest entry with this uuid"
+        if entries := self.by_uuid.get(uuid):
+            return next(reversed(entries.values()))
+        return None
+
+    def for_uuid(self, uuid: str) -> list[Any]:
+        return list(self.by_uuid.get(uuid, {}).values())
+
+    def for_task(self, task: str) -> list[Any]:
+        return list(self.by_task.get(task, {}).values())
+
+    def entries(self) -> list[Any]:
+        "Every entry indexed by uuid, in the order added for each uuid"
+        return [entry for entries in self.by_uuid.values() for entry in entries.values()]
+
+    def candidates(self, data: dict) -> Optional[list[Any]]:
+        """Return entries that could match the control filter data, or None if the index can not narrow it down
+
+        Callers still need to check the other filter fields against the entries returned.
+        """
+        if uuid := data.get('uuid'):
+            return self.for_uuid(uuid)
+        if task := data.get('task'):
+            return self.for_task(task)
+        return None
@@ -0,0 +1,97 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+"""Profiling of single task runs in the worker, armed for a task name by the profile control command
+
+The main process adds a "profile" entry to the messages of the runs to profile,
+and the worker sends a summary of the top entries back in its done message.
+The full stats are written to a file in the given directory, for a closer look.
+"""
+
+PROFILE_MODES = ('cpu', 'memory')
+
+
+class TaskProfiler:
+    """Context manager around one task call
+
+    The cpu mode uses cProfile and writes a pstats file, the memory mode uses tracemalloc and writes a snapshot,
+    which can be read back with tracemalloc.Snapshot.load.
+    """
+
+    def __init__(self, task: str, uuid: str, mode: str = 'cpu', directory: str = 'dispatcher_profiles', top: int = 20) -> None:
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode {mode}, options are {PROFILE_MODES}')
+        self.task = task
+        self.uuid = uuid
+        self.mode = mode
+        self.directory = directory
+        self.top = top
+        self.profiler: Optional[cProfile.Profile] = None
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.peak = 0
+
+    def __enter__(self) -> 'TaskProfiler':
+        if self.mode == 'cpu':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.profiler:
+            self.profiler.disable()
+        else:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def get_path(self) -> str:
+        name = f'{self.task}-{self.uuid}-{int(time.time())}'.replace(os.sep, '_')
+        return os.path.join(self.directory, name + ('.prof' if self.mode == 'cpu' else '.tracemalloc'))
+
+    def save(self) -> Optional[str]:
+        "Write the full stats, returns the file path, or None if that failed, the summary is still sent"
+        path = self.get_path()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.profiler:
+                self.profiler.dump_stats(path)
+            elif self.snapshot:
+                self.snapshot.dump(path)
+        except OSError:
+            logger.exception(f'Could not write profile of task (uuid={self.uuid}) to {path}')
+            return None
+        return path
+
+    def cpu_entries(self) -> list[dict]:
+        assert self.profiler is not None
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        entries = []
+        for (filename, lineno, function), (_, calls, tottime, cumtime, _) in stats.stats.items():  # type: ignore[attr-defined]
+            entries.append({'function': f'{filename}:{lineno}({function})', 'calls': calls, 'tottime': tottime, 'cumtime': cumtime})
+        entries.sort(key=lambda entry: entry['cumtime'], reverse=True)
+        return entries[: self.top]
+
+    def memory_entries(self) -> list[dict]:
+        assert self.snapshot is not None
+        snapshot = self.snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        return [{'location': str(stat.traceback), 'size': stat.size, 'count': stat.count} for stat in snapshot.statistics('lineno')[: self.top]]
+
+    def summary(self) -> dict:
+        data: dict = {'uuid': self.uuid, 'mode': self.mode, 'path': self.save()}
+        if self.profiler:
+            data['top'] = self.cpu_entries()
+        else:
+            data['peak'] = self.peak
+            data['top'] = self.memory_entries()
+        return data
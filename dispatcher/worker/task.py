@@ -2,15 +2,18 @@ import json
 import logging
 import multiprocessing
 import os
+import resource
 import signal
 import sys
 import time
 import traceback
 from queue import Empty as QueueEmpty
+from typing import Optional
 
 from ..config import setup
 from ..registry import DispatcherMethodRegistry
 from ..registry import registry as global_registry
+from .profile import TaskProfiler
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +25,48 @@ class DispatcherCancel(Exception):
     pass
 
 
+# ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def read_proc_io() -> dict[str, int]:
+    "Bytes this process caused to be read from and written to storage, only available on Linux"
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ', 1) for line in f.read().splitlines())
+    except (OSError, ValueError):
+        return {}
+    return {'read_bytes': int(counters['read_bytes']), 'write_bytes': int(counters['write_bytes'])}
+
+
+def get_resource_usage() -> dict[str, float]:
+    "Snapshot of the resources used by this process so far, the difference before and after a task is its usage"
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    data: dict[str, float] = {
+        'cpu_user': usage.ru_utime,
+        'cpu_system': usage.ru_stime,
+        'max_rss': usage.ru_maxrss * MAXRSS_UNIT,
+        'block_in': usage.ru_inblock,
+        'block_out': usage.ru_oublock,
+    }
+    data.update(read_proc_io())
+    return data
+
+
+def resource_usage_since(start: dict[str, float]) -> dict[str, float]:
+    """Resources used since the start snapshot
+
+    The max_rss of a process is its peak so far, so max_rss_delta is how much the task raised the peak,
+    and is 0 for a task that used less memory than an earlier task in the same worker.
+    """
+    end = get_resource_usage()
+    data: dict[str, float] = {
+        key: end[key] - start[key] for key in ('cpu_user', 'cpu_system', 'block_in', 'block_out', 'read_bytes', 'write_bytes') if key in start and key in end
+    }
+    data['max_rss_delta'] = end['max_rss'] - start['max_rss']
+    return data
+
+
 class WorkerSignalHandler:
     def __init__(self, worker_id):
         self.kill_now = False
@@ -70,6 +115,7 @@ class TaskWorker:
         self.ppid = os.getppid()
         self.pid = os.getpid()
         self.signal_handler = WorkerSignalHandler(worker_id)
+        self.profile_summary: Optional[dict] = None  # for the task just ran, if it was profiled
 
     def should_exit(self) -> bool:
         """Called before continuing the loop, something suspicious, return True, should exit"""
@@ -109,6 +155,13 @@ class TaskWorker:
             args = [self.produce_binder(message)] + args
 
         try:
+            if 'profile' in message:
+                profiler = TaskProfiler(task, self.get_uuid(message), **message['profile'])
+                try:
+                    with profiler:
+                        return _call(*args, **kwargs)
+                finally:
+                    self.profile_summary = profiler.summary()
             return _call(*args, **kwargs)
         except DispatcherCancel:
             # Log exception because this can provide valuable info about where a task was when getting signal
@@ -176,7 +229,7 @@ class TaskWorker:
     # these were used for the consumer classes, but not the worker classes
 
     # TODO: new WorkerTaskCall class to track timings and such
-    def get_finished_message(self, raw_result, message, time_started):
+    def get_finished_message(self, raw_result, message, time_started, usage_start=None):
         """I finished the task in message, giving result. This is what I send back to traffic control."""
         result = None
         if type(raw_result) in (type(None), list, dict, int, str):
@@ -186,7 +239,7 @@ class TaskWorker:
         else:
             logger.info(f'Discarding task (uuid={self.get_uuid(message)}) result of non-serializable type {type(raw_result)}')
 
-        return {
+        finished_message = {
             "worker": self.worker_id,
             "event": "done",
             "result": result,
@@ -194,6 +247,12 @@ class TaskWorker:
             "time_started": time_started,
             "time_finish": time.time(),
         }
+        if usage_start is not None:
+            finished_message["resources"] = resource_usage_since(usage_start)
+        if self.profile_summary is not None:
+            finished_message["profile"] = self.profile_summary
+            self.profile_summary = None
+        return finished_message
 
     def get_ready_message(self):
         """Message for traffic control, saying am entering the main work loop and am HOT TO GO"""
@@ -247,10 +306,11 @@ def work_loop(worker_id: int, settings: dict, finished_queue: multiprocessing.Qu
                 break
 
         time_started = time.time()
+        usage_start = get_resource_usage()
         result = worker.perform_work(message)
 
         # Indicate that the task is finished by putting a message in the finished_queue
-        finished_queue.put(worker.get_finished_message(result, message, time_started))
+        finished_queue.put(worker.get_finished_message(result, message, time_started, usage_start=usage_start))
 
     finished_queue.put(worker.get_shutdown_message())
     logger.debug(f'Worker {worker_id} informed the pool manager that we have exited')
@@ -0,0 +1,104 @@
+import asyncio
+from copy import deepcopy
+from typing import Callable, Iterator, Optional
+
+import pytest
+
+from dispatcher.config import DispatcherSettings
+from dispatcher.factories import from_settings, pool_from_settings
+from dispatcher.service.main import DispatcherMain
+
+from tests.conftest import BASIC_CONFIG
+
+"""
+Benchmarks run against a real service, with real worker processes.
+
+pytest-benchmark times synchronous callables, so each test gets its own event loop,
+starts the service in it, and every timed round is a run_until_complete call on that loop.
+Run with make benchmark, which saves machine-readable results to compare between commits.
+"""
+
+
+try:
+    import pytest_benchmark  # noqa: F401
+except ImportError:
+    collect_ignore_glob = ['test_*.py']  # the benchmark fixture comes from this plugin
+
+
+MEMORY_BROKER_CONFIG = {'channels': ['test_channel'], 'default_publish_channel': 'test_channel'}
+
+
+def benchmark_settings(broker: Optional[str] = None, **pool_kwargs) -> DispatcherSettings:
+    "Settings with no broker, the pg_notify broker used in tests, or the memory broker"
+    config = deepcopy(BASIC_CONFIG)
+    if broker is None:
+        config['brokers'] = {}
+    elif broker == 'memory':
+        config['brokers'] = {'memory': MEMORY_BROKER_CONFIG.copy()}
+    config['service'] = {'pool_kwargs': pool_kwargs}
+    return DispatcherSettings(config)
+
+
+def build_dispatcher(broker: Optional[str] = None, **pool_kwargs) -> DispatcherMain:
+    settings = benchmark_settings(broker=broker, **pool_kwargs)
+    if broker:
+        return from_settings(settings=settings)
+    # Without brokers, messages are given straight to process_message, so pg_notify is not measured
+    return DispatcherMain([], pool_from_settings(settings=settings))
+
+
+async def start_dispatcher(dispatcher: DispatcherMain) -> None:
+    await dispatcher.start_working()
+    await dispatcher.wait_for_producers_ready()
+    await dispatcher.pool.events.workers_ready.wait()
+
+
+async def stop_dispatcher(dispatcher: DispatcherMain) -> None:
+    await dispatcher.shutdown()
+    await dispatcher.cancel_tasks()
+
+
+async def wait_for_processed(dispatcher: DispatcherMain, target: int, timeout: float = 30.0) -> None:
+    "Wait until the pool has finished or discarded target messages in total"
+    pool = dispatcher.pool
+    while pool.processed_count < target:
+        pool.events.work_cleared.clear()
+        await asyncio.wait_for(pool.events.work_cleared.wait(), timeout=timeout)
+
+
+@pytest.fixture
+def benchmark_loop() -> Iterator[asyncio.AbstractEventLoop]:
+    loop = asyncio.new_event_loop()
+    try:
+        yield loop
+    finally:
+        loop.run_until_complete(asyncio.sleep(0))  # let closed transports clean up
+        loop.close()
+
+
+@pytest.fixture
+def running_dispatcher(benchmark_loop) -> Iterator[Callable[..., DispatcherMain]]:
+    "Factory fixture, starts a service in the benchmark loop with the given options and stops it after the test"
+    started: list[DispatcherMain] = []
+
+    def _rf(broker: Optional[str] = None, **pool_kwargs) -> DispatcherMain:
+        dispatcher = build_dispatcher(broker=broker, **pool_kwargs)
+        benchmark_loop.run_until_complete(start_dispatcher(dispatcher))
+        started.append(dispatcher)
+        return dispatcher
+
+    yield _rf
+
+    for dispatcher in started:
+        benchmark_loop.run_until_complete(stop_dispatcher(dispatcher))
+
+
+def latency_info(dispatcher: DispatcherMain, task: Optional[str] = None) -> dict:
+    "Flatten the latency percentiles from the pool into benchmark extra_info"
+    info = {}
+    for task_name, stages in dispatcher.pool.task_latency.summary(task=task).items():
+        for stage, summary in stages.items():
+            for key in ('p50', 'p90', 'p99', 'max'):
+                if key in summary:
+                    info[f'{stage}_{key}'] = summary[key]
+    return info
@@ -0,0 +1,126 @@
+import asyncio
+import json
+
+import pytest
+
+from dispatcher.factories import get_control_from_settings, get_publisher_from_settings
+
+from tests.benchmark.conftest import benchmark_settings, build_dispatcher, latency_info, start_dispatcher, stop_dispatcher, wait_for_processed
+
+NOOP_TASK = 'lambda: None'
+
+
+def run_rounds(benchmark, loop, coro_factory, rounds: int = 5) -> None:
+    "Time coro_factory() to completion in the loop, with a new coroutine for every round"
+    benchmark.pedantic(loop.run_until_complete, setup=lambda: ((coro_factory(),), {}), rounds=rounds, warmup_rounds=1)
+
+
+@pytest.mark.parametrize('worker_ct', [1, 4])
+def test_messages_per_second(benchmark, benchmark_loop, running_dispatcher, worker_ct):
+    "Throughput of no-op tasks given straight to the service, without a broker"
+    dispatcher = running_dispatcher(min_workers=worker_ct, max_workers=worker_ct)
+    message_ct = 200
+
+    async def submit_and_wait():
+        target = dispatcher.pool.processed_count + message_ct
+        for _ in range(message_ct):
+            await dispatcher.process_message({'task': NOOP_TASK})
+        await wait_for_processed(dispatcher, target)
+
+    run_rounds(benchmark, benchmark_loop, submit_and_wait)
+
+    benchmark.extra_info['message_ct'] = message_ct
+    benchmark.extra_info['messages_per_second'] = message_ct / benchmark.stats.stats.median
+    benchmark.extra_info.update(latency_info(dispatcher, task=NOOP_TASK))
+
+
+def test_messages_per_second_memory_broker(benchmark, benchmark_loop, running_dispatcher):
+    "Throughput of no-op tasks published through the memory broker, so the producer path is included without postgres"
+    dispatcher = running_dispatcher(broker='memory', min_workers=4, max_workers=4)
+    publisher = get_publisher_from_settings(settings=benchmark_settings(broker='memory'))
+    message = json.dumps({'task': NOOP_TASK})
+    message_ct = 200
+
+    async def publish_and_wait():
+        target = dispatcher.pool.processed_count + message_ct
+        for _ in range(message_ct):
+            await publisher.apublish_message(message=message)
+        await wait_for_processed(dispatcher, target)
+
+    run_rounds(benchmark, benchmark_loop, publish_and_wait)
+
+    benchmark.extra_info['message_ct'] = message_ct
+    benchmark.extra_info['messages_per_second'] = message_ct / benchmark.stats.stats.median
+
+
+def test_single_task_latency(benchmark, benchmark_loop, running_dispatcher):
+    "Time for one no-op task to go through an idle service, percentiles by stage are in extra_info"
+    dispatcher = running_dispatcher(min_workers=1, max_workers=1)
+
+    async def submit_and_wait():
+        target = dispatcher.pool.processed_count + 1
+        await dispatcher.process_message({'task': NOOP_TASK})
+        await wait_for_processed(dispatcher, target)
+
+    run_rounds(benchmark, benchmark_loop, submit_and_wait, rounds=100)
+
+    benchmark.extra_info.update(latency_info(dispatcher, task=NOOP_TASK))
+
+
+def test_scale_up_time(benchmark, benchmark_loop):
+    "Time from a burst of work landing on a single worker to the pool being scaled up to max_workers"
+    worker_ct = 4
+    dispatchers = []
+
+    async def start_idle():
+        dispatcher = build_dispatcher(min_workers=1, max_workers=worker_ct, scaledown_wait=60.0)
+        await start_dispatcher(dispatcher)
+        dispatchers.append(dispatcher)
+        return dispatcher
+
+    async def scale_up(dispatcher):
+        for _ in range(worker_ct):
+            await dispatcher.process_message({'task': 'lambda: __import__("time").sleep(0.5)'})
+        while sum(1 for worker in dispatcher.pool.workers.values() if worker.status == 'ready') < worker_ct:
+            await asyncio.sleep(0.005)
+
+    def setup():
+        return ((scale_up(benchmark_loop.run_until_complete(start_idle())),), {})
+
+    try:
+        benchmark.pedantic(benchmark_loop.run_until_complete, setup=setup, rounds=3)
+    finally:
+        for dispatcher in dispatchers:
+            benchmark_loop.run_until_complete(stop_dispatcher(dispatcher))
+
+    benchmark.extra_info['worker_ct'] = worker_ct
+
+
+def test_control_round_trip(benchmark, benchmark_loop, running_dispatcher):
+    "Time for a control-and-reply alive check over pg_notify, including connecting for the reply channel"
+    running_dispatcher(broker='pg_notify', min_workers=1, max_workers=1)
+    control = get_control_from_settings(settings=benchmark_settings(broker='pg_notify'))
+
+    async def alive_check():
+        replies = await control.acontrol_with_reply('alive', timeout=5)
+        assert len(replies) == 1
+
+    run_rounds(benchmark, benchmark_loop, alive_check, rounds=20)
+
+
+@pytest.mark.parametrize('on_duplicate', ['serial', 'queue_one', 'discard'])
+def test_duplicate_backlog(benchmark, benchmark_loop, running_dispatcher, on_duplicate):
+    "Cost of the on_duplicate checks with a large number of submissions of the same task"
+    dispatcher = running_dispatcher(min_workers=2, max_workers=2)
+    message_ct = 500
+
+    async def submit_and_wait():
+        target = dispatcher.pool.processed_count + message_ct
+        for _ in range(message_ct):
+            await dispatcher.process_message({'task': NOOP_TASK, 'on_duplicate': on_duplicate})
+        await wait_for_processed(dispatcher, target)
+
+    run_rounds(benchmark, benchmark_loop, submit_and_wait, rounds=3)
+
+    benchmark.extra_info['message_ct'] = message_ct
+    benchmark.extra_info['total_discard_count'] = dispatcher.pool.discard_count  # over all rounds, including warmup
@@ -40,6 +40,13 @@ BASIC_CONFIG = {
     }
 }
 
+# Service with the in-memory broker, for tests that need no postgres
+MEMORY_CONFIG = {
+    "version": 2,
+    "brokers": {"memory": {"channels": ['test_channel'], "default_publish_channel": 'test_channel'}},
+    "service": {"pool_kwargs": {"min_workers": 1, "max_workers": 2}, "process_manager_cls": "ProcessManager"},
+}
+
 
 @contextlib.asynccontextmanager
 async def aconnection_for_test():
@@ -1,3 +1,7 @@
+import asyncio
+import importlib
+import json
+import threading
 import time
 import multiprocessing
 
@@ -39,6 +43,7 @@ def _send_message(conn_config):
 def test_sync_listen_receive(conn_config):
     messages = []
     with multiprocessing.Pool(processes=1) as pool:
+
         def send_from_subprocess():
             pool.apply(_send_message, args=(conn_config,))
 
@@ -57,6 +62,7 @@ def test_sync_listen_receive_multi_message(conn_config):
     """Tests that the expected messages exit condition works, we get 3 messages, not just 1"""
     messages = []
     with multiprocessing.Pool(processes=1) as pool:
+
         def send_from_subprocess():
             pool.apply(_send_message, args=(conn_config,))
             pool.apply(_send_message, args=(conn_config,))
@@ -77,6 +83,7 @@ def test_get_message_then_timeout(conn_config):
     """Tests that the expected messages exit condition works, we get 3 messages, not just 1"""
     messages = []
     with multiprocessing.Pool(processes=1) as pool:
+
         def send_from_subprocess():
             pool.apply(_send_message, args=(conn_config,))
 
@@ -103,3 +110,166 @@ async def test_async_connection_from_config_reuse(conn_config):
     assert conn is conn2
 
     assert conn is not await acreate_connection(**conn_config)
+
+
+def test_abandon_async_connections(conn_config):
+    broker = Broker(config=conn_config)
+    connection = asyncio.run(broker.aget_connection())  # the loop closes on return
+    assert broker.abandon_async_connections() is True
+    assert connection.closed
+
+    given = asyncio.run(acreate_connection(**conn_config))
+    broker = Broker(config=conn_config, async_connection=given)
+    assert broker.abandon_async_connections() is True
+    assert not given.closed  # belongs to the caller
+    given.pgconn.finish()
+
+
+def test_sync_publish_many(conn_config):
+    publisher = Broker(config=conn_config, default_publish_channel='test_publish_many')
+    publisher.PUBLISH_MANY_BATCH_SIZE = 4  # makes this go over several statements
+
+    def send_many():
+        publisher.publish_many([(None, f'msg-{i}') for i in range(9)] + [('test_publish_many_other', 'other')])
+
+    broker = Broker(config=conn_config, channels=('test_publish_many', 'test_publish_many_other'))
+    received = list(broker.process_notify(connected_callback=send_many, max_messages=10, timeout=2.0))
+
+    assert received == [('test_publish_many', f'msg-{i}') for i in range(9)] + [('test_publish_many_other', 'other')]
+
+
+@pytest.mark.asyncio
+async def test_async_publish_many(conn_config):
+    broker = Broker(config=conn_config, channels=('test_apublish_many',))
+    publisher = Broker(config=conn_config, default_publish_channel='test_apublish_many')
+
+    async def send_many():
+        await publisher.apublish_many([(None, f'msg-{i}') for i in range(5)])
+
+    received = []
+    async for channel, message in broker.aprocess_notify(connected_callback=send_many):
+        received.append(message)
+        if len(received) >= 5:
+            break
+
+    assert received == [f'msg-{i}' for i in range(5)]
+    await publisher.aclose()
+    await broker.aclose()
+
+
+def test_publish_pool_from_threads(conn_config):
+    publisher = Broker(config=conn_config, default_publish_channel='test_publish_pool', publish_pool_size=2)
+
+    def send_from_threads():
+        threads = [threading.Thread(target=publisher.publish_message, kwargs={'message': f'msg-{i}'}) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    broker = Broker(config=conn_config, channels=('test_publish_pool',))
+    received = [message for _, message in broker.process_notify(connected_callback=send_from_threads, max_messages=6, timeout=2.0)]
+
+    assert sorted(received) == sorted(f'msg-{i}' for i in range(6))
+    assert len(publisher._publish_pool.all_connections) <= 2
+    assert publisher._sync_connection is None  # the pool is used instead of the shared connection
+    publisher.close()
+    assert publisher._publish_pool.idle == []
+
+
+@pytest.mark.asyncio
+async def test_publish_while_listening_separate_connection(conn_config):
+    broker = Broker(config=conn_config, channels=('test_separate_publish',), separate_publish_connection=True)
+
+    async def send_first():
+        await broker.apublish_message(message='first')
+
+    received = []
+    async for channel, message in broker.aprocess_notify(connected_callback=send_first):
+        received.append(message)
+        if len(received) >= 3:
+            break
+        # without a separate connection, these would wait in notify_queue until another notification came in
+        await broker.apublish_message(message=f'reply-{len(received)}')
+
+    assert received == ['first', 'reply-1', 'reply-2']
+    assert broker._async_publish_connection is not broker._async_connection
+    await broker.aclose()
+    assert broker._async_publish_connection is None
+
+
+@pytest.mark.asyncio
+async def test_claimed_tasks_go_to_one_listener(conn_config):
+    connection = create_connection(**conn_config)
+    with connection.cursor() as cur:
+        cur.execute('DROP TABLE IF EXISTS dispatcher_claims_test')
+    connection.close()
+
+    listeners = [Broker(config=conn_config, channels=('test_claims',), claim_table='dispatcher_claims_test') for _ in range(2)]
+    publisher = Broker(config=conn_config, default_publish_channel='test_claims')
+    received: list[list[dict]] = [[], []]
+
+    async def consume(broker, into):
+        async for _, message in broker.aprocess_notify():
+            into.append(json.loads(message))
+
+    tasks = [asyncio.create_task(consume(broker, into)) for broker, into in zip(listeners, received)]
+    for _ in range(100):
+        if all(broker.notify_loop_active for broker in listeners):
+            break
+        await asyncio.sleep(0.01)
+
+    messages = [(None, json.dumps({'task': 'lambda: None', 'uuid': f'claim-{i}'})) for i in range(20)]
+    messages.append((None, json.dumps({'control': 'alive'})))
+    await publisher.apublish_many(messages)
+    for _ in range(200):
+        if sum(len(into) for into in received) >= 22:
+            break
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)  # would catch a task run twice
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    task_uuids = [message['uuid'] for into in received for message in into if 'task' in message]
+    assert sorted(task_uuids) == sorted(f'claim-{i}' for i in range(20))  # each task exactly once
+    for into in received:
+        assert {'control': 'alive'} in into  # control goes to every node
+    for broker in listeners + [publisher]:
+        await broker.aclose()
+
+
+_thread_connections = threading.local()
+
+
+def thread_local_connection(**config):
+    "Like the connection handling of a web framework, every thread has its own connection"
+    if getattr(_thread_connections, 'connection', None) is None:
+        _thread_connections.connection = create_connection(**config)
+    return _thread_connections.connection
+
+
+def test_factory_connection_per_thread(conn_config):
+    factory = 'tests.integration.brokers.test_pg_notify.thread_local_connection'
+    publisher = Broker(config=conn_config, sync_connection_factory=factory, default_publish_channel='test_factory_threads')
+    used = []
+
+    thread_connections = importlib.import_module('tests.integration.brokers.test_pg_notify')._thread_connections  # as the broker imports it
+
+    def publish_from_thread(i):
+        publisher.publish_message(message=f'msg-{i}')
+        used.append(thread_connections.connection)
+        thread_connections.connection.close()
+
+    def send_from_threads():
+        threads = [threading.Thread(target=publish_from_thread, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    broker = Broker(config=conn_config, channels=('test_factory_threads',))
+    received = [message for _, message in broker.process_notify(connected_callback=send_from_threads, max_messages=3, timeout=2.0)]
+    assert sorted(received) == [f'msg-{i}' for i in range(3)]
+    assert len({id(connection) for connection in used}) == 3  # each thread published on its own connection
+    assert publisher._sync_connection is None  # the application connection is not kept by the broker
@@ -0,0 +1,182 @@
+import asyncio
+import json
+
+import pytest
+
+from dispatcher.brokers.pg_notify import create_connection
+from dispatcher.brokers.pg_queue import Broker, is_broadcast
+from dispatcher.config import DispatcherSettings
+from dispatcher.control import Control
+from dispatcher.factories import from_settings, get_control_from_settings
+
+from tests.conftest import CONNECTION_STRING
+from tests.data import methods as test_methods
+
+TABLE = 'dispatcher_queue_test'
+
+
+@pytest.fixture
+def clear_table(conn_config):
+    connection = create_connection(**conn_config)
+    with connection.cursor() as cur:
+        cur.execute(f'DROP TABLE IF EXISTS {TABLE}')
+    yield
+    connection.close()
+
+
+async def listen_for(broker, ct, connected_callback=None) -> list[tuple[str, str]]:
+    received = []
+    async for channel, message in broker.aprocess_notify(connected_callback=connected_callback):
+        received.append((channel, message))
+        if len(received) >= ct:
+            break
+    return received
+
+
+@pytest.mark.asyncio
+async def test_messages_wait_for_listener(conn_config, clear_table):
+    "Messages published with nothing listening are not lost, unlike pg_notify"
+    publisher = Broker(config=conn_config, table=TABLE, default_publish_channel='test_pg_queue')
+    publisher.publish_many([(None, f'msg-{i}') for i in range(3)])
+    publisher.publish_message(message='msg-3')
+
+    listener = Broker(config=conn_config, table=TABLE, channels=('test_pg_queue',))
+    received = await asyncio.wait_for(listen_for(listener, 4), timeout=5)
+    assert received == [('test_pg_queue', f'msg-{i}') for i in range(4)]
+    await listener.aclose()
+
+
+@pytest.mark.asyncio
+async def test_each_message_to_one_listener(conn_config, clear_table):
+    publisher = Broker(config=conn_config, table=TABLE, default_publish_channel='test_pg_queue')
+    listeners = [Broker(config=conn_config, table=TABLE, channels=('test_pg_queue',), batch_size=5) for _ in range(2)]
+    all_received: list[str] = []
+
+    async def consume(broker):
+        async for _, message in broker.aprocess_notify():
+            all_received.append(message)
+            await asyncio.sleep(0.001)  # give the other listener a chance to claim
+
+    tasks = [asyncio.create_task(consume(broker)) for broker in listeners]
+    await asyncio.sleep(0.2)  # both listening
+    await publisher.apublish_many([(None, f'msg-{i}') for i in range(40)])
+    for _ in range(200):
+        if len(all_received) >= 40:
+            break
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)  # would catch any duplicate delivery
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    assert sorted(all_received) == sorted(f'msg-{i}' for i in range(40))
+    for broker in listeners + [publisher]:
+        await broker.aclose()
+
+
+@pytest.mark.asyncio
+async def test_claim_expires_after_visibility_timeout(conn_config, clear_table):
+    publisher = Broker(config=conn_config, table=TABLE, default_publish_channel='test_pg_queue')
+    publisher.publish_many([(None, 'first'), (None, 'second')])
+
+    # This listener takes the first message of its batch and then dies, never finishing the batch
+    crashed = Broker(config=conn_config, table=TABLE, channels=('test_pg_queue',), visibility_timeout=0.2)
+    assert await asyncio.wait_for(listen_for(crashed, 1), timeout=5) == [('test_pg_queue', 'first')]
+    await crashed.aclose()
+
+    listener = Broker(config=conn_config, table=TABLE, channels=('test_pg_queue',), poll_interval=0.1)
+    received = await asyncio.wait_for(listen_for(listener, 2), timeout=5)
+    assert received == [('test_pg_queue', 'first'), ('test_pg_queue', 'second')]  # at-least-once
+    await listener.aclose()
+
+
+@pytest.mark.asyncio
+async def test_service_with_pg_queue_broker(clear_table):
+    settings = DispatcherSettings(
+        {
+            "version": 2,
+            "brokers": {
+                "pg_queue": {
+                    "config": {'conninfo': CONNECTION_STRING},
+                    "table": TABLE,
+                    "channels": ['test_channel'],
+                    "default_publish_channel": 'test_channel',
+                }
+            },
+            "service": {"pool_kwargs": {"min_workers": 1, "max_workers": 2}, "process_manager_cls": "ProcessManager"},
+        }
+    )
+    dispatcher = from_settings(settings=settings)
+    try:
+        await dispatcher.start_working()
+        await dispatcher.wait_for_producers_ready()
+        await dispatcher.pool.events.workers_ready.wait()
+
+        clearing_task = asyncio.create_task(dispatcher.pool.events.work_cleared.wait())
+        test_methods.print_hello.apply_async(settings=settings)
+        await asyncio.wait_for(clearing_task, timeout=3)
+        assert dispatcher.pool.finished_count == 1
+
+        control = get_control_from_settings(settings=settings)
+        alive = await asyncio.wait_for(control.acontrol_with_reply('alive', timeout=2), timeout=5)
+        assert alive == [{'node_id': dispatcher.node_id}]
+    finally:
+        await dispatcher.shutdown()
+        await dispatcher.cancel_tasks()
+
+
+def test_broadcast_messages():
+    assert is_broadcast(Control.generate_reply_queue_name(), '{"alive": true}')
+    assert is_broadcast('test_channel', json.dumps({'control': 'alive', 'reply_to': 'reply_to_x'}))
+    assert is_broadcast('dispatcher_heartbeat', json.dumps({'heartbeat': 'node-1', 'interval': 1.0}))
+    assert not is_broadcast('test_channel', json.dumps({'task': 'tests.data.methods.print_hello', 'kwargs': {'control': 1}}))
+    assert not is_broadcast('test_channel', 'lambda: "control"')
+
+
+@pytest.mark.asyncio
+async def test_control_and_heartbeats_reach_every_node(clear_table):
+    settings = DispatcherSettings(
+        {
+            "version": 2,
+            "brokers": {
+                "pg_queue": {
+                    "config": {'conninfo': CONNECTION_STRING},
+                    "table": TABLE,
+                    "channels": ['test_channel'],
+                    "default_publish_channel": 'test_channel',
+                }
+            },
+            "service": {
+                "pool_kwargs": {"min_workers": 1, "max_workers": 1},
+                "process_manager_cls": "ProcessManager",
+                "heartbeat_kwargs": {"interval": 0.2},
+            },
+        }
+    )
+    nodes = [from_settings(settings=settings) for _ in range(2)]
+    try:
+        for node in nodes:
+            await node.start_working()
+            await node.wait_for_producers_ready()
+
+        control = get_control_from_settings(settings=settings)
+        alive = await asyncio.wait_for(control.acontrol_with_reply('alive', expected_replies=2, timeout=2), timeout=5)
+        assert sorted(reply['node_id'] for reply in alive) == sorted(node.node_id for node in nodes)  # not claimed by one node
+
+        async with control.client() as client:
+            await client.astart()
+            for _ in range(100):
+                if client.get_expected_nodes() and len(client.get_expected_nodes()) == 2:
+                    break
+                await asyncio.sleep(0.05)
+            assert client.get_expected_nodes() == {node.node_id for node in nodes}  # heartbeats of both arrived
+
+        connection = create_connection(conninfo=CONNECTION_STRING)
+        with connection.cursor() as cur:
+            cur.execute(f'SELECT count(*) FROM {TABLE}')
+            assert cur.fetchone()[0] == 0  # nothing for control went through the table
+        connection.close()
+    finally:
+        for node in nodes:
+            await node.shutdown()
+        await nodes[0].cancel_tasks()  # cancels the tasks of both, they share the event loop
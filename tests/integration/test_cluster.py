@@ -0,0 +1,174 @@
+import asyncio
+import copy
+import time
+
+import pytest
+
+from dispatcher.brokers.pg_notify import LeaseTable, create_connection
+from dispatcher.config import DispatcherSettings
+from dispatcher.factories import from_settings, get_control_from_settings, get_node_directory
+from dispatcher.nodes import node_channel
+
+from tests.conftest import BASIC_CONFIG
+from tests.data import methods as test_methods
+
+TABLE = 'dispatcher_leases_test'
+
+
+@pytest.fixture
+def clear_leases(conn_config):
+    connection = create_connection(**conn_config)
+    with connection.cursor() as cur:
+        cur.execute(f'DROP TABLE IF EXISTS {TABLE}')
+    yield
+    connection.close()
+
+
+@pytest.mark.asyncio
+async def test_lease_table(conn_config, clear_leases):
+    leases = LeaseTable(config=conn_config, table=TABLE)
+    try:
+        assert await leases.acquire('fp1', 'node-a', 'uuid-1', 60.0) is True
+        assert await leases.acquire('fp1', 'node-b', 'uuid-2', 60.0) is False
+        assert await leases.acquire('fp1', 'node-a', 'uuid-3', 60.0) is True  # same node may take it again
+
+        await leases.release(['fp1'], 'node-b')  # not the holder, nothing happens
+        assert await leases.acquire('fp1', 'node-b', 'uuid-2', 60.0) is False
+        await leases.release(['fp1'], 'node-a')
+        assert await leases.acquire('fp1', 'node-b', 'uuid-2', 0.1) is True
+
+        await asyncio.sleep(0.2)  # node-b died without renewing
+        assert await leases.acquire('fp1', 'node-a', 'uuid-4', 60.0) is True
+    finally:
+        await leases.aclose()
+
+
+@pytest.mark.asyncio
+async def test_serial_task_across_nodes(clear_leases):
+    "Both nodes get the message over pg_notify, the leases keep them from running it at the same time"
+    config = copy.deepcopy(BASIC_CONFIG)
+    config['service'] = {
+        'pool_kwargs': {'min_workers': 1, 'max_workers': 1},
+        'process_manager_cls': 'ProcessManager',
+        'cluster_kwargs': {'table': TABLE, 'cache_ttl': 0.1},
+    }
+    settings = DispatcherSettings(config)
+    nodes = [from_settings(settings=settings) for _ in range(2)]
+    try:
+        for node in nodes:
+            await node.start_working()
+        for node in nodes:
+            await node.wait_for_producers_ready()
+            await node.pool.events.workers_ready.wait()
+
+        test_methods.sleep_serial.apply_async(args=[0.5], settings=settings)
+        for _ in range(100):
+            if sum(node.pool.get_running_count() + len(node.pool.queued_messages) for node in nodes) >= 2:
+                break
+            await asyncio.sleep(0.01)
+        assert sorted(node.pool.get_running_count() for node in nodes) == [0, 1]
+        assert sorted(len(node.pool.queued_messages) for node in nodes) == [0, 1]
+
+        for _ in range(300):
+            if sum(node.pool.finished_count for node in nodes) >= 2:
+                break
+            await asyncio.sleep(0.01)
+        assert [node.pool.finished_count for node in nodes] == [1, 1]  # one after the other
+        assert sum(node.pool.cluster_duplicates.blocked_count for node in nodes) >= 1
+    finally:
+        for node in nodes:
+            await node.shutdown()
+            await node.cancel_tasks()
+
+
+@pytest.mark.asyncio
+async def test_control_replies_from_all_live_nodes():
+    config = copy.deepcopy(BASIC_CONFIG)
+    config['service'] = {
+        'pool_kwargs': {'min_workers': 1, 'max_workers': 1},
+        'process_manager_cls': 'ProcessManager',
+        'heartbeat_kwargs': {'interval': 0.2},
+    }
+    settings = DispatcherSettings(config)
+    nodes = [from_settings(settings=settings) for _ in range(2)]
+    try:
+        async with get_control_from_settings(settings=settings).client() as client:
+            for node in nodes:
+                await node.start_working()
+                await node.wait_for_producers_ready()
+            await asyncio.sleep(0.3)  # one heartbeat interval, so the client knows every node
+
+            start = time.monotonic()
+            replies = await asyncio.wait_for(client.acontrol_with_reply('alive', expected_replies=None, timeout=3), timeout=5)
+            assert time.monotonic() - start < 1.0
+            assert sorted(reply['node_id'] for reply in replies) == sorted(node.node_id for node in nodes)
+    finally:
+        for node in nodes:
+            await node.shutdown()
+            await node.cancel_tasks()
+
+
+@pytest.mark.asyncio
+async def test_control_replies_from_nodes_on_queue():
+    "A node listening on other channels does not get the command, so it is not waited for"
+    config = copy.deepcopy(BASIC_CONFIG)
+    config['service'] = {
+        'pool_kwargs': {'min_workers': 1, 'max_workers': 1},
+        'process_manager_cls': 'ProcessManager',
+        'heartbeat_kwargs': {'interval': 0.2},
+    }
+    settings = DispatcherSettings(config)
+    other_config = copy.deepcopy(config)
+    other_config['brokers']['pg_notify']['channels'] = ['test_other_queue']
+    other_config['brokers']['pg_notify']['default_publish_channel'] = 'test_other_queue'
+    nodes = [from_settings(settings=settings), from_settings(settings=DispatcherSettings(other_config))]
+    try:
+        async with get_control_from_settings(settings=settings).client() as client:
+            for node in nodes:
+                await node.start_working()
+                await node.wait_for_producers_ready()
+            await asyncio.sleep(0.3)  # one heartbeat interval, so the client knows every node
+            assert len(client.nodes.live_nodes()) == 2
+
+            start = time.monotonic()
+            replies = await asyncio.wait_for(client.acontrol_with_reply('alive', expected_replies=None, timeout=3), timeout=5)
+            assert time.monotonic() - start < 1.0
+            assert replies == [{'node_id': nodes[0].node_id}]
+    finally:
+        for node in nodes:
+            await node.shutdown()
+            await node.cancel_tasks()
+
+
+@pytest.mark.asyncio
+async def test_route_tasks_by_load():
+    config = copy.deepcopy(BASIC_CONFIG)
+    config['service'] = {
+        'pool_kwargs': {'min_workers': 1, 'max_workers': 2},
+        'process_manager_cls': 'ProcessManager',
+        'heartbeat_kwargs': {'interval': 0.2},
+    }
+    settings = DispatcherSettings(config)
+    directory = get_node_directory(settings=settings)
+    nodes = [from_settings(settings=settings) for _ in range(2)]
+    try:
+        for node in nodes:
+            await node.start_working()
+            await node.wait_for_producers_ready()
+        for _ in range(200):
+            if len(directory.live_nodes()) == 2:
+                break
+            await asyncio.sleep(0.01)
+        assert {info.route_channel for info in directory.live_nodes().values()} == {node_channel(node.node_id) for node in nodes}
+
+        for _ in range(4):
+            test_methods.sleep_function.apply_async(args=[0.1], settings=settings, route='least_loaded')
+        for _ in range(200):
+            if sum(node.pool.finished_count for node in nodes) >= 4:
+                break
+            await asyncio.sleep(0.01)
+        assert [node.pool.finished_count for node in nodes] == [2, 2]  # two free workers each
+    finally:
+        for node in nodes:
+            await node.shutdown()
+            await node.cancel_tasks()
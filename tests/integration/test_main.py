@@ -8,6 +8,7 @@ import pytest
 from tests.data import methods as test_methods
 
 from dispatcher.config import temporary_settings
+from dispatcher.service.loop_monitor import LoopMonitor
 
 SLEEP_METHOD = 'lambda: __import__("time").sleep(0.1)'
 
@@ -56,6 +57,21 @@ async def test_run_decorated_function(apg_dispatcher, test_settings):
     assert apg_dispatcher.pool.finished_count == 3
 
 
+@pytest.mark.asyncio
+async def test_metrics_after_task(apg_dispatcher, test_settings):
+    clearing_task = asyncio.create_task(apg_dispatcher.pool.events.work_cleared.wait())
+    test_methods.print_hello.apply_async(settings=test_settings)
+    await asyncio.wait_for(clearing_task, timeout=3)
+
+    text = apg_dispatcher.metrics.render()
+    assert 'dispatcher_tasks_finished_total 1.0' in text
+    assert 'dispatcher_tasks_produced_total{producer="BrokeredProducer"} 1.0' in text
+    assert 'dispatcher_broker_lag_seconds_count 1' in text  # decorated methods send time_pub
+    assert 'dispatcher_dispatch_latency_seconds_count 1' in text
+    assert 'dispatcher_task_runtime_seconds_count 1' in text
+    assert 'dispatcher_workers{status="ready"}' in text
+
+
 @pytest.mark.asyncio
 async def test_submit_with_global_settings(apg_dispatcher, test_settings):
     clearing_task = asyncio.create_task(apg_dispatcher.pool.events.work_cleared.wait())
@@ -109,6 +125,27 @@ async def test_get_running_jobs(apg_dispatcher, pg_message, pg_control):
     assert running_job['uuid'] == 'find_me'
 
 
+@pytest.mark.asyncio
+async def test_async_submission(apg_dispatcher, test_settings):
+    clearing_task = asyncio.create_task(apg_dispatcher.pool.events.work_cleared.wait())
+    await asyncio.gather(*[test_methods.print_hello.aapply_async(settings=test_settings) for _ in range(3)])
+    await asyncio.wait_for(clearing_task, timeout=3)
+    assert apg_dispatcher.pool.finished_count == 3
+
+
+@pytest.mark.asyncio
+async def test_task_latency_control(apg_dispatcher, test_settings, pg_control):
+    clearing_task = asyncio.create_task(apg_dispatcher.pool.events.work_cleared.wait())
+    test_methods.print_hello.apply_async(settings=test_settings)
+    await asyncio.wait_for(clearing_task, timeout=3)
+
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('latency', data={'task': 'tests.data.methods.print_hello'}, timeout=1), timeout=5)
+    stages = get_worker_data(replies)
+    assert set(stages.keys()) == {'publish_to_receive', 'queue_wait', 'dispatch', 'run'}
+    for stage_data in stages.values():
+        assert stage_data['count'] == 1
+
+
 @pytest.mark.asyncio
 async def test_cancel_task(apg_dispatcher, pg_message, pg_control):
     msg = json.dumps({'task': 'lambda: __import__("time").sleep(3.1415)', 'uuid': 'foobar'})
@@ -187,6 +224,18 @@ async def test_alive_check(apg_dispatcher, pg_control):
     assert apg_dispatcher.control_count == 1
 
 
+@pytest.mark.asyncio
+async def test_control_client_reuses_reply_channel(apg_dispatcher, pg_control):
+    async with pg_control.client() as client:
+        for _ in range(3):
+            alive = await asyncio.wait_for(client.acontrol_with_reply('alive', timeout=5), timeout=10)
+            assert alive == [{'node_id': apg_dispatcher.node_id}]
+        running = await asyncio.wait_for(asyncio.gather(*[client.acontrol_with_reply('running', timeout=5) for _ in range(5)]), timeout=10)
+        assert all(replies == [{'node_id': apg_dispatcher.node_id}] for replies in running)
+
+    assert apg_dispatcher.control_count == 8
+
+
 @pytest.mark.asyncio
 async def test_task_discard(apg_dispatcher, pg_message):
     messages = [
@@ -248,3 +297,84 @@ async def test_scale_up(apg_dispatcher, test_settings):
             break
     else:
         assert f'Never scaled up to expected 6 workers, have: {apg_dispatcher.pool.workers}'
+
+
+@pytest.mark.asyncio
+async def test_pool_limits_control(apg_dispatcher, pg_control):
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('pool_limits', data={'max_workers': 2, 'scaledown_wait': 1.0}, timeout=1), timeout=5)
+    assert len(replies) == 1
+    assert replies[0]['min_workers'] == 1
+    assert replies[0]['max_workers'] == 2
+    assert replies[0]['scaledown_wait'] == 1.0
+    assert apg_dispatcher.pool.max_workers == 2
+
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('pool_limits', data={'min_workers': 3}, timeout=1), timeout=5)
+    assert 'error' in replies[0]
+
+
+@pytest.mark.asyncio
+async def test_pause_and_resume_intake(apg_dispatcher, pg_message, pg_control):
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('pause', data={'channel': 'test_channel'}, timeout=1), timeout=5)
+    assert replies[0]['paused_channels'] == ['test_channel']
+
+    await pg_message(SLEEP_METHOD)
+    for _ in range(100):
+        if apg_dispatcher.held_messages:
+            break
+        await asyncio.sleep(0.01)
+    assert len(apg_dispatcher.held_messages) == 1
+    assert apg_dispatcher.pool.received_count == 0
+
+    clearing_task = asyncio.create_task(apg_dispatcher.pool.events.work_cleared.wait())
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('resume', timeout=1), timeout=5)
+    assert replies[0]['released'] == 1
+    assert replies[0]['held'] == 0
+    await asyncio.wait_for(clearing_task, timeout=3)
+    assert apg_dispatcher.pool.finished_count == 1
+
+
+@pytest.mark.asyncio
+async def test_task_resources_control(apg_dispatcher, test_settings, pg_control):
+    clearing_task = asyncio.create_task(apg_dispatcher.pool.events.work_cleared.wait())
+    test_methods.print_hello.apply_async(settings=test_settings)
+    await asyncio.wait_for(clearing_task, timeout=3)
+
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('resources', data={'top': 5}, timeout=1), timeout=5)
+    usage = get_worker_data(replies)
+    assert usage['count'] == 1
+    assert 'cpu_user' in usage['total']
+    assert 'max_rss_delta' in usage['max']
+
+
+@pytest.mark.asyncio
+async def test_profile_control(apg_dispatcher, test_settings, pg_control):
+    task_name = 'tests.data.methods.print_hello'
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('profile', data={'task': task_name, 'top': 5}, timeout=1), timeout=5)
+    assert replies[0]['remaining'] == 1
+    assert replies[0]['mode'] == 'cpu'
+
+    clearing_task = asyncio.create_task(apg_dispatcher.pool.events.work_cleared.wait())
+    test_methods.print_hello.apply_async(settings=test_settings)
+    await asyncio.wait_for(clearing_task, timeout=3)
+
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('profile_results', data={'task': task_name}, timeout=1), timeout=5)
+    profiles = get_worker_data(replies)
+    assert len(profiles) == 1
+    assert 0 < len(profiles[0]['top']) <= 5
+    assert apg_dispatcher.pool.profiling.armed == {}
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_control(apg_dispatcher, pg_control):
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('loop_lag', timeout=1), timeout=5)
+    assert 'error' in replies[0]  # off without loop_monitor_kwargs
+
+    apg_dispatcher.loop_monitor = LoopMonitor()  # stopped by the dispatcher shutdown
+    await apg_dispatcher.loop_monitor.start(apg_dispatcher)
+    await asyncio.sleep(0.25)  # a couple of samples at the default interval
+    forks_from_service = apg_dispatcher.pool.process_manager.mp_context == 'fork'
+    assert (apg_dispatcher.loop_monitor.watchdog is None) is forks_from_service  # no thread while workers may fork
+    replies = await asyncio.wait_for(pg_control.acontrol_with_reply('loop_lag', timeout=1), timeout=5)
+    assert len(replies) == 1
+    assert replies[0]['lag']['count'] >= 1
+    assert isinstance(replies[0]['slow_callbacks'], list)
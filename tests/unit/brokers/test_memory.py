@@ -0,0 +1,111 @@
+import asyncio
+import json
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from dispatcher.brokers.memory import Broker
+from dispatcher.config import DispatcherSettings
+from dispatcher.factories import from_settings, get_control_from_settings
+
+from tests.conftest import MEMORY_CONFIG
+from tests.data import methods as test_methods
+
+
+def test_sync_listen_timeout():
+    broker = Broker(channels=('memory_timeout',))
+    start = time.monotonic()
+    assert list(broker.process_notify(timeout=0.05)) == []
+    assert time.monotonic() - start >= 0.05
+
+
+def test_sync_listen_receive_from_thread():
+    broker = Broker(channels=('memory_thread',))
+
+    def send_from_thread():
+        threading.Thread(target=Broker().publish_message, args=('memory_thread', 'test_message')).start()
+
+    start = time.monotonic()
+    messages = list(broker.process_notify(connected_callback=send_from_thread, timeout=2.0))
+    assert messages == [('memory_thread', 'test_message')]
+    assert time.monotonic() - start < 2.0
+
+
+async def listen_for(broker, ct, connected_callback=None) -> list[tuple[str, str]]:
+    received = []
+    async for channel, message in broker.aprocess_notify(connected_callback=connected_callback):
+        received.append((channel, message))
+        if len(received) >= ct:
+            break
+    return received
+
+
+@pytest.mark.asyncio
+async def test_async_listen_receive():
+    broker = Broker(channels=('memory_async', 'memory_async2'))
+    publisher = Broker(default_publish_channel='memory_async')
+
+    async def send():
+        await publisher.apublish_message(message='first')
+        await publisher.apublish_message(channel='memory_async2', message='second')
+        await publisher.apublish_message(channel='memory_not_listening', message='dropped')
+
+    received = await asyncio.wait_for(listen_for(broker, 2, connected_callback=send), timeout=2)
+    assert received == [('memory_async', 'first'), ('memory_async2', 'second')]
+
+
+def _publish_from_child():
+    Broker().publish_message('memory_fork', 'from child')
+
+
+@pytest.mark.asyncio
+async def test_publish_from_forked_process():
+    broker = Broker(channels=('memory_fork',), cross_process=True)
+
+    async def fork_and_send():
+        process = multiprocessing.get_context('fork').Process(target=_publish_from_child)
+        process.start()
+        await asyncio.get_running_loop().run_in_executor(None, process.join)
+        assert process.exitcode == 0
+
+    received = await asyncio.wait_for(listen_for(broker, 1, connected_callback=fork_and_send), timeout=5)
+    assert received == [('memory_fork', 'from child')]
+
+
+def test_apply_many_publishes_each_call():
+    settings = DispatcherSettings(MEMORY_CONFIG)
+    broker = Broker(channels=('test_channel',))
+
+    def send():
+        bodies, queue = test_methods.print_hello.apply_many([{}, {'uuid': 'second'}], settings=settings, timeout=3)
+        assert queue == 'test_channel'
+        assert [body['uuid'] for body in bodies][1] == 'second'
+
+    messages = [json.loads(message) for _, message in broker.process_notify(connected_callback=send, max_messages=2, timeout=2.0)]
+    assert [message['task'] for message in messages] == ['tests.data.methods.print_hello'] * 2
+    assert messages[1]['uuid'] == 'second'
+    assert all(message['timeout'] == 3 for message in messages)  # shared options go to every call
+
+
+@pytest.mark.asyncio
+async def test_service_with_memory_broker():
+    settings = DispatcherSettings(MEMORY_CONFIG)
+    dispatcher = from_settings(settings=settings)
+    try:
+        await dispatcher.start_working()
+        await dispatcher.wait_for_producers_ready()
+        await dispatcher.pool.events.workers_ready.wait()
+
+        clearing_task = asyncio.create_task(dispatcher.pool.events.work_cleared.wait())
+        test_methods.print_hello.apply_async(settings=settings)
+        await asyncio.wait_for(clearing_task, timeout=3)
+        assert dispatcher.pool.finished_count == 1
+
+        control = get_control_from_settings(settings=settings)
+        alive = await asyncio.wait_for(control.acontrol_with_reply('alive', timeout=1), timeout=5)
+        assert alive == [{'node_id': dispatcher.node_id}]
+    finally:
+        await dispatcher.shutdown()
+        await dispatcher.cancel_tasks()
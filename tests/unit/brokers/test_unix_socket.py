@@ -0,0 +1,226 @@
+import asyncio
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from dispatcher.brokers.unix_socket import FRAME_HEADER, Broker, encode_frame
+from dispatcher.config import DispatcherSettings
+from dispatcher.factories import from_settings, get_control_from_settings
+
+from tests.data import methods as test_methods
+
+
+async def listen_for(broker, ct, connected_callback=None) -> list[tuple[str, str]]:
+    received = []
+    async for channel, message in broker.aprocess_notify(connected_callback=connected_callback):
+        received.append((channel, message))
+        if len(received) >= ct:
+            break
+    return received
+
+
+@pytest.mark.asyncio
+async def test_pipelined_async_publish(tmp_path):
+    path = str(tmp_path / 'dispatcher.sock')
+    listener = Broker(path=path, channels=('test_channel',), server=True)
+    publisher = Broker(path=path, default_publish_channel='test_channel')
+
+    async def send():
+        await asyncio.gather(*[publisher.apublish_message(message=f'msg-{i}') for i in range(100)])
+
+    received = await asyncio.wait_for(listen_for(listener, 100, connected_callback=send), timeout=5)
+    assert [message for _, message in received] == [f'msg-{i}' for i in range(100)]  # order is kept over one connection
+    assert publisher._client.pending == {}  # all acknowledged
+    await publisher.aclose()
+    assert not os.path.exists(path)  # listener cleaned up the socket
+
+
+@pytest.mark.asyncio
+async def test_subscriber_not_reading_is_dropped(tmp_path):
+    path = str(tmp_path / 'dispatcher.sock')
+    server = Broker(path=path, channels=('test_channel',), max_write_buffer=1024, server=True)
+    await server.start_server()
+    try:
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(encode_frame({'op': 'sub', 'id': 0, 'channels': ['stuck_channel']}))
+        await reader.readexactly(FRAME_HEADER.size)  # ack header, then nothing more is read
+        assert 'stuck_channel' in server._subscriptions
+
+        for _ in range(200):
+            server.route('stuck_channel', 'x' * 65536)
+            if 'stuck_channel' not in server._subscriptions:
+                break
+            await asyncio.sleep(0)
+        assert 'stuck_channel' not in server._subscriptions
+        writer.close()
+    finally:
+        await server.stop_server()
+
+
+def _publish_many_sync(path, ct):
+    broker = Broker(path=path, default_publish_channel='test_channel', max_unacked=8)
+    broker.publish_many([(None, f'many-{i}') for i in range(ct)])  # more than max_unacked, goes in windows
+    broker.close()
+
+
+@pytest.mark.asyncio
+async def test_sync_publish_many(tmp_path):
+    path = str(tmp_path / 'dispatcher.sock')
+    listener = Broker(path=path, channels=('test_channel',), server=True)
+
+    async def send():
+        process = multiprocessing.get_context('fork').Process(target=_publish_many_sync, args=(path, 30))
+        process.start()
+        await asyncio.get_running_loop().run_in_executor(None, process.join)
+        assert process.exitcode == 0
+
+    received = await asyncio.wait_for(listen_for(listener, 30, connected_callback=send), timeout=5)
+    assert [message for _, message in received] == [f'many-{i}' for i in range(30)]
+
+
+def _publish_sync(path, ct):
+    broker = Broker(path=path, default_publish_channel='test_channel', max_unacked=8)
+    for i in range(ct):
+        broker.publish_message(message=f'sync-{i}')
+    broker.close()  # waits for remaining acks
+
+
+@pytest.mark.asyncio
+async def test_sync_publish_from_other_process(tmp_path):
+    path = str(tmp_path / 'dispatcher.sock')
+    listener = Broker(path=path, channels=('test_channel',), server=True)
+
+    async def send():
+        assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)  # only this user may submit tasks, from the moment of binding
+        process = multiprocessing.get_context('fork').Process(target=_publish_sync, args=(path, 20))
+        process.start()
+        await asyncio.get_running_loop().run_in_executor(None, process.join)
+        assert process.exitcode == 0
+
+    received = await asyncio.wait_for(listen_for(listener, 20, connected_callback=send), timeout=5)
+    assert len(received) == 20
+
+
+@pytest.mark.asyncio
+async def test_service_with_unix_socket_broker(tmp_path):
+    path = str(tmp_path / 'dispatcher.sock')
+    settings = DispatcherSettings({
+        "version": 2,
+        "brokers": {"unix_socket": {"path": path, "channels": ['test_channel'], "default_publish_channel": 'test_channel'}},
+        "service": {"pool_kwargs": {"min_workers": 1, "max_workers": 2}, "process_manager_cls": "ProcessManager"},
+    })
+    dispatcher = from_settings(settings=settings)
+    try:
+        await dispatcher.start_working()
+        await dispatcher.wait_for_producers_ready()
+        await dispatcher.pool.events.workers_ready.wait()
+
+        clearing_task = asyncio.create_task(dispatcher.pool.events.work_cleared.wait())
+        await asyncio.get_running_loop().run_in_executor(None, lambda: test_methods.print_hello.apply_async(settings=settings))
+        await asyncio.wait_for(clearing_task, timeout=3)
+        assert dispatcher.pool.finished_count == 1
+
+        control = get_control_from_settings(settings=settings)
+        alive = await asyncio.wait_for(control.acontrol_with_reply('alive', timeout=1), timeout=5)
+        assert alive == [{'node_id': dispatcher.node_id}]
+
+        # Blocking control-and-reply, has to be in a thread because the service runs in this event loop
+        replies = await asyncio.get_running_loop().run_in_executor(None, lambda: control.control_with_reply('workers', timeout=2))
+        assert len(replies) == 1
+        assert 'worker-0' in replies[0]
+        assert json.dumps(replies)  # sanity, replies are plain data
+
+        async with control.client() as client:
+            replies = await asyncio.wait_for(asyncio.gather(*[client.acontrol_with_reply('alive', timeout=1) for _ in range(3)]), timeout=5)
+            assert replies == [[{'node_id': dispatcher.node_id}]] * 3
+    finally:
+        await dispatcher.shutdown()
+        await dispatcher.cancel_tasks()
+
+
+@pytest.mark.asyncio
+async def test_only_server_binds(tmp_path):
+    path = str(tmp_path / 'dispatcher.sock')
+    client = Broker(path=path, channels=('test_channel',))
+    with pytest.raises(FileNotFoundError):
+        await listen_for(client, 1)  # does not become the server when the service is not running
+    assert not os.path.exists(path)
+
+    listener = Broker(path=path, channels=('test_channel',), server=True)
+
+    async def second_server():
+        with pytest.raises(RuntimeError):
+            await listen_for(Broker(path=path, channels=('test_channel',), server=True), 1)
+        await Broker(path=path, default_publish_channel='test_channel').apublish_message(message='still served')
+
+    received = await asyncio.wait_for(listen_for(listener, 1, connected_callback=second_server), timeout=5)
+    assert received == [('test_channel', 'still served')]
+
+
+async def serve_for(path, ct):
+    listener = Broker(path=path, channels=('test_channel',), server=True)
+    ready = asyncio.Event()
+
+    async def connected():
+        ready.set()
+
+    task = asyncio.create_task(listen_for(listener, ct, connected_callback=connected))
+    await ready.wait()
+    return task
+
+
+@pytest.mark.asyncio
+async def test_sync_publisher_reconnects_after_restart(tmp_path):
+    path = str(tmp_path / 'dispatcher.sock')
+    publisher = Broker(path=path, default_publish_channel='test_channel')
+    loop = asyncio.get_running_loop()
+
+    listen_task = await serve_for(path, 1)
+    await loop.run_in_executor(None, lambda: publisher.publish_many([(None, 'before')]))
+    assert await asyncio.wait_for(listen_task, timeout=5) == [('test_channel', 'before')]
+
+    listen_task = await serve_for(path, 1)  # new service, the publisher still has the old connection
+    await loop.run_in_executor(None, lambda: publisher.publish_many([(None, 'after')]))
+    assert await asyncio.wait_for(listen_task, timeout=5) == [('test_channel', 'after')]
+    publisher.close()
+
+
+@pytest.mark.asyncio
+async def test_sync_publisher_raises_for_unacked(tmp_path):
+    path = str(tmp_path / 'dispatcher.sock')
+    publisher = Broker(path=path, default_publish_channel='test_channel')
+    loop = asyncio.get_running_loop()
+
+    listen_task = await serve_for(path, 1)
+    await loop.run_in_executor(None, lambda: publisher.publish_message(message='maybe lost'))  # ack not read yet
+    await asyncio.wait_for(listen_task, timeout=5)
+
+    listen_task = await serve_for(path, 1)
+    with pytest.raises(ConnectionError):
+        await loop.run_in_executor(None, lambda: publisher.publish_message(message='next'))
+    assert publisher._sock is None
+    await loop.run_in_executor(None, lambda: publisher.publish_many([(None, 'reconnected')]))  # next publish connects again
+    assert await asyncio.wait_for(listen_task, timeout=5) == [('test_channel', 'reconnected')]
+    publisher.close()
+
+
+@pytest.mark.asyncio
+async def test_async_publisher_reconnects_after_restart(tmp_path):
+    path = str(tmp_path / 'dispatcher.sock')
+    publisher = Broker(path=path, default_publish_channel='test_channel')
+
+    async def send_one():
+        await publisher.apublish_message(message='first')
+
+    listener = Broker(path=path, channels=('test_channel',), server=True)
+    await asyncio.wait_for(listen_for(listener, 1, connected_callback=send_one), timeout=5)
+
+    async def send_two():
+        await publisher.apublish_message(message='second')
+
+    listener = Broker(path=path, channels=('test_channel',), server=True)
+    received = await asyncio.wait_for(listen_for(listener, 1, connected_callback=send_two), timeout=5)
+    assert received == [('test_channel', 'second')]
+    await publisher.aclose()
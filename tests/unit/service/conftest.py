@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from dispatcher.brokers.memory import Broker
+from dispatcher.nodes import node_channel
+from dispatcher.service.heartbeat import Heartbeat
+from dispatcher.service.main import DispatcherMain
+from dispatcher.service.pool import WorkerPool
+from dispatcher.service.process import ProcessManager
+
+
+class RecordingBroker(Broker):
+    "Memory broker keeping what is published with apublish_many, or failing to publish it"
+
+    def __init__(self, fail: bool = False, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.fail = fail
+        self.sent: list[tuple[str, dict]] = []
+
+    async def apublish_many(self, messages) -> None:
+        if self.fail:
+            raise RuntimeError('Broker is down')
+        self.sent.extend((channel, json.loads(message)) for channel, message in messages)
+
+
+@pytest.fixture
+def recording_broker():
+    return RecordingBroker
+
+
+@pytest.fixture
+def make_dispatcher(test_settings):
+    "Makes a dispatcher without workers, so tasks stay queued, with heartbeats published to a RecordingBroker"
+
+    def _make_dispatcher(node_id='busy', **kwargs):
+        pool = WorkerPool(ProcessManager(settings=test_settings), max_workers=0)
+        heartbeat = Heartbeat(RecordingBroker(), route_channel=node_channel(node_id))
+        return DispatcherMain([], pool, node_id=node_id, heartbeat=heartbeat, **kwargs)
+
+    return _make_dispatcher
@@ -1,8 +1,10 @@
 import asyncio
+import time
 
 import pytest
 
 from dispatcher.producers import ScheduledProducer
+from dispatcher.service.store import LocalStore
 
 
 class ItWorked(Exception):
@@ -37,6 +39,17 @@ def test_scheduled_producer_with_options():
         }
     })
 
-    loop = asyncio.get_event_loop()
     with pytest.raises(ItWorked):
-        loop.run_until_complete(run_schedules_for_a_while(producer))
+        asyncio.run(run_schedules_for_a_while(producer))
+
+
+def test_first_wait_uses_saved_schedule(tmp_path):
+    producer = ScheduledProducer({'tests.data.methods.print_hello': {'schedule': 10}})
+    assert producer.first_wait('tests.data.methods.print_hello', 10) == 10  # no store
+
+    producer.store = LocalStore(path=str(tmp_path / 'store.sqlite3'))
+    producer.store.record_schedule_run('tests.data.methods.print_hello', time.time() - 4.0)
+    assert 5.0 < producer.first_wait('tests.data.methods.print_hello', 10) <= 6.0
+
+    producer.store.record_schedule_run('tests.data.methods.print_hello', time.time() - 60.0)
+    assert producer.first_wait('tests.data.methods.print_hello', 10) == 0.0  # overdue, run right away
@@ -0,0 +1,205 @@
+import asyncio
+import time
+
+import pytest
+
+from dispatcher.service.cluster import ClusterDuplicates, task_fingerprint
+from dispatcher.service.pool import WorkerPool
+from dispatcher.service.process import ProcessManager
+
+
+class MemoryLeases:
+    "Stand-in for the lease table, shared by the nodes of a test"
+
+    def __init__(self) -> None:
+        self.leases: dict[str, tuple[str, float]] = {}
+        self.acquire_calls = 0
+
+    async def acquire(self, fingerprint, node_id, uuid, ttl):
+        self.acquire_calls += 1
+        holder = self.leases.get(fingerprint)
+        if holder and holder[0] != node_id and holder[1] > time.monotonic():
+            return False
+        self.leases[fingerprint] = (node_id, time.monotonic() + ttl)
+        return True
+
+    async def renew(self, fingerprints, node_id, ttl):
+        for fingerprint in fingerprints:
+            if self.leases.get(fingerprint, ('',))[0] == node_id:
+                self.leases[fingerprint] = (node_id, time.monotonic() + ttl)
+
+    async def release(self, fingerprints, node_id):
+        for fingerprint in fingerprints:
+            if self.leases.get(fingerprint, ('',))[0] == node_id:
+                del self.leases[fingerprint]
+
+    async def aclose(self):
+        pass
+
+
+def make_node(backend, node_id, cache_ttl=1.0):
+    cluster = ClusterDuplicates(cache_ttl=cache_ttl)
+    cluster.backend = backend
+    cluster.node_id = node_id
+    return cluster
+
+
+def test_fingerprint_ignores_uuid():
+    assert task_fingerprint({'task': 'a', 'args': [1], 'uuid': 'x'}) == task_fingerprint({'task': 'a', 'args': [1], 'uuid': 'y'})
+    assert task_fingerprint({'task': 'a', 'args': [1]}) != task_fingerprint({'task': 'a', 'args': [2]})
+
+
+@pytest.mark.asyncio
+async def test_lease_blocks_other_node():
+    backend = MemoryLeases()
+    node_a, node_b = make_node(backend, 'a'), make_node(backend, 'b')
+    message = {'task': 'tests.data.methods.sleep_serial', 'on_duplicate': 'serial'}
+
+    assert await node_a.acquire(dict(message, uuid='1')) is True
+    assert await node_b.acquire(dict(message, uuid='2')) is False
+    assert node_b.is_held_elsewhere(message)
+    assert node_b.blocked_count == 1
+
+    # a second local copy does not need a round trip
+    calls = backend.acquire_calls
+    assert await node_a.acquire(dict(message, uuid='3')) is True
+    assert backend.acquire_calls == calls
+
+    node_a.release(message)
+    await node_a.release_pending()
+    assert backend.leases  # one copy is still running on node a
+    node_a.release(message)
+    await node_a.release_pending()
+    assert not backend.leases
+
+    node_b.held_elsewhere.clear()  # as if the cached answer expired
+    assert await node_b.acquire(dict(message, uuid='2')) is True
+
+
+@pytest.mark.asyncio
+async def test_parallel_tasks_not_leased():
+    backend = MemoryLeases()
+    node = make_node(backend, 'a')
+    assert await node.acquire({'task': 'foo', 'uuid': '1'}) is True
+    assert await node.acquire({'task': 'foo', 'uuid': '2', 'on_duplicate': 'parallel'}) is True
+    assert backend.acquire_calls == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_action_for_task_on_other_node(test_settings):
+    backend = MemoryLeases()
+    await make_node(backend, 'other').acquire({'task': 'foo', 'on_duplicate': 'serial'})
+
+    cluster = make_node(backend, 'this')
+    pool = WorkerPool(ProcessManager(settings=test_settings), cluster_duplicates=cluster)
+    for on_duplicate, expected in (('serial', 'queue'), ('queue_one', 'queue'), ('discard', 'discard')):
+        message = {'task': 'foo', 'on_duplicate': on_duplicate}
+        assert await cluster.acquire(message) is False
+        assert pool.get_blocking_action(message) == expected  # from the cache, no round trip
+    assert pool.get_blocking_action({'task': 'foo'}) == 'run'
+
+
+class SlowLeases(MemoryLeases):
+    "Lease table that does not answer until told to"
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.proceed = asyncio.Event()
+
+    async def acquire(self, fingerprint, node_id, uuid, ttl):
+        await self.proceed.wait()
+        return await super().acquire(fingerprint, node_id, uuid, ttl)
+
+
+@pytest.mark.asyncio
+async def test_lease_query_outside_management_lock(test_settings):
+    backend = SlowLeases()
+    cluster = make_node(backend, 'a')
+    pool = WorkerPool(ProcessManager(settings=test_settings), cluster_duplicates=cluster)
+    await pool.up()
+    pool.workers[0].status = 'ready'  # a lie, for test
+
+    dispatch = asyncio.create_task(pool.dispatch_task({'task': 'foo', 'on_duplicate': 'serial', 'uuid': '1'}))
+    await asyncio.sleep(0.01)
+    assert not dispatch.done()  # waiting on the lease table
+    await asyncio.wait_for(pool.management_lock.acquire(), timeout=1)  # pool management is not held up
+    pool.workers[0].current_task = {'task': 'bar'}  # the worker was taken in the meantime
+    pool.management_lock.release()
+
+    backend.proceed.set()
+    await dispatch
+    assert len(pool.queued_messages) == 1
+    assert not cluster.held and cluster.releasing  # lease given back, since the task did not start
+
+
+def test_cache_ttl_must_be_positive():
+    with pytest.raises(ValueError):
+        ClusterDuplicates(cache_ttl=0)
+
+
+class FailingLeases(MemoryLeases):
+    "Lease table that can not be reached until fixed"
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.failing = True
+
+    async def acquire(self, fingerprint, node_id, uuid, ttl):
+        if self.failing:
+            self.acquire_calls += 1
+            raise ConnectionError('lease table is down')
+        return await super().acquire(fingerprint, node_id, uuid, ttl)
+
+    async def release(self, fingerprints, node_id):
+        if self.failing:
+            raise ConnectionError('lease table is down')
+        await super().release(fingerprints, node_id)
+
+
+@pytest.mark.asyncio
+async def test_lease_table_errors_fall_back_to_local_rules():
+    backend = FailingLeases()
+    node = make_node(backend, 'a', cache_ttl=0.05)
+    message = {'task': 'foo', 'on_duplicate': 'serial', 'uuid': '1'}
+
+    assert await node.acquire(message) is True  # runs under the local rules
+    assert node.error_count == 1
+    assert not node.held  # no lease to give back
+
+    assert await node.acquire(dict(message, uuid='2')) is True
+    assert backend.acquire_calls == 1  # backing off, the table is not tried again yet
+
+    backend.failing = False
+    time.sleep(0.06)
+    assert await node.acquire(dict(message, uuid='3')) is True
+    assert backend.acquire_calls == 2
+    assert node.held and node.consecutive_errors == 0
+
+
+@pytest.mark.asyncio
+async def test_release_error_keeps_leases_to_retry():
+    backend = FailingLeases()
+    backend.failing = False
+    node = make_node(backend, 'a')
+    message = {'task': 'foo', 'on_duplicate': 'serial'}
+    assert await node.acquire(message) is True
+
+    backend.failing = True
+    node.release(message)
+    with pytest.raises(ConnectionError):
+        await node.release_pending()
+    assert node.releasing  # tried again by the maintenance task
+
+    backend.failing = False
+    await node.release_pending()
+    assert not backend.leases
+
+
+@pytest.mark.asyncio
+async def test_shutdown_with_lease_table_down():
+    backend = FailingLeases()
+    backend.failing = False
+    node = make_node(backend, 'a')
+    assert await node.acquire({'task': 'foo', 'on_duplicate': 'serial'}) is True
+    backend.failing = True
+    await node.shutdown()  # logs instead of raising, the lease expires
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import pytest
+
+from dispatcher.brokers.memory import Broker
+from dispatcher.config import DispatcherSettings
+from dispatcher.control import ControlClient
+from dispatcher.factories import from_settings, get_control_from_settings
+
+from tests.conftest import MEMORY_CONFIG
+
+
+@pytest.mark.asyncio
+async def test_control_client_concurrent_requests():
+    settings = DispatcherSettings(MEMORY_CONFIG)
+    dispatcher = from_settings(settings=settings)
+    try:
+        await dispatcher.start_working()
+        await dispatcher.wait_for_producers_ready()
+
+        async with get_control_from_settings(settings=settings).client() as client:
+            replies = await asyncio.wait_for(asyncio.gather(*[client.acontrol_with_reply('alive', timeout=5) for _ in range(5)]), timeout=10)
+            assert replies == [[{'node_id': dispatcher.node_id}]] * 5
+            workers = await asyncio.wait_for(client.acontrol_with_reply('workers', timeout=5), timeout=10)
+            assert workers[0]['node_id'] == dispatcher.node_id
+        assert dispatcher.control_count == 6
+    finally:
+        await dispatcher.shutdown()
+        await dispatcher.cancel_tasks()
+
+
+@pytest.mark.asyncio
+async def test_client_skips_invalid_messages():
+    client = ControlClient('memory', {}, queue='control_invalid', heartbeat_channel='control_invalid_heartbeat')
+    service = Broker(channels=('control_invalid',))
+    publisher = Broker()
+    service_ready = asyncio.Event()
+
+    async def connected_callback():
+        service_ready.set()
+
+    async def reply_to_one():
+        async for channel, payload in service.aprocess_notify(connected_callback=connected_callback):
+            request = json.loads(payload)
+            await publisher.apublish_message(channel=client.heartbeat_channel, message='not json')
+            await publisher.apublish_message(channel=client.heartbeat_channel, message='[1, 2]')
+            await publisher.apublish_message(channel=request['reply_to'], message='{not json')
+            await publisher.apublish_message(channel=request['reply_to'], message=json.dumps({'node_id': 'a', 'correlation_id': request['correlation_id']}))
+            return
+
+    async with client:
+        service_task = asyncio.create_task(reply_to_one())
+        await asyncio.wait_for(service_ready.wait(), timeout=5)
+        replies = await asyncio.wait_for(client.acontrol_with_reply('alive', timeout=5), timeout=10)
+        await service_task
+        assert replies == [{'node_id': 'a'}]
+        assert not client.listen_task.done()  # still listening for later requests
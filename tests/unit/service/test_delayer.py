@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+import pytest
+
+from dispatcher.service.delayer import Delayer
+
+
+def test_expire_in_deadline_order():
+    delayer = Delayer()
+    for i, delay in enumerate([0.3, 0.1, 0.2]):
+        delayer.add({'uuid': f'task-{i}', 'delay': delay})
+    assert len(delayer) == 3
+
+    expired = delayer.pop_expired(time.monotonic() + 1.0)
+    assert [capsule.uuid for capsule in expired] == ['task-1', 'task-2', 'task-0']
+    assert len(delayer) == 0
+
+
+def test_cancel_by_uuid():
+    delayer = Delayer()
+    delayer.add({'uuid': 'keep', 'delay': 0.1})
+    delayer.add({'uuid': 'drop', 'delay': 0.1})
+
+    assert [capsule.message['uuid'] for capsule in delayer.cancel('drop')] == ['drop']
+    assert delayer.cancel('drop') == []  # already gone
+    assert [capsule.uuid for capsule in delayer.capsules] == ['keep']
+
+    expired = delayer.pop_expired(time.monotonic() + 1.0)
+    assert [capsule.uuid for capsule in expired] == ['keep']
+
+
+def test_same_uuid_keeps_both_capsules():
+    delayer = Delayer()
+    delayer.add({'uuid': 'same', 'delay': 0.1, 'args': [1]})
+    delayer.add({'uuid': 'same', 'delay': 0.2, 'args': [2]})
+    assert len(delayer) == 2
+
+    expired = delayer.pop_expired(time.monotonic() + 1.0)
+    assert [capsule.message['args'] for capsule in expired] == [[1], [2]]
+
+
+def test_canceled_capsules_compacted():
+    delayer = Delayer()
+    for i in range(1000):
+        delayer.add({'uuid': f'task-{i}', 'delay': 60.0})
+    for i in range(900):
+        delayer.cancel(f'task-{i}')
+    assert len(delayer) == 100
+    assert len(delayer._heap) < 600  # compaction happened, not holding all 1000
+    assert delayer.next_deadline() is not None
+
+
+@pytest.mark.asyncio
+async def test_timer_task_runs_messages():
+    delayer = Delayer()
+    received = []
+
+    async def process_message(message):
+        received.append(message['uuid'])
+
+    timer_task = asyncio.create_task(delayer.run_forever(process_message))
+    delayer.add({'uuid': 'later', 'delay': 0.2})
+    await asyncio.sleep(0.01)  # timer is now sleeping until the 0.2 deadline
+    delayer.add({'uuid': 'sooner', 'delay': 0.05})
+
+    for _ in range(50):
+        await asyncio.sleep(0.01)
+        if len(received) == 2:
+            break
+    timer_task.cancel()
+
+    assert received == ['sooner', 'later']
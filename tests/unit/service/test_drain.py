@@ -0,0 +1,137 @@
+import asyncio
+import copy
+import json
+import time
+
+import pytest
+
+from dispatcher.brokers.memory import Broker
+from dispatcher.config import DispatcherSettings
+from dispatcher.factories import from_settings
+from dispatcher.nodes import node_channel
+from dispatcher.service.drain import Drainer, handoff_message
+from dispatcher.service.store import LocalStore
+
+from tests.conftest import MEMORY_CONFIG
+
+
+@pytest.fixture
+def make_draining(make_dispatcher, recording_broker):
+    def _make_draining(store=None, fail=False, timeout=0.05):
+        return make_dispatcher(node_id='draining', store=store, drainer=Drainer(recording_broker(fail=fail), timeout=timeout))
+
+    return _make_draining
+
+
+def add_work(dispatcher):
+    dispatcher.pool.queue_message({'task': 'tests.data.methods.print_hello', 'uuid': 'queued-1', 'channel': 'test_channel', 'time_received': time.time()})
+    dispatcher.pool.queue_message({'task': 'tests.data.methods.print_hello', 'uuid': 'queued-2', 'channel': node_channel('draining'), 'delay': 1.0})
+    dispatcher.delayer.add({'task': 'tests.data.methods.print_hello', 'uuid': 'delayed-1', 'channel': 'test_channel', 'delay': 60.0})
+    dispatcher.held_messages.append({'task': 'tests.data.methods.print_hello', 'uuid': 'held-1', 'channel': 'test_channel', 'delay': 30.0})
+
+
+def test_handoff_message():
+    message = {'task': 'foo', 'uuid': 'a', 'channel': 'test_channel', 'time_received': 1.0, 'time_queued': 2.0, 'delay': 5.0, 'time_pub': 0.5}
+    assert handoff_message(message) == {'task': 'foo', 'uuid': 'a', 'time_pub': 0.5, 'handoffs': 1}
+    assert handoff_message(dict(message, handoffs=1), delay=2.0) == {'task': 'foo', 'uuid': 'a', 'time_pub': 0.5, 'delay': 2.0, 'handoffs': 2}
+
+
+@pytest.mark.asyncio
+async def test_queued_and_delayed_handed_off(make_draining):
+    dispatcher = make_draining()
+    add_work(dispatcher)
+    await dispatcher.drainer.drain(dispatcher)
+
+    sent = dispatcher.drainer.broker.sent
+    assert [(channel, message['uuid']) for channel, message in sent] == [
+        ('test_channel', 'queued-1'),
+        (None, 'queued-2'),
+        ('test_channel', 'held-1'),
+        ('test_channel', 'delayed-1'),
+    ]
+    assert 'delay' not in sent[1][1]  # already waited here
+    assert sent[2][1]['delay'] == 30.0  # intake was paused, so the delay has not started
+    assert 59.0 < sent[3][1]['delay'] <= 60.0
+    assert dispatcher.drainer.handoff_count == 4
+    assert list(dispatcher.pool.queued_messages) == []
+    assert dispatcher.held_messages == []
+    assert len(dispatcher.delayer) == 0
+
+
+@pytest.mark.asyncio
+async def test_queued_kept_if_handoff_fails(make_draining):
+    dispatcher = make_draining(fail=True)
+    add_work(dispatcher)
+    await dispatcher.drainer.drain(dispatcher)
+    assert [message['uuid'] for message in dispatcher.pool.queued_messages] == ['queued-1', 'queued-2']
+    assert [message['uuid'] for message in dispatcher.held_messages] == ['held-1']
+    assert [capsule.uuid for capsule in dispatcher.delayer.capsules] == ['delayed-1']
+    assert dispatcher.drainer.handoff_count == 0
+
+
+@pytest.mark.asyncio
+async def test_store_keeps_work_for_next_start(make_draining, tmp_path):
+    store = LocalStore(path=str(tmp_path / 'store.sqlite3'))
+    dispatcher = make_draining(store=store, fail=True)
+    add_work(dispatcher)
+    await dispatcher.drainer.drain(dispatcher)
+    assert list(dispatcher.pool.queued_messages) == []
+    assert dispatcher.held_messages == []
+    assert len(dispatcher.delayer) == 1  # left for the store, not handed off
+
+    await store.flush()
+    store.load()
+    pending = {message['uuid']: message for message in store.pending_delayed()}
+    assert sorted(pending) == ['delayed-1', 'held-1', 'queued-1', 'queued-2']
+    assert 29.0 < pending['held-1']['delay'] <= 30.0
+
+
+@pytest.mark.asyncio
+async def test_drain_timeout(make_draining):
+    dispatcher = make_draining()
+    dispatcher.pool.get_running_count = lambda: 1  # a task that never finishes
+    start = time.monotonic()
+    assert await dispatcher.drainer.wait_for_running(dispatcher) is False
+    assert time.monotonic() - start < 1.0
+
+    dispatcher.pool.get_running_count = lambda: 0
+    assert await dispatcher.drainer.wait_for_running(dispatcher) is True
+
+
+@pytest.mark.asyncio
+async def test_drain_hands_off_to_other_node():
+    config = copy.deepcopy(MEMORY_CONFIG)
+    config['service']['heartbeat_kwargs'] = {'interval': 1.0}
+    config['service']['drain_kwargs'] = {'timeout': 2.0}
+    config['service']['pool_kwargs'] = {'min_workers': 1, 'max_workers': 1}
+    settings = DispatcherSettings(config)
+    stopping, other = [from_settings(settings=settings) for _ in range(2)]
+    try:
+        for dispatcher in (stopping, other):
+            await dispatcher.start_working()
+            await dispatcher.wait_for_producers_ready()
+            await dispatcher.pool.events.workers_ready.wait()
+
+        publisher = Broker()
+        for i in range(3):
+            message = {'task': 'tests.data.methods.sleep_function', 'args': [0.1], 'uuid': f'drain-{i}'}
+            await publisher.apublish_message(channel=node_channel(stopping.node_id), message=json.dumps(message))
+        delayed = {'task': 'tests.data.methods.print_hello', 'uuid': 'drain-delayed', 'delay': 0.2}
+        await publisher.apublish_message(channel=node_channel(stopping.node_id), message=json.dumps(delayed))
+        for _ in range(100):
+            if len(stopping.pool.queued_messages) == 2 and len(stopping.delayer) == 1:
+                break
+            await asyncio.sleep(0.01)
+
+        await stopping.shutdown()
+        assert stopping.pool.finished_count == 1  # the running task finished
+        assert stopping.drainer.handoff_count == 3
+        for _ in range(300):
+            if other.pool.finished_count >= 3:
+                break
+            await asyncio.sleep(0.01)
+        assert other.pool.finished_count == 3
+    finally:
+        for dispatcher in (stopping, other):
+            await dispatcher.shutdown()
+        await stopping.cancel_tasks()
@@ -0,0 +1,55 @@
+import asyncio
+import copy
+import json
+import time
+
+import pytest
+
+from dispatcher.config import DispatcherSettings
+from dispatcher.factories import from_settings, get_control_from_settings
+from dispatcher.nodes import node_channel
+from dispatcher.service.heartbeat import Heartbeat
+
+from tests.conftest import MEMORY_CONFIG
+
+
+def test_channels_announced_with_route_channel(make_dispatcher, recording_broker):
+    dispatcher = make_dispatcher()
+    data = json.loads(dispatcher.heartbeat.get_message(dispatcher))
+    assert data['route_channel'] == node_channel('busy')
+    assert data['channels'] == []
+
+    dispatcher.heartbeat = Heartbeat(recording_broker())
+    data = json.loads(dispatcher.heartbeat.get_message(dispatcher))
+    assert 'route_channel' not in data
+    assert 'channels' not in data  # not known, so clients do not count on it
+
+
+@pytest.mark.asyncio
+async def test_control_client_expects_live_nodes():
+    config = copy.deepcopy(MEMORY_CONFIG)
+    config['service']['heartbeat_kwargs'] = {'interval': 0.1}
+    settings = DispatcherSettings(config)
+    dispatchers = [from_settings(settings=settings) for _ in range(2)]
+    try:
+        async with get_control_from_settings(settings=settings).client() as client:
+            for dispatcher in dispatchers:
+                await dispatcher.start_working()
+                await dispatcher.wait_for_producers_ready()
+            await asyncio.sleep(0.2)  # listen for a full heartbeat interval
+            assert set(client.nodes.live_nodes()) == {dispatcher.node_id for dispatcher in dispatchers}
+
+            start = time.monotonic()
+            replies = await asyncio.wait_for(client.acontrol_with_reply('alive', expected_replies=None, timeout=3), timeout=5)
+            assert time.monotonic() - start < 1.0  # did not wait for the timeout
+            assert sorted(reply['node_id'] for reply in replies) == sorted(dispatcher.node_id for dispatcher in dispatchers)
+
+            await dispatchers[1].shutdown()
+            await asyncio.sleep(0.01)
+            assert set(client.nodes.live_nodes()) == {dispatchers[0].node_id}  # announced stopping
+            replies = await asyncio.wait_for(client.acontrol_with_reply('alive', expected_replies=None, timeout=3), timeout=5)
+            assert replies == [{'node_id': dispatchers[0].node_id}]
+    finally:
+        for dispatcher in dispatchers:
+            await dispatcher.shutdown()
+        await dispatchers[0].cancel_tasks()
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+import pytest
+
+from dispatcher.factories import loop_monitor_from_settings
+from dispatcher.service.loop_monitor import LoopMonitor
+from dispatcher.service.main import DispatcherMain
+from dispatcher.service.pool import WorkerPool
+from dispatcher.service.process import ForkServerManager, ProcessManager
+
+
+def block_the_loop():
+    time.sleep(0.3)
+
+
+@pytest.mark.asyncio
+async def test_slow_callback_source(test_settings):
+    monitor = LoopMonitor(interval=0.02, slow_threshold=0.1, use_watchdog=True)
+    dispatcher = DispatcherMain([], WorkerPool(ProcessManager(settings=test_settings)), loop_monitor=monitor)
+    await monitor.start(dispatcher)
+    try:
+        await asyncio.sleep(0.1)
+        block_the_loop()
+        await asyncio.sleep(0.1)
+    finally:
+        await monitor.shutdown()
+
+    summary = monitor.summary()
+    assert summary['slow_count'] == 1
+    slow = summary['slow_callbacks'][0]
+    assert 0.2 < slow['lag'] < 1.0
+    assert any('block_the_loop' in entry for entry in slow['source'])
+    assert summary['lag']['count'] > 5
+    assert summary['lag']['p50'] < 0.1
+    assert 'dispatcher_loop_slow_callbacks_total 1.0' in dispatcher.metrics.render()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('manager_cls, watchdog', [(ProcessManager, False), (ForkServerManager, True)])
+async def test_no_watchdog_when_forking_from_service(test_settings, manager_cls, watchdog):
+    "Workers are forked from the service for scale-up and recycling too, which is unsafe while the thread runs"
+    monitor = LoopMonitor(interval=0.01)
+    dispatcher = DispatcherMain([], WorkerPool(manager_cls(settings=test_settings)), loop_monitor=monitor)
+    await monitor.start(dispatcher)
+    try:
+        assert (monitor.watchdog is not None) is watchdog
+        await asyncio.sleep(0.05)
+        assert monitor.lag_summary.summary()['count'] > 0  # lag is measured either way
+    finally:
+        await monitor.shutdown()
+
+
+def test_off_by_default(test_settings):
+    assert DispatcherMain([], WorkerPool(ProcessManager(settings=test_settings))).loop_monitor is None
+    assert loop_monitor_from_settings(settings=test_settings) is None
+
+
+def test_lag_under_threshold_not_slow():
+    monitor = LoopMonitor(slow_threshold=0.1)
+    monitor.record(1, 0.05)
+    assert monitor.slow_count == 0
+    monitor.stall = (2, ['somewhere.py:1 in blocker'])
+    monitor.record(2, 0.5)
+    monitor.record(3, 0.5)  # stack was captured for another tick
+    assert [slow['source'] for slow in monitor.slow_callbacks] == [['somewhere.py:1 in blocker'], []]
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from dispatcher.service.metrics import Counter, Gauge, Histogram, LatencyHistogram, MetricsRegistry, MetricsServer, TaskLatency, TaskResources
+
+
+def test_render_counter_and_gauge():
+    registry = MetricsRegistry()
+    counter = registry.register(Counter('things_total', 'Things that happened', labelnames=('kind',)))
+    registry.register(Gauge('depth', 'Current depth', collect=lambda: 7))
+    counter.inc(kind='a')
+    counter.inc(2, kind='b"quoted"')
+
+    text = registry.render()
+    assert '# TYPE things_total counter' in text
+    assert 'things_total{kind="a"} 1.0' in text
+    assert 'things_total{kind="b\\"quoted\\""} 2.0' in text
+    assert '# HELP depth Current depth' in text
+    assert 'depth 7.0' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+
+    lines = histogram.render().splitlines()
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum 6.05' in lines
+    assert 'latency_seconds_count 4' in lines
+
+
+def test_duplicate_metric_name():
+    registry = MetricsRegistry()
+    registry.register(Gauge('depth', 'Current depth'))
+    with pytest.raises(ValueError):
+        registry.register(Counter('depth', 'Current depth'))
+
+
+def test_broken_callback_does_not_break_render():
+    registry = MetricsRegistry()
+    registry.register(Gauge('broken', 'Raises', collect=lambda: 1 / 0))
+    registry.register(Gauge('fine', 'Works', collect=lambda: 1))
+    text = registry.render()
+    assert 'fine 1.0' in text
+    assert 'broken' not in text
+
+
+async def http_get(path: str, request_path: str) -> bytes:
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(f'GET {request_path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+@pytest.mark.asyncio
+async def test_serve_over_unix_socket(tmp_path):
+    registry = MetricsRegistry()
+    registry.register(Gauge('depth', 'Current depth', collect=lambda: 3))
+    path = str(tmp_path / 'metrics.sock')
+    server = MetricsServer(path=path)
+    await server.start(registry)
+    try:
+        response = await http_get(path, '/metrics')
+        assert response.startswith(b'HTTP/1.1 200 OK')
+        assert b'text/plain; version=0.0.4' in response
+        assert response.endswith(b'depth 3.0\n')
+
+        response = await http_get(path, '/other')
+        assert response.startswith(b'HTTP/1.1 404')
+
+        response = await http_get(path, '/' + 'x' * 100000)  # longer than the stream limit
+        assert response.startswith(b'HTTP/1.1 400')
+    finally:
+        await server.shutdown()
+
+
+def test_latency_percentiles_within_bucket_error():
+    histogram = LatencyHistogram()
+    for i in range(1, 1001):
+        histogram.record(i / 1000.0)  # 1 ms to 1 s
+    assert histogram.count == 1000
+    assert histogram.percentile(50) == pytest.approx(0.5, rel=0.02)
+    assert histogram.percentile(99) == pytest.approx(0.99, rel=0.02)
+    summary = histogram.summary()
+    assert summary['min'] == 0.001
+    assert summary['max'] == 1.0
+    assert summary['mean'] == pytest.approx(0.5005)
+
+
+def test_task_latency_limits_task_names():
+    latency = TaskLatency(max_tasks=2)
+    for task in ('a', 'b', 'c', 'd'):
+        latency.record(task, 'run', 0.1)
+    latency.record('a', 'run', 0.2)
+    summary = latency.summary()
+    assert set(summary.keys()) == {'a', 'b', '<other>'}
+    assert summary['a']['run']['count'] == 2
+    assert summary['<other>']['run']['count'] == 2
+    assert list(latency.summary(task='b').keys()) == ['b']
+
+
+def test_task_resources_by_cost():
+    resources = TaskResources(max_tasks=2)
+    resources.record('cheap', {'cpu_user': 0.1, 'cpu_system': 0.0, 'max_rss_delta': 100})
+    resources.record('costly', {'cpu_user': 1.0, 'cpu_system': 0.5, 'max_rss_delta': 0})
+    resources.record('costly', {'cpu_user': 2.0, 'cpu_system': 0.5, 'max_rss_delta': 300})
+    resources.record('new', {'cpu_user': 0.1, 'cpu_system': 0.0})
+    summary = resources.summary()
+    assert list(summary.keys()) == ['costly', 'cheap', '<other>']
+    assert summary['costly']['count'] == 2
+    assert summary['costly']['total']['cpu_user'] == 3.0
+    assert summary['costly']['mean']['cpu_system'] == 0.5
+    assert summary['costly']['max']['max_rss_delta'] == 300
+    assert list(resources.summary(top=1).keys()) == ['costly']
+    assert list(resources.summary(task='cheap').keys()) == ['cheap']
+    assert resources.cpu_seconds()[('costly', 'user')] == 3.0
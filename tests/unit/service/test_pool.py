@@ -4,7 +4,7 @@ from unittest import mock
 
 import pytest
 
-from dispatcher.service.pool import WorkerPool
+from dispatcher.service.pool import MessageQueue, PoolWorker, WorkerPool
 from dispatcher.service.process import ProcessManager
 
 
@@ -35,6 +35,22 @@ async def test_scale_due_to_queue_pressure(test_settings):
     assert set([worker.status for worker in pool.workers.values()]) == {'ready', 'initialized'}
 
 
+@pytest.mark.asyncio
+async def test_scale_up_continues_under_pressure(test_settings):
+    "With more queued tasks than one new worker can take, the manager is kicked to scale again right away"
+    pm = ProcessManager(settings=test_settings)
+    pool = WorkerPool(pm, min_workers=1, max_workers=4)
+    await pool.scale_workers()
+    pool.workers[0].status = 'ready'  # a lie, for test
+    pool.workers[0].current_task = {'task': 'waiting.task'}
+    pool.queued_messages = [{'task': 'waiting.task'} for i in range(3)]
+    for expected_ct in (2, 3, 4):
+        pool.events.management_event.clear()
+        await pool.scale_workers()
+        assert len(pool.workers) == expected_ct
+    assert not pool.events.management_event.is_set()  # at max_workers, so no reason to check again
+
+
 @pytest.mark.asyncio
 async def test_initialized_workers_count_for_scaling(test_settings):
     """If we have workers currently scaling up, and queued tasks, we should not scale more workers
@@ -117,3 +133,133 @@ async def test_error_while_scaling_up(test_settings):
         await pool.manage_new_workers(asyncio.Lock())
 
     assert set([worker.status for worker in pool.workers.values()]) == {'error'}
+
+
+def exit_after_short_sleep(settings, finished_queue, message_queue, worker_id=None):
+    time.sleep(0.2)
+
+
+@pytest.mark.asyncio
+async def test_join_does_not_block_event_loop(test_settings):
+    """Waiting on a worker process to exit should let other event loop work continue"""
+    pm = ProcessManager(settings=test_settings)
+    process = pm.create_process(target=exit_after_short_sleep)
+    worker = PoolWorker(0, process)
+    await worker.start()
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.monotonic()
+    await worker.join(timeout=3)
+    delta = time.monotonic() - start
+    ticker_task.cancel()
+
+    assert not process.is_alive()
+    assert worker.process_exited.is_set()
+    assert delta < 1.0  # returned on exit event, not the timeout
+    assert ticks > 5  # event loop kept running while we waited
+
+
+@pytest.mark.asyncio
+async def test_stop_killed_worker_quickly(test_settings):
+    """A worker whose process was killed externally is reaped as soon as the loop sees it exit"""
+    pm = ProcessManager(settings=test_settings)
+    process = pm.create_process(target=sleep_forever)
+    worker = PoolWorker(0, process)
+    await worker.start()
+    worker.status = 'exited'  # a lie, for test, skip waiting on exit message
+
+    start = time.monotonic()
+    process.kill()
+    await worker.stop()
+    delta = time.monotonic() - start
+
+    assert worker.status == 'retired'
+    assert not process.is_alive()
+    assert delta < 1.0
+
+
+def sleep_forever(settings, finished_queue, message_queue, worker_id=None):
+    while True:
+        time.sleep(1)
+
+
+@pytest.mark.asyncio
+async def test_killed_worker_is_marked_exited(test_settings):
+    """A worker that dies while running a task is noticed right away, and its task does not stay running"""
+    pm = ProcessManager(settings=test_settings)
+    pool = WorkerPool(pm, min_workers=1, max_workers=1)
+    worker = PoolWorker(0, pm.create_process(target=sleep_forever), on_exit=pool.worker_exited)
+    pool.workers[0] = worker
+    await worker.start()
+    worker.status = 'ready'  # a lie, for test
+    message = {'task': 'waiting.task', 'uuid': 'doomed'}
+    await worker.start_task(message)
+    pool.running_index.add(message, worker)
+
+    pool.events.management_event.clear()
+    worker.process.kill()
+    await asyncio.wait_for(pool.events.management_event.wait(), timeout=3)
+    assert worker.status == 'exited'
+
+    await pool.manage_old_workers()
+    assert worker.status == 'retired'
+    assert worker.current_task is None
+    assert pool.finished_count == 1
+    assert pool.events.work_cleared.is_set()
+
+
+@pytest.mark.asyncio
+async def test_queued_messages_indexed(test_settings):
+    pm = ProcessManager(settings=test_settings)
+    pool = WorkerPool(pm, min_workers=1, max_workers=1)
+    for i in range(3):
+        await pool.dispatch_task({'task': 'waiting.task', 'uuid': f'queued-{i}'})  # no workers ready, all queue
+    assert len(pool.queued_messages) == 3
+    assert pool.queued_index.get('queued-1') is list(pool.queued_messages)[1]
+
+    pool.remove_queued(pool.queued_index.get('queued-1'))
+    assert [message['uuid'] for message in pool.queued_messages] == ['queued-0', 'queued-2']
+    assert pool.queued_index.get('queued-1') is None
+    assert len(pool.queued_index.for_task('waiting.task')) == 2
+
+
+@pytest.mark.asyncio
+async def test_set_limits_at_runtime(test_settings):
+    "Lowering max_workers stops idle workers above it right away, without waiting for scaledown_wait"
+    pm = ProcessManager(settings=test_settings)
+    pool = WorkerPool(pm, min_workers=3, max_workers=3)
+    await pool.scale_workers()
+    for worker in pool.workers.values():
+        worker.status = 'ready'  # a lie, for test
+    pool.workers[0].current_task = {'task': 'waiting.task'}
+
+    pool.events.management_event.clear()
+    pool.set_limits(min_workers=1, max_workers=1)
+    assert pool.events.management_event.is_set()
+    await pool.scale_workers()
+    assert [worker.status for worker in pool.workers.values()] == ['ready', 'stopping', 'stopping']  # busy worker kept
+
+    with pytest.raises(ValueError):
+        pool.set_limits(min_workers=2)  # above max_workers
+    assert (pool.min_workers, pool.max_workers) == (1, 1)
+
+
+def test_message_queue_removal():
+    queue = MessageQueue()
+    messages = [{'task': 'waiting.task'} for i in range(3)]  # equal, but different messages
+    for message in messages:
+        queue.append(message)
+
+    queue.remove(messages[1])
+    assert [id(message) for message in queue] == [id(messages[0]), id(messages[2])]
+    assert len(queue) == 2
+    with pytest.raises(ValueError):
+        queue.remove(messages[1])
@@ -0,0 +1,26 @@
+import pytest
+
+from dispatcher.service.profiling import TaskProfiling
+
+
+def test_armed_for_count_runs(tmp_path):
+    profiling = TaskProfiling(directory=str(tmp_path), max_results=2)
+    profiling.arm('foo', count=2, mode='memory', top=5)
+    assert profiling.take({'task': 'bar'}) is None
+    assert profiling.take({'task': 'foo'}) == {'mode': 'memory', 'directory': str(tmp_path), 'top': 5}
+    assert profiling.take({'task': 'foo'}) is not None
+    assert profiling.take({'task': 'foo'}) is None  # both runs used
+    assert profiling.armed == {}
+
+    for i in range(3):
+        profiling.record('foo', {'uuid': str(i)})
+    assert profiling.summary() == {'foo': [{'uuid': '1'}, {'uuid': '2'}]}
+    assert profiling.summary(task='bar') == {}
+
+
+def test_invalid_profile_options():
+    profiling = TaskProfiling()
+    with pytest.raises(ValueError):
+        profiling.arm('foo', mode='gpu')
+    with pytest.raises(ValueError):
+        profiling.arm('foo', count=0)
@@ -0,0 +1,123 @@
+import asyncio
+import copy
+import json
+
+import pytest
+
+from dispatcher.brokers.memory import Broker
+from dispatcher.config import DispatcherSettings
+from dispatcher.factories import from_settings
+from dispatcher.nodes import node_channel
+from dispatcher.service.rebalancer import Rebalancer
+
+from tests.conftest import MEMORY_CONFIG
+
+
+@pytest.fixture
+def make_rebalancing(make_dispatcher):
+    def _make_rebalancing(node_id='busy', **rebalance_kwargs):
+        return make_dispatcher(node_id=node_id, rebalancer=Rebalancer(Broker(), **rebalance_kwargs))
+
+    return _make_rebalancing
+
+
+def idle_heartbeat(node_id, free=2, accepting=True, channels=('test_channel',)):
+    return {
+        'heartbeat': node_id,
+        'interval': 10.0,
+        'load': {'free': free, 'queued': 0, 'accepting': accepting},
+        'route_channel': node_channel(node_id),
+        'channels': list(channels),
+    }
+
+
+def queue_tasks(dispatcher, ct, **extra):
+    for i in range(ct):
+        dispatcher.pool.queue_message(dict({'task': 'tests.data.methods.print_hello', 'uuid': f'task-{i}', 'channel': 'test_channel'}, **extra))
+
+
+@pytest.mark.asyncio
+async def test_surplus_sent_to_idle_node(make_rebalancing):
+    dispatcher = make_rebalancing(surplus_threshold=2)
+    rebalancer = dispatcher.rebalancer
+    rebalancer.nodes.update(idle_heartbeat('idle', free=2))
+    rebalancer.nodes.update(idle_heartbeat('full', accepting=False))
+    queue_tasks(dispatcher, 5)
+
+    assert await rebalancer.rebalance(dispatcher) == 2  # no more than the free workers announced
+    sent = dispatcher.heartbeat.broker.sent
+    assert [channel for channel, _ in sent] == [node_channel('idle')] * 2
+    assert [message['uuid'] for _, message in sent] == ['task-2', 'task-3']  # oldest stay here
+    assert sent[0][1]['rebalanced'] == ['busy']
+    assert 'channel' not in sent[0][1]
+    assert [message['uuid'] for message in dispatcher.pool.queued_messages] == ['task-0', 'task-1', 'task-4']
+
+    assert await rebalancer.rebalance(dispatcher) == 0  # idle node is full until its next heartbeat
+
+
+@pytest.mark.asyncio
+async def test_no_ping_pong(make_rebalancing):
+    dispatcher = make_rebalancing(surplus_threshold=0)
+    rebalancer = dispatcher.rebalancer
+    rebalancer.nodes.update(idle_heartbeat('idle'))
+    queue_tasks(dispatcher, 2, rebalanced=['idle'])  # already moved here once
+    queue_tasks(dispatcher, 1, on_duplicate='serial')
+    assert await rebalancer.rebalance(dispatcher) == 0
+
+    # with more hops allowed, still never sent back to a node it came from
+    rebalancer.max_hops = 3
+    assert await rebalancer.rebalance(dispatcher) == 0
+    rebalancer.nodes.update(idle_heartbeat('other'))
+    assert await rebalancer.rebalance(dispatcher) == 2
+    assert {channel for channel, _ in dispatcher.heartbeat.broker.sent} == {node_channel('other')}
+
+
+@pytest.mark.asyncio
+async def test_only_nodes_on_same_queue(make_rebalancing):
+    dispatcher = make_rebalancing(surplus_threshold=0)
+    rebalancer = dispatcher.rebalancer
+    rebalancer.nodes.update(idle_heartbeat('idle', channels=['other_channel']))
+    queue_tasks(dispatcher, 1)
+    assert await rebalancer.rebalance(dispatcher) == 0
+
+    next(iter(dispatcher.pool.queued_messages))['channel'] = node_channel('busy')  # routed here, so any node can take it
+    assert await rebalancer.rebalance(dispatcher) == 1
+
+
+def test_accepting_announced_in_heartbeat(make_rebalancing):
+    dispatcher = make_rebalancing()
+    dispatcher.pool.max_workers = 2
+    assert json.loads(dispatcher.heartbeat.get_message(dispatcher))['load']['accepting'] is True
+    queue_tasks(dispatcher, 1)
+    assert json.loads(dispatcher.heartbeat.get_message(dispatcher))['load']['accepting'] is False
+
+
+@pytest.mark.asyncio
+async def test_queued_tasks_move_to_idle_node():
+    config = copy.deepcopy(MEMORY_CONFIG)
+    config['service']['heartbeat_kwargs'] = {'interval': 0.05}
+    config['service']['rebalance_kwargs'] = {'interval': 0.05, 'surplus_threshold': 1}
+    config['service']['pool_kwargs'] = {'min_workers': 1, 'max_workers': 1}
+    settings = DispatcherSettings(config)
+    busy, idle = [from_settings(settings=settings) for _ in range(2)]
+    try:
+        for dispatcher in (busy, idle):
+            await dispatcher.start_working()
+            await dispatcher.wait_for_producers_ready()
+            await dispatcher.pool.events.workers_ready.wait()
+
+        publisher = Broker()
+        for i in range(4):
+            message = {'task': 'tests.data.methods.sleep_function', 'args': [0.1], 'uuid': f'rebalance-{i}'}
+            await publisher.apublish_message(channel=node_channel(busy.node_id), message=json.dumps(message))
+        for _ in range(300):
+            if busy.pool.finished_count + idle.pool.finished_count >= 4:
+                break
+            await asyncio.sleep(0.01)
+        assert busy.pool.finished_count + idle.pool.finished_count == 4
+        assert idle.pool.finished_count >= 1
+        assert busy.rebalancer.sent_count == idle.pool.finished_count
+    finally:
+        for dispatcher in (busy, idle):
+            await dispatcher.shutdown()
+        await busy.cancel_tasks()
@@ -0,0 +1,42 @@
+import asyncio
+import copy
+
+import pytest
+
+from dispatcher.config import DispatcherSettings
+from dispatcher.factories import from_settings, get_node_directory
+
+from tests.conftest import MEMORY_CONFIG
+from tests.data import methods as test_methods
+
+
+@pytest.mark.asyncio
+async def test_route_to_least_loaded_node():
+    config = copy.deepcopy(MEMORY_CONFIG)
+    config['service']['heartbeat_kwargs'] = {'interval': 0.1}
+    config['service']['pool_kwargs'] = {'min_workers': 1, 'max_workers': 1}
+    settings = DispatcherSettings(config)
+    directory = get_node_directory(settings=settings)
+    dispatchers = [from_settings(settings=settings) for _ in range(2)]
+    try:
+        for dispatcher in dispatchers:
+            await dispatcher.start_working()
+            await dispatcher.wait_for_producers_ready()
+        for _ in range(100):
+            if len(directory.live_nodes()) == 2:
+                break
+            await asyncio.sleep(0.01)
+
+        for _ in range(2):
+            _, channel = test_methods.sleep_function.apply_async(args=[0.2], settings=settings, route='least_loaded')
+            assert channel.startswith('dispatcher_node_')
+        for _ in range(100):
+            if sum(dispatcher.pool.received_count for dispatcher in dispatchers) >= 2:
+                break
+            await asyncio.sleep(0.01)
+        # the one free worker of each node was known, so the tasks were spread
+        assert [dispatcher.pool.received_count for dispatcher in dispatchers] == [1, 1]
+    finally:
+        for dispatcher in dispatchers:
+            await dispatcher.shutdown()
+        await dispatchers[0].cancel_tasks()
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from dispatcher.service.delayer import Delayer
+from dispatcher.service.store import LocalStore
+
+
+@pytest.mark.asyncio
+async def test_delayed_messages_survive_restart(tmp_path):
+    path = str(tmp_path / 'store.sqlite3')
+    store = LocalStore(path=path)
+    delayer = Delayer(store=store)
+    delayer.add({'uuid': 'keep', 'delay': 60.0, 'task': 'tests.data.methods.print_hello'})
+    delayer.add({'uuid': 'drop', 'delay': 60.0, 'task': 'tests.data.methods.print_hello'})
+    delayer.cancel('drop')
+    await store.shutdown()  # final flush
+
+    new_store = LocalStore(path=path)
+    new_store.load()
+    messages = new_store.pending_delayed()
+    assert [message['uuid'] for message in messages] == ['keep']
+    assert 55.0 < messages[0]['delay'] <= 60.0  # remaining time, not the original delay
+    await new_store.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_expired_delayed_message_removed(tmp_path):
+    path = str(tmp_path / 'store.sqlite3')
+    store = LocalStore(path=path)
+    delayer = Delayer(store=store)
+    delayer.add({'uuid': 'ran', 'delay': 0.0})
+    assert [capsule.uuid for capsule in delayer.pop_expired(time.monotonic())] == ['ran']
+    await store.shutdown()
+
+    new_store = LocalStore(path=path)
+    new_store.load()
+    assert new_store.pending_delayed() == []
+    await new_store.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_schedule_runs_saved(tmp_path):
+    path = str(tmp_path / 'store.sqlite3')
+    store = LocalStore(path=path)
+    store.record_schedule_run('tests.data.methods.print_hello', 12345.0)
+    await store.flush()
+    await store.shutdown()
+
+    new_store = LocalStore(path=path)
+    new_store.load()
+    assert new_store.schedule_runs == {'tests.data.methods.print_hello': 12345.0}
+    await new_store.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_same_uuid_keeps_remaining_message(tmp_path):
+    path = str(tmp_path / 'store.sqlite3')
+    store = LocalStore(path=path)
+    delayer = Delayer(store=store)
+    delayer.add({'uuid': 'same', 'delay': 0.0, 'args': [1]})
+    delayer.add({'uuid': 'same', 'delay': 60.0, 'args': [2]})
+    assert [capsule.message['args'] for capsule in delayer.pop_expired(time.monotonic())] == [[1]]
+    await store.shutdown()
+
+    new_store = LocalStore(path=path)
+    new_store.load()
+    assert [message['args'] for message in new_store.pending_delayed()] == [[2]]  # the one still waiting is saved
+    await new_store.shutdown()
@@ -0,0 +1,45 @@
+from dispatcher.service.task_index import TaskIndex
+
+
+def test_lookup_by_uuid_and_task():
+    index = TaskIndex()
+    messages = [{'uuid': f'uuid-{i}', 'task': 'tests.data.methods.print_hello' if i % 2 else 'other.task'} for i in range(6)]
+    for message in messages:
+        index.add(message, message)
+
+    assert index.get('uuid-3') is messages[3]
+    assert index.get('uuid-missing') is None
+    assert [message['uuid'] for message in index.for_task('tests.data.methods.print_hello')] == ['uuid-1', 'uuid-3', 'uuid-5']
+
+    index.remove(messages[3], messages[3])
+    assert index.get('uuid-3') is None
+    assert [message['uuid'] for message in index.for_task('tests.data.methods.print_hello')] == ['uuid-1', 'uuid-5']
+    assert len(index) == 5
+
+
+def test_candidates_from_control_data():
+    index = TaskIndex()
+    message = {'uuid': 'find-me', 'task': 'other.task'}
+    index.add(message, 'worker-entry')
+
+    assert index.candidates({'uuid': 'find-me'}) == ['worker-entry']
+    assert index.candidates({'uuid': 'not-here'}) == []
+    assert index.candidates({'task': 'other.task'}) == ['worker-entry']
+    assert index.candidates({'args': [1]}) is None  # index can not help, caller must scan
+
+
+def test_duplicate_uuid_keeps_both():
+    index = TaskIndex()
+    first = {'uuid': 'same', 'task': 'other.task'}
+    second = {'uuid': 'same', 'task': 'other.task'}
+    index.add(first, first)
+    index.add(second, second)
+    assert index.get('same') is second
+    assert index.for_uuid('same') == [first, second]
+    assert index.candidates({'uuid': 'same'}) == [first, second]
+    assert len(index) == 2
+
+    index.remove(second, second)  # removing the newer entry leaves the older one
+    assert index.get('same') is first
+    assert index.for_task('other.task') == [first]
+    assert len(index) == 1
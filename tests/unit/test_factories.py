@@ -1,8 +1,16 @@
+import asyncio
+import json
+import multiprocessing
 from unittest import mock
 
-from dispatcher.factories import process_manager_from_settings
+import pytest
+
+from dispatcher.brokers.memory import Broker
+from dispatcher.factories import PublisherCache, get_cached_publisher, process_manager_from_settings
 from dispatcher.config import temporary_settings, DispatcherSettings
 
+from tests.data import methods as test_methods
+
 
 def test_pass_preload_modules():
     test_config = {
@@ -19,3 +27,73 @@ def test_pass_preload_modules():
         with mock.patch('dispatcher.service.process.ForkServerManager.__init__', return_value=None) as mock_init:
             process_manager_from_settings()
             mock_init.assert_called_once_with(preload_modules=['test.not_real.hazmat'], settings=mock.ANY)
+
+
+MEMORY_CONFIG = {'version': 2, 'brokers': {'memory': {'default_publish_channel': 'test_channel'}}}
+
+
+def test_cached_publisher_reused():
+    settings = DispatcherSettings(MEMORY_CONFIG)
+    broker = get_cached_publisher(settings=settings)
+    assert get_cached_publisher(settings=DispatcherSettings(MEMORY_CONFIG)) is broker  # same config, same broker
+
+    other_settings = DispatcherSettings({'version': 2, 'brokers': {'memory': {'default_publish_channel': 'other_channel'}}})
+    assert get_cached_publisher(settings=other_settings) is not broker
+
+
+def _check_new_broker_in_child(parent_broker_id, queue):
+    queue.put(id(get_cached_publisher(settings=DispatcherSettings(MEMORY_CONFIG))) != parent_broker_id)
+
+
+def test_cached_publisher_after_fork():
+    broker = get_cached_publisher(settings=DispatcherSettings(MEMORY_CONFIG))
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_check_new_broker_in_child, args=(id(broker), queue))
+    process.start()
+    process.join()
+    assert queue.get(timeout=2) is True
+
+
+@pytest.mark.asyncio
+async def test_async_submissions_batched():
+    settings = DispatcherSettings(MEMORY_CONFIG)
+    listener = Broker(channels=('test_channel',))
+    batch_sizes = []
+    original_apublish_many = Broker.apublish_many
+
+    async def record_batch(self, messages):
+        messages = list(messages)
+        batch_sizes.append(len(messages))
+        await original_apublish_many(self, messages)
+
+    async def send():
+        with mock.patch.object(Broker, 'apublish_many', record_batch):
+            await asyncio.gather(*[test_methods.print_hello.aapply_async(settings=settings) for _ in range(10)])
+            await test_methods.print_hello.adelay()  # uses global settings
+        assert batch_sizes == [10, 1]
+
+    async def listen():
+        received = []
+        async for _, message in listener.aprocess_notify(connected_callback=send):
+            received.append(json.loads(message))
+            if len(received) == 11:
+                return received
+
+    with temporary_settings(MEMORY_CONFIG):
+        received = await asyncio.wait_for(listen(), timeout=2)
+    assert all(message['task'] == 'tests.data.methods.print_hello' for message in received)
+
+
+def test_batcher_of_closed_loop_closes_its_broker(caplog):
+    cache = PublisherCache()
+
+    async def get_batcher():
+        return cache.get_batcher('memory', {'default_publish_channel': 'test_channel'})
+
+    first = asyncio.run(get_batcher())
+    with mock.patch.object(first.broker, 'abandon_async_connections', return_value=False) as abandon:
+        second = asyncio.run(get_batcher())
+    abandon.assert_called_once_with()
+    assert list(cache.batchers.values()) == [second]
+    assert 'leaked' in caplog.text  # the broker could not close its connection without the loop
@@ -0,0 +1,100 @@
+import time
+
+from dispatcher.control import PendingReplies
+from dispatcher.nodes import NodeDirectory, node_channel
+
+
+def test_nodes_from_heartbeats():
+    directory = NodeDirectory()
+    directory.mark_listening()
+    directory.update({'heartbeat': 'a', 'interval': 10.0, 'load': {'running': 2}})
+    directory.update({'heartbeat': 'b', 'interval': 10.0, 'load': {'running': 0}})
+    assert set(directory.live_nodes()) == {'a', 'b'}
+    assert directory.nodes['a'].load == {'running': 2}
+
+    directory.update({'heartbeat': 'b', 'interval': 10.0, 'stopping': True})
+    assert set(directory.live_nodes()) == {'a'}
+
+
+def test_node_missed_heartbeats():
+    directory = NodeDirectory(missed_heartbeats=2)
+    directory.update({'heartbeat': 'a', 'interval': 10.0})
+    directory.nodes['a'].last_seen = time.monotonic() - 21.0
+    assert directory.live_nodes() == {}
+
+
+def test_directory_complete_after_one_interval():
+    directory = NodeDirectory()
+    assert not directory.is_complete()  # not listening yet
+    directory.mark_listening()
+    directory.update({'heartbeat': 'a', 'interval': 10.0})
+    assert not directory.is_complete()  # another node may not have sent its heartbeat yet
+    directory.listening_since = time.monotonic() - 10.0
+    assert directory.is_complete()
+
+
+def test_pending_replies_from_expected_nodes():
+    pending = PendingReplies(0, expected_nodes={'a', 'b'})
+    pending.add({'node_id': 'a'})
+    assert not pending.done.is_set()
+    pending.add({'node_id': 'c'})  # not known yet, still counted as a reply
+    pending.add({'node_id': 'b'})
+    assert pending.done.is_set()
+    assert len(pending.replies) == 3
+
+    assert PendingReplies(0, expected_nodes=set()).done.is_set()
+
+
+def test_nodes_listening_on_channel():
+    directory = NodeDirectory()
+    directory.update({'heartbeat': 'a', 'interval': 10.0, 'channels': ['default']})
+    directory.update({'heartbeat': 'b', 'interval': 10.0, 'channels': ['default', 'slow']})
+    assert directory.listening_on('slow') == {'b'}
+    assert directory.listening_on('other') == set()
+
+    directory.update({'heartbeat': 'c', 'interval': 10.0})  # channels not announced
+    assert directory.listening_on('slow') is None
+
+
+def heartbeat(node_id, free=0, queued=0, p95_wait=0.0, channels=('default',)):
+    return {
+        'heartbeat': node_id,
+        'interval': 10.0,
+        'load': {'free': free, 'queued': queued, 'p95_wait': p95_wait},
+        'route_channel': node_channel(node_id),
+        'channels': list(channels),
+    }
+
+
+def test_pick_least_loaded():
+    directory = NodeDirectory()
+    assert directory.pick_least_loaded() is None
+
+    directory.update(heartbeat('a', free=1))
+    directory.update(heartbeat('b', p95_wait=0.5))
+    assert directory.pick_least_loaded().node_id == 'a'
+    assert directory.pick_least_loaded().node_id == 'a'  # no free workers left, but waits less
+    # tasks routed since the last heartbeat count towards the load
+    assert directory.pick_least_loaded().node_id == 'b'
+    assert directory.nodes['a'].load == {'free': 0, 'queued': 1, 'p95_wait': 0.0}
+
+
+def test_pick_only_nodes_on_queue():
+    directory = NodeDirectory()
+    directory.update(heartbeat('a', free=5, channels=['default']))
+    directory.update(heartbeat('b', queued=10, channels=['default', 'slow']))
+    assert directory.pick_least_loaded(queue='slow').node_id == 'b'
+    assert directory.pick_least_loaded(queue='other') is None
+
+
+def test_pick_two_random_nodes():
+    directory = NodeDirectory()
+    for i in range(5):
+        directory.update(heartbeat(f'node-{i}', queued=i * 100))
+    picked = {directory.pick_least_loaded().node_id for _ in range(20)}
+    assert 'node-4' not in picked  # always beaten by the other choice
+    assert len(picked) > 1
+
+
+def test_node_channel_is_identifier():
+    assert node_channel('9760671a-6261-45aa-881a-f66929ff9725') == 'dispatcher_node_9760671a_6261_45aa_881a_f66929ff9725'
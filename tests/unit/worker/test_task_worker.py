@@ -1,4 +1,8 @@
-from dispatcher.worker.task import TaskWorker
+import os
+
+import pytest
+
+from dispatcher.worker.task import TaskWorker, get_resource_usage
 from dispatcher.publish import task
 
 
@@ -18,3 +22,43 @@ def test_run_method_with_bind(registry):
         "task": dmethod.serialize_task(),
         "uuid": "12345"
     })
+
+
+def use_some_cpu():
+    return sum(i * i for i in range(200000))
+
+
+def test_finished_message_resources(registry):
+    task(registry=registry)(use_some_cpu)
+    message = {"task": registry.get_from_callable(use_some_cpu).serialize_task(), "uuid": "12345"}
+
+    worker = TaskWorker(1, registry=registry)
+    usage_start = get_resource_usage()
+    result = worker.perform_work(message)
+    resources = worker.get_finished_message(result, message, 0.0, usage_start=usage_start)['resources']
+    assert resources['cpu_user'] + resources['cpu_system'] > 0.0
+    assert resources['max_rss_delta'] >= 0
+    assert {'block_in', 'block_out'} <= set(resources)
+
+    assert 'resources' not in worker.get_finished_message(result, message, 0.0)
+
+
+def allocate_some_memory():
+    return len([str(i) for i in range(10000)])
+
+
+@pytest.mark.parametrize('mode', ['cpu', 'memory'])
+def test_profiled_task(registry, tmp_path, mode):
+    task(registry=registry)(allocate_some_memory)
+    dmethod = registry.get_from_callable(allocate_some_memory)
+    message = {"task": dmethod.serialize_task(), "uuid": "12345", "profile": {"mode": mode, "directory": str(tmp_path), "top": 3}}
+
+    worker = TaskWorker(1, registry=registry)
+    assert worker.perform_work(message) == 10000
+    summary = worker.get_finished_message(10000, message, 0.0)['profile']
+    assert summary['mode'] == mode
+    assert 0 < len(summary['top']) <= 3
+    assert os.path.exists(summary['path'])
+    if mode == 'memory':
+        assert summary['peak'] > 0
+    assert 'profile' not in worker.get_finished_message(10000, {"task": dmethod.serialize_task()}, 0.0)